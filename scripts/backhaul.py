@@ -0,0 +1,48 @@
+"""
+Backhaul sampling shared by the preprocessing scripts.
+
+"""
+import numpy as np
+
+#Backhaul types, in the order of the cumulative shares in the tower lut.
+BACKHAUL_TYPES = ['fiber', 'copper', 'microwave', 'satellite']
+
+
+def sample_backhaul_types(sites, tower_backhaul_lut, seed=None):
+    """
+    Split the sites in each region by backhaul type.
+
+    Each site has the backhaul type shares of `tower_backhaul_lut`, so the
+    counts in each region are drawn from a multinomial distribution, for
+    all regions at once.
+
+    Parameters
+    ----------
+    sites : list of ints
+        Number of sites in each region.
+    tower_backhaul_lut : dict
+        Cumulative share of sites using fiber, copper and microwave
+        backhaul, as from `estimate_backhaul_type`. All other sites use
+        satellite backhaul.
+    seed : int
+        Seed of the random number generator, so draws are reproducible.
+
+    Returns
+    -------
+    counts : numpy array
+        Number of sites using each backhaul type (columns, in the order of
+        `BACKHAUL_TYPES`) in each region (rows).
+
+    """
+    cumulative = np.clip([
+        tower_backhaul_lut['fiber'],
+        tower_backhaul_lut['copper'],
+        tower_backhaul_lut['microwave'],
+        1,
+    ], 0, 1)
+
+    shares = np.diff(np.maximum.accumulate(cumulative), prepend=0)
+
+    rng = np.random.default_rng(seed)
+
+    return rng.multinomial(np.asarray(sites, dtype=np.int64), shares)
@@ -0,0 +1,67 @@
+"""
+Raster clipping shared by the preprocessing scripts.
+
+"""
+import rasterio
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+
+#Maximum number of pixels read (and written) at once when clipping.
+CHUNK_PIXELS = 2 ** 24
+
+
+def clip_raster(src, shapes, path_output, nodata, crs='epsg:4326'):
+    """
+    Clip a raster to a set of shapes and write the result to file.
+
+    The output matches `rasterio.mask.mask(src, shapes, crop=True)` with
+    `nodata` set on the source: only the window covering the shapes is
+    kept, and pixels outside the shapes are set to nodata. The window is
+    read and written in strips of rows, so the clipped raster is never
+    held in memory in full, and the source is only opened for reading.
+
+    Parameters
+    ----------
+    src : rasterio dataset
+        Open source raster, which can be reused for many clips.
+    shapes : list of dicts
+        GeoJSON-like geometries to clip to, in the crs of the source.
+    path_output : string
+        Path to write the clipped raster to.
+    nodata : int or float
+        Value of pixels outside the shapes, and the nodata value of the
+        output raster.
+    crs : string
+        Coordinate reference system of the output raster.
+
+    """
+    window = geometry_window(src, shapes)
+    height, width = int(window.height), int(window.width)
+
+    out_meta = src.meta.copy()
+
+    out_meta.update({"driver": "GTiff",
+                    "height": height,
+                    "width": width,
+                    "transform": src.window_transform(window),
+                    "crs": crs,
+                    "nodata": nodata})
+
+    rows = max(1, CHUNK_PIXELS // max(1, width))
+
+    with rasterio.open(path_output, "w", **out_meta) as dest:
+
+        for row_off in range(0, height, rows):
+
+            strip = Window(0, row_off, width, min(rows, height - row_off))
+
+            out_img = src.read(window=Window(window.col_off,
+                window.row_off + row_off, strip.width, strip.height))
+
+            outside = geometry_mask(shapes,
+                out_shape=(int(strip.height), width),
+                transform=dest.window_transform(strip))
+
+            out_img[:, outside] = nodata
+
+            dest.write(out_img, window=strip)
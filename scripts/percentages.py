@@ -11,89 +11,167 @@ import configparser
 import numpy as np
 import pandas as pd
 
+from write import RESULT_STORE, read_results
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
 
 RESULTS = os.path.join(BASE_PATH, '..', 'results', 'model_results')
 OUTPUT = os.path.join(BASE_PATH, '..', 'results', 'percentages')
+RESULT_FORMAT = CONFIG.get('run', 'result_format', fallback='csv')
+
+CAPACITIES = [
+    10,
+    30
+]
+
+COST_TYPES = [
+    'financial_cost',
+    'government_cost'
+]
 
 
 def process_percentages():
     """
+    Process the percentage differences for all capacities and cost types,
+    from national results read once.
 
     """
     if not os.path.exists(OUTPUT):
         os.makedirs(OUTPUT)
 
-    capacities = [
-        10,
-        30
-    ]
-
-    cost_types = [
-        'financial_cost',
-        'government_cost'
-    ]
+    data = load_national_results(COST_TYPES)
 
-    for capacity in capacities:
-        for cost_type in cost_types:
+    for capacity in CAPACITIES:
+        for cost_type in COST_TYPES:
 
             print('- {} GB per user ({})'.format(capacity, cost_type.split('_')[0]))
 
             #Processing PODIS data
-            process_technologies_data(capacity, cost_type)
+            process_technologies_data(capacity, cost_type, data)
 
             #Processing PODIS data
-            process_sharing_data(capacity, cost_type)
+            process_sharing_data(capacity, cost_type, data)
 
     return
 
 
-def process_technologies_data(capacity, cost_type):
+def load_national_results(cost_types=COST_TYPES):
     """
-    Process the technology results.
+    Load the mean, baseline input cost national market cost results.
+
+    Only the columns needed are read, from the Parquet result store (if
+    `result_format` is parquet) or otherwise from all national .csv
+    results, with other results dropped from each file as it is read.
+
+    Parameters
+    ----------
+    cost_types : list of strings
+        The cost types we wish to process.
+
+    Returns
+    -------
+    data : pandas df
+        National market cost results, with categorical scenario and
+        strategy columns.
+
+    """
+    columns = ['GID_0', 'scenario', 'strategy', 'confidence',
+        'input_cost'] + list(cost_types)
+
+    store = os.path.join(RESULTS, RESULT_STORE)
+
+    if RESULT_FORMAT == 'parquet':
+        data = read_results(
+            store,
+            'national_market_cost_results',
+            columns=columns,
+            filters=[('confidence', '=', 50), ('input_cost', '=', 'baseline')],
+        )
+
+    else:
+        data = []
+
+        path = os.path.join(RESULTS, 'national_results')
+
+        for filename in os.listdir(path):
+
+            # if not capacity in filename:
+            #     continue
+
+            if not 'national_market_cost_results' in filename:
+                continue
+
+            filepath = os.path.join(path, filename)
+
+            sample = pd.read_csv(filepath, usecols=columns)
+
+            #subset based on defined confidence (mean results)
+            sample = sample[(sample['confidence'] == 50) &
+                (sample['input_cost'] == 'baseline')]
+
+            data.append(sample[columns])
+
+        data = pd.concat(data, ignore_index=True)
+
+    for column in ['scenario', 'strategy']:
+        data[column] = data[column].astype('category')
+
+    return data
+
+
+def select_capacity(data, capacity):
+    """
+    Select the national results for a single capacity.
 
     Parameters
     ----------
+    data : pandas df
+        National results, from `load_national_results`.
     capacity : int
         The capacity we wish to process.
-    cost_type : string
-        The cost type we wish to process.
 
     Returns
     -------
     data : pandas df
-        All processed model results.
+        National results for the capacity, with scenario and strategy
+        labels as strings, ready to be relabelled.
 
     """
-    data = []
+    handle = '{}_{}_{}'.format(capacity, capacity, capacity)
+    data = data[data['scenario'].str.contains(handle)].reset_index(drop=True)
 
-    path = os.path.join(RESULTS, 'national_results')
+    for column in ['scenario', 'strategy']:
+        data[column] = data[column].astype(object)
 
-    for filename in os.listdir(path):
+    return data
 
-        # if not capacity in filename:
-        #     continue
 
-        if not 'national_market_cost_results' in filename:
-            continue
+def process_technologies_data(capacity, cost_type, data=None):
+    """
+    Process the technology results.
 
-        filepath = os.path.join(path, filename)
+    Parameters
+    ----------
+    capacity : int
+        The capacity we wish to process.
+    cost_type : string
+        The cost type we wish to process.
+    data : pandas df
+        National results, from `load_national_results` (read if not given).
 
-        sample = pd.read_csv(filepath)
-        sample = sample.to_dict('records')
-        data = data + sample
+    Returns
+    -------
+    data : pandas df
+        All processed model results.
 
-    data = pd.DataFrame(data)
+    """
+    if data is None:
+        data = load_national_results([cost_type])
 
     #subset based on defined capacity
-    handle = '{}_{}_{}'.format(capacity, capacity, capacity)
-    data = data[data['scenario'].str.contains(str(handle))].reset_index()
-
-    #subset based on defined confidence (mean results)
-    data = data.loc[data['confidence'] == 50]
-    data = data.loc[data['input_cost'] == 'baseline']
+    data = select_capacity(data, capacity)
 
     #relabel long strings
     scenario = 'low_{}_{}_{}'.format(capacity, capacity, capacity)
@@ -150,7 +228,7 @@ def process_technologies_data(capacity, cost_type):
     return
 
 
-def process_sharing_data(capacity, cost_type):
+def process_sharing_data(capacity, cost_type, data=None):
     """
     Process any infrastructure sharing strategies.
 
@@ -160,6 +238,8 @@ def process_sharing_data(capacity, cost_type):
         The capacity we wish to process.
     cost_type : string
         The cost type we wish to process.
+    data : pandas df
+        National results, from `load_national_results` (read if not given).
 
     Returns
     -------
@@ -167,33 +247,11 @@ def process_sharing_data(capacity, cost_type):
         All processed model results.
 
     """
-    data = []
-
-    path = os.path.join(RESULTS, 'national_results')
-
-    for filename in os.listdir(path):
-
-        # if not capacity in filename:
-        #     continue
-
-        if not 'national_market_cost_results' in filename:
-            continue
-
-        filepath = os.path.join(path, filename)
-
-        sample = pd.read_csv(filepath)
-        sample = sample.to_dict('records')
-        data = data + sample
-
-    data = pd.DataFrame(data)
+    if data is None:
+        data = load_national_results([cost_type])
 
     #subset based on defined capacity
-    handle = '{}_{}_{}'.format(capacity, capacity, capacity)
-    data = data[data['scenario'].str.contains(str(handle))].reset_index()
-
-    #subset based on defined confidence (mean results)
-    data = data.loc[data['confidence'] == 50]
-    data = data.loc[data['input_cost'] == 'baseline']
+    data = select_capacity(data, capacity)
 
     #relabel long strings
     scenario = 'low_{}_{}_{}'.format(capacity, capacity, capacity)
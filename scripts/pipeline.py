@@ -0,0 +1,413 @@
+"""
+Dependency-aware, cached running of preprocessing stages.
+
+Each stage is a dict declaring the function to call, its arguments, the
+parameters its outputs depend on and the files it reads and writes:
+
+    {
+        'name': 'SEN: prep2.process_regions',
+        'function': process_regions,
+        'args': (country,),
+        'params': {'iso3': 'SEN', 'regional_level': 2},
+        'inputs': [...],
+        'outputs': [...],
+        'optional': [...], #outputs which are not always written
+    }
+
+A stage depends on every other stage writing one of its inputs. Each
+stage is fingerprinted by its function, the code it runs, its parameters
+and the contents of its inputs, and is skipped when the fingerprint and its outputs match
+those recorded when it last ran. As the fingerprint covers the contents
+of the inputs, a stage which writes different outputs invalidates all
+stages downstream of it, including when its code is edited. Stages which do not depend on each other are
+run across a process pool.
+
+Each file is written by a single stage. Scripts which need files written
+by another script declare that script's stages for them (rather than
+stages of their own), and all scripts record stages in the same cache
+folder, so each file is only rebuilt when its own inputs change.
+
+"""
+import os
+import re
+import glob
+import json
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+def country_stage(function, country, inputs, outputs, params=(), optional=()):
+    """
+    Declare a stage which calls `function(country)`.
+
+    Parameters
+    ----------
+    function : function
+        The stage function, taking the country dict.
+    country : dict
+        Contains all country specfic information.
+    inputs : list of strings
+        Paths of the files read by the stage.
+    outputs : list of strings
+        Paths of the files written by the stage.
+    params : list of strings
+        The country keys the outputs depend on, besides `iso3`.
+    optional : list of strings
+        Outputs which are not always written.
+
+    Returns
+    -------
+    stage : dict
+        The stage, as described above.
+
+    """
+    return {
+        'name': '{}: {}'.format(country['iso3'], get_function_name(function)),
+        'function': function,
+        'args': (country,),
+        'params': {key: country[key] for key in ['iso3'] + list(params)},
+        'inputs': list(inputs),
+        'outputs': list(outputs),
+        'optional': list(optional),
+    }
+
+
+def run_stages(stages, cache_folder, workers=1):
+    """
+    Run all stages which are out of date, once their upstream stages have
+    completed.
+
+    Parameters
+    ----------
+    stages : list of dicts
+        All stages, as described above, with unique names.
+    cache_folder : string
+        Folder holding the fingerprints recorded for each stage.
+    workers : int
+        Number of stages to run at once.
+
+    """
+    writers = {}
+    for stage in stages:
+        for path in stage['outputs']:
+            writers[os.path.normpath(path)] = stage['name']
+
+    upstream = {}
+    for stage in stages:
+        upstream[stage['name']] = set(
+            writers[os.path.normpath(path)] for path in stage['inputs']
+            if os.path.normpath(path) in writers
+        ) - {stage['name']}
+
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+
+    hashes = load_json(os.path.join(cache_folder, 'hashes.json'))
+
+    pending = {stage['name']: stage for stage in stages}
+    complete = set()
+    running = {}
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    try:
+        while pending or running:
+
+            ready = get_ready_stages(pending, upstream, complete)
+
+            while ready:
+                for stage in ready:
+                    fingerprint = prepare_stage(stage, cache_folder, hashes)
+                    if fingerprint is None:
+                        complete.add(stage['name'])
+                    elif executor is None:
+                        stage['function'](*stage['args'])
+                        record_stage(stage, fingerprint, cache_folder, hashes)
+                        complete.add(stage['name'])
+                    else:
+                        future = executor.submit(stage['function'], *stage['args'])
+                        running[future] = (stage, fingerprint)
+                ready = get_ready_stages(pending, upstream, complete)
+
+            if not running:
+                if pending:
+                    raise ValueError('Stages depend on each other: {}'.format(
+                        ', '.join(pending)))
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                stage, fingerprint = running.pop(future)
+                #errors in a stage are raised here
+                future.result()
+                record_stage(stage, fingerprint, cache_folder, hashes)
+                complete.add(stage['name'])
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        save_json(os.path.join(cache_folder, 'hashes.json'), hashes)
+
+
+def get_ready_stages(pending, upstream, complete):
+    """
+    Remove and return the pending stages whose upstream stages have all
+    completed.
+
+    """
+    ready = [stage for name, stage in pending.items()
+        if upstream[name] <= complete]
+
+    for stage in ready:
+        del pending[stage['name']]
+
+    return ready
+
+
+def prepare_stage(stage, cache_folder, hashes):
+    """
+    Check whether a stage needs to run, and if so remove its old outputs.
+
+    A stage is up to date when its fingerprint matches the one recorded
+    when it last ran, all of its required outputs exist, and its outputs
+    are unchanged since then.
+
+    Returns
+    -------
+    fingerprint : string
+        Fingerprint of the stage, or None if the stage is up to date.
+
+    """
+    fingerprint = get_fingerprint(stage, hashes)
+
+    record = load_json(get_record_path(stage, cache_folder))
+
+    optional = set(stage.get('optional', []))
+    missing = [path for path in stage['outputs']
+        if not os.path.exists(path) and path not in optional]
+
+    if (record.get('fingerprint') == fingerprint and not missing and
+        record.get('outputs') == get_hashes(stage['outputs'], hashes)):
+        print('Skipping {} (up to date)'.format(stage['name']))
+        return None
+
+    #stages skip work when their outputs exist, so stale outputs are removed
+    for path in stage['outputs']:
+        if os.path.exists(path):
+            remove_output(path)
+
+    print('Running {}'.format(stage['name']))
+
+    return fingerprint
+
+
+def record_stage(stage, fingerprint, cache_folder, hashes):
+    """
+    Record the fingerprint and outputs of a stage which has run.
+
+    """
+    save_json(get_record_path(stage, cache_folder), {
+        'fingerprint': fingerprint,
+        'outputs': get_hashes(stage['outputs'], hashes),
+    })
+
+
+def get_record_path(stage, cache_folder):
+    """
+    Path of the record for a stage, named after the stage.
+
+    """
+    filename = re.sub(r'[^A-Za-z0-9_.-]+', '_', stage['name']) + '.json'
+
+    return os.path.join(cache_folder, filename)
+
+
+def get_fingerprint(stage, hashes):
+    """
+    Hash the function, code, parameters and input contents of a stage.
+
+    """
+    key = json.dumps({
+        'function': get_function_name(stage['function']),
+        'code': get_code(stage['function']),
+        'params': stage.get('params', {}),
+        'inputs': get_hashes(stage['inputs'], hashes),
+    }, sort_keys=True, default=str)
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_function_name(function):
+    """
+    Name a stage function after the script defining it, which is the same
+    whether the script is run directly or imported by another script.
+
+    """
+    script = os.path.splitext(os.path.basename(inspect.getfile(function)))[0]
+
+    return '{}.{}'.format(script, function.__name__)
+
+
+def get_code(function):
+    """
+    Get the source of a stage function and of every function it calls,
+    directly or through other functions, which is defined in the same
+    folder of scripts (such as helpers imported from spatial.py), with
+    the values of the module constants they use.
+
+    Returns
+    -------
+    code : dict
+        Source of each function and value of each constant, by name.
+
+    """
+    folder = os.path.dirname(os.path.abspath(inspect.getfile(function)))
+
+    code = {}
+    functions = [function]
+
+    while functions:
+        function = functions.pop()
+        name = get_function_name(function)
+
+        if name in code:
+            continue
+
+        code[name] = inspect.getsource(function)
+
+        script = name.rsplit('.', 1)[0]
+        names = get_names(function.__code__)
+
+        for key in names:
+
+            if not key in function.__globals__:
+                continue
+
+            value = function.__globals__[key]
+
+            if inspect.ismodule(value):
+                #attributes of scripts used as modules (e.g. spatial.f)
+                if not is_in_folder(value, folder):
+                    continue
+                values = [('{}.{}'.format(key, attr), getattr(value, attr))
+                    for attr in names if hasattr(value, attr)]
+            else:
+                values = [(key, value)]
+
+            for key, value in values:
+                if inspect.isfunction(value) and is_in_folder(value, folder):
+                    functions.append(value)
+                elif isinstance(value, (bool, int, float, str)):
+                    code['{}.{}'.format(script, key)] = repr(value)
+
+    return code
+
+
+def get_names(code):
+    """
+    Get the global names used by a code object, including those used by
+    nested code such as comprehensions and lambdas.
+
+    """
+    names = list(code.co_names)
+
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names += get_names(const)
+
+    return names
+
+
+def is_in_folder(value, folder):
+    """
+    Check whether a function or module is defined in a file in `folder`.
+
+    """
+    try:
+        filename = inspect.getfile(value)
+    except TypeError:
+        #built-in
+        return False
+
+    return os.path.dirname(os.path.abspath(filename)) == folder
+
+
+def get_hashes(paths, hashes):
+    """
+    Hash the contents of each file, with None for missing files.
+
+    """
+    return {os.path.normpath(path): hash_file(path, hashes) for path in paths}
+
+
+def hash_file(path, hashes):
+    """
+    Hash the contents of a file, including the sidecar files of a shapefile.
+
+    Hashes are reused while the size and modification time of the files
+    are unchanged, so large rasters are only read when they change.
+
+    """
+    if not os.path.exists(path):
+        return None
+
+    files = get_files(path)
+
+    stats = [[os.path.basename(filename), os.path.getsize(filename),
+        os.stat(filename).st_mtime_ns] for filename in files]
+
+    key = os.path.abspath(path)
+
+    if key in hashes and hashes[key]['stats'] == stats:
+        return hashes[key]['hash']
+
+    digest = hashlib.sha256()
+
+    for filename in files:
+        digest.update(os.path.basename(filename).encode('utf-8'))
+        with open(filename, 'rb') as source:
+            for block in iter(lambda: source.read(2 ** 20), b''):
+                digest.update(block)
+
+    hashes[key] = {'stats': stats, 'hash': digest.hexdigest()}
+
+    return hashes[key]['hash']
+
+
+def get_files(path):
+    """
+    Get a file, or all files making up a shapefile.
+
+    """
+    root, ext = os.path.splitext(path)
+
+    if ext == '.shp':
+        return sorted(glob.glob(glob.escape(root) + '.*'))
+
+    return [path]
+
+
+def remove_output(path):
+    """
+    Remove an output file, including the sidecar files of a shapefile.
+
+    """
+    for filename in get_files(path):
+        os.remove(filename)
+
+
+def load_json(path):
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as source:
+        return json.load(source)
+
+
+def save_json(path, data):
+
+    with open(path, 'w') as sink:
+        json.dump(data, sink)
@@ -19,7 +19,6 @@ import pyproj
 # import fiona
 # from fiona.crs import from_epsg
 import rasterio
-from rasterio.mask import mask
 from rasterstats import zonal_stats
 # import random
 # import networkx as nx
@@ -27,6 +26,11 @@ from rasterstats import zonal_stats
 # import numpy as np
 # import math
 
+from clip import clip_raster
+from pipeline import country_stage, run_stages
+from prep2 import get_layer_stages
+from spatial import assign_agglomerations, exclude_small_shapes
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
@@ -35,6 +39,8 @@ DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 
+STAGE_WORKERS = CONFIG.getint('prep', 'stage_workers', fallback=1)
+
 
 def find_country_list(continent_list):
     """
@@ -102,7 +108,7 @@ def process_country_shapes(country):
         return 'Completed national outline processing'
 
     if not os.path.exists(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
 
     shape_path = os.path.join(path, 'national_outline.shp')
 
@@ -114,8 +120,7 @@ def process_country_shapes(country):
     single_country = countries[countries.GID_0 == iso3]
 
     # print('Excluding small shapes')
-    single_country['geometry'] = single_country.apply(
-        exclude_small_shapes, axis=1)
+    single_country['geometry'] = exclude_small_shapes(single_country)
 
     # print('Adding ISO country code and other global information')
     glob_info_path = os.path.join(BASE_PATH, 'global_information.csv')
@@ -157,7 +162,7 @@ def process_regions(country):
         print('Working on {} level {}'.format(iso3, regional_level))
 
         if not os.path.exists(folder):
-            os.mkdir(folder)
+            os.makedirs(folder)
 
         filename = 'gadm36_{}.shp'.format(regional_level)
         path_regions = os.path.join(DATA_RAW, 'gadm36_levels_shp', filename)
@@ -167,7 +172,7 @@ def process_regions(country):
         regions = regions[regions.GID_0 == iso3]
 
         print('Excluding small shapes')
-        regions['geometry'] = regions.apply(exclude_small_shapes, axis=1)
+        regions['geometry'] = exclude_small_shapes(regions)
 
         try:
             print('Writing global_regions.shp to file')
@@ -198,10 +203,6 @@ def process_settlement_layer(country):
     path_settlements = os.path.join(DATA_RAW,'settlement_layer',
         'ppp_2020_1km_Aggregated.tif')
 
-    settlements = rasterio.open(path_settlements, 'r+')
-    settlements.nodata = 255
-    settlements.crs = {"init": "epsg:4326"}
-
     iso3 = country['iso3']
     path_country = os.path.join(DATA_INTERMEDIATE, iso3,
         'national_outline.shp')
@@ -227,18 +228,8 @@ def process_settlement_layer(country):
 
     coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-    out_img, out_transform = mask(settlements, coords, crop=True)
-
-    out_meta = settlements.meta.copy()
-
-    out_meta.update({"driver": "GTiff",
-                    "height": out_img.shape[1],
-                    "width": out_img.shape[2],
-                    "transform": out_transform,
-                    "crs": 'epsg:4326'})
-
-    with rasterio.open(shape_path, "w", **out_meta) as dest:
-            dest.write(out_img)
+    with rasterio.open(path_settlements) as settlements:
+        clip_raster(settlements, coords, shape_path, nodata=255)
 
     return print('Completed processing of settlement layer')
 
@@ -273,10 +264,6 @@ def process_under_10_layers(country):
         if os.path.exists(path_out):
             continue
 
-        settlements = rasterio.open(path, 'r+')
-        settlements.nodata = 255
-        settlements.crs = {"init": "epsg:4326"}
-
         filename = 'national_outline.shp'
         path_country = os.path.join(DATA_INTERMEDIATE, iso3, filename)
 
@@ -294,20 +281,8 @@ def process_under_10_layers(country):
 
         coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-        #chop on coords
-        out_img, out_transform = mask(settlements, coords, crop=True)
-
-        # Copy the metadata
-        out_meta = settlements.meta.copy()
-
-        out_meta.update({"driver": "GTiff",
-                        "height": out_img.shape[1],
-                        "width": out_img.shape[2],
-                        "transform": out_transform,
-                        "crs": 'epsg:4326'})
-
-        with rasterio.open(path_out, "w", **out_meta) as dest:
-                dest.write(out_img)
+        with rasterio.open(path) as settlements:
+            clip_raster(settlements, coords, path_out, nodata=255)
 
     return print('Completed processing of settlement layer')
 
@@ -442,94 +417,6 @@ def area_of_polygon(geom):
     return abs(poly_area)
 
 
-def exclude_small_shapes(x):
-    """
-    Remove small multipolygon shapes.
-
-    Parameters
-    ---------
-    x : polygon
-        Feature to simplify.
-
-    Returns
-    -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
-
-    """
-    # if its a single polygon, just return the polygon geometry
-    if x.geometry.geom_type == 'Polygon':
-        return x.geometry
-
-    # if its a multipolygon, we start trying to simplify
-    # and remove shapes if its too big.
-    elif x.geometry.geom_type == 'MultiPolygon':
-
-        area1 = 0.01
-        area2 = 50
-
-        # dont remove shapes if total area is already very small
-        if x.geometry.area < area1:
-            return x.geometry
-        # remove bigger shapes if country is really big
-
-        if x['GID_0'] in ['CHL','IDN']:
-            threshold = 0.01
-        elif x['GID_0'] in ['RUS','GRL','CAN','USA']:
-            threshold = 0.01
-
-        elif x.geometry.area > area2:
-            threshold = 0.1
-        else:
-            threshold = 0.001
-
-        # save remaining polygons as new multipolygon for
-        # the specific country
-        new_geom = []
-        for y in x.geometry:
-            if y.area > threshold:
-                new_geom.append(y)
-
-        return MultiPolygon(new_geom)
-
-
-def clean_coverage(x):
-    """
-    Cleans the coverage polygons by remove small multipolygon shapes.
-
-    Parameters
-    ---------
-    x : polygon
-        Feature to simplify.
-
-    Returns
-    -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
-
-    """
-    # if its a single polygon, just return the polygon geometry
-    if x.geometry.geom_type == 'Polygon':
-        if x.geometry.area > 1e7:
-            return x.geometry
-
-    # if its a multipolygon, we start trying to simplify and
-    # remove shapes if its too big.
-    elif x.geometry.geom_type == 'MultiPolygon':
-
-        threshold = 1e7
-
-        # save remaining polygons as new multipolygon for
-        # the specific country
-        new_geom = []
-        for y in x.geometry:
-
-            if y.area > threshold:
-                new_geom.append(y)
-
-        return MultiPolygon(new_geom)
-
-
 def estimate_core_nodes(iso3, pop_density_km2, settlement_size):
     """
     This function identifies settlements which exceed a desired settlement
@@ -646,37 +533,24 @@ def generate_agglomeration_lut(country):
     regions = gpd.read_file(path, crs="epsg:4326")
 
     path_settlements = os.path.join(DATA_INTERMEDIATE, iso3, 'settlements.tif')
-    settlements = rasterio.open(path_settlements, 'r+')
-    settlements.nodata = 255
-    settlements.crs = {"init": "epsg:4326"}
 
     folder_tifs = os.path.join(DATA_INTERMEDIATE, iso3, 'agglomerations', 'tifs')
     if not os.path.exists(folder_tifs):
         os.makedirs(folder_tifs)
 
-    for idx, region in regions.iterrows():
-
-        bbox = region['geometry'].envelope
-        geo = gpd.GeoDataFrame()
-        geo = gpd.GeoDataFrame({'geometry': bbox}, index=[idx])
-        coords = [json.loads(geo.to_json())['features'][0]['geometry']]
-
-        #chop on coords
-        out_img, out_transform = mask(settlements, coords, crop=True)
+    #one handle on the settlement layer is used for all regions
+    with rasterio.open(path_settlements) as settlements:
 
-        # Copy the metadata
-        out_meta = settlements.meta.copy()
+        for idx, region in regions.iterrows():
 
-        out_meta.update({"driver": "GTiff",
-                        "height": out_img.shape[1],
-                        "width": out_img.shape[2],
-                        "transform": out_transform,
-                        "crs": 'epsg:4326'})
+            bbox = region['geometry'].envelope
+            geo = gpd.GeoDataFrame()
+            geo = gpd.GeoDataFrame({'geometry': bbox}, index=[idx])
+            coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-        path_output = os.path.join(folder_tifs, region[GID_level] + '.tif')
+            path_output = os.path.join(folder_tifs, region[GID_level] + '.tif')
 
-        with rasterio.open(path_output, "w", **out_meta) as dest:
-                dest.write(out_img)
+            clip_raster(settlements, coords, path_output, nodata=255)
 
     print('Completed settlement.tif regional segmentation')
 
@@ -692,35 +566,8 @@ def generate_agglomeration_lut(country):
     nodes = pd.concat([nodes, bool_list], axis=1)
     nodes = nodes[nodes[0] == True].drop(columns=0)
 
-    agglomerations = []
-
     print('Identifying agglomerations')
-    for idx1, region in regions.iterrows():
-        seen = set()
-        for idx2, node in nodes.iterrows():
-            if node['geometry'].intersects(region['geometry']):
-                agglomerations.append({
-                    'type': 'Feature',
-                    'geometry': mapping(node['geometry']),
-                    'properties': {
-                        'id': idx1,
-                        'GID_0': region['GID_0'],
-                        GID_level: region[GID_level],
-                        'population': node['sum'],
-                    }
-                })
-                seen.add(region[GID_level])
-        if len(seen) == 0:
-            agglomerations.append({
-                    'type': 'Feature',
-                    'geometry': mapping(region['geometry'].centroid),
-                    'properties': {
-                        'id': 'regional_node',
-                        'GID_0': region['GID_0'],
-                        GID_level: region[GID_level],
-                        'population': 1,
-                    }
-                })
+    agglomerations = assign_agglomerations(regions, nodes, GID_level)
 
     agglomerations = gpd.GeoDataFrame.from_features(
             [
@@ -864,33 +711,55 @@ def find_nodes_on_existing_infrastructure(country):
     return print('Found nodes on existing infrastructure')
 
 
-if __name__ == '__main__':
+def get_stages(country):
+    """
+    Declare the preprocessing stages for a country, with the files each
+    stage reads and writes and the country parameters each depends on,
+    for `pipeline.run_stages`.
 
-    countries = find_country_list(['Africa'])
-    countries = countries#[::-1]
+    Parameters
+    ----------
+    country : dict
+        Contains all country specfic information.
 
-    for country in countries:#[:1]:
+    Returns
+    -------
+    stages : list of dicts
+        All stages for the country.
 
-        # if not country['iso3'] == 'COD':
-        #     continue
+    """
+    iso3 = country['iso3']
+    level = country['regional_level']
 
-        print('----')
-        print('-- Working on {}'.format(country['country_name']))
+    folder = os.path.join(DATA_INTERMEDIATE, iso3)
+    national_outline = os.path.join(folder, 'national_outline.shp')
+    regions = os.path.join(folder, 'regions', 'regions_{}_{}.shp'.format(level, iso3))
+    settlements = os.path.join(folder, 'settlements.tif')
+
+    #the boundaries and settlement layers are written by the prep2.py stages
+    layers = get_layer_stages(country)
+
+    under_10 = layers['under_10'][0]['outputs']
 
-        print('Processing country boundary')
-        process_country_shapes(country)
+    return (layers['national_outline'] + layers['regions'] +
+        layers['settlements'] + layers['under_10'] + [
+        country_stage(get_regional_data, country,
+            [national_outline, regions, settlements] + under_10,
+            [os.path.join(folder, 'regional_data_uba.csv')],
+            ['regional_level']),
+    ])
 
-        print('Processing regions')
-        process_regions(country)
 
-        print('Processing settlement layers')
-        process_settlement_layer(country)
+if __name__ == '__main__':
+
+    countries = find_country_list(['Africa'])
+    countries = countries#[::-1]
 
-        print('Processing settlement layers for those under 10 years')
-        process_under_10_layers(country)
+    #stages are skipped when their inputs and parameters are unchanged
+    stages = [stage for country in countries for stage in get_stages(country)]
 
-        print('Getting regional data')
-        get_regional_data(country)
+    run_stages(stages, os.path.join(DATA_INTERMEDIATE, 'cache'),
+        STAGE_WORKERS)
 
     all_regional_data = []
 
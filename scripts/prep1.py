@@ -16,6 +16,10 @@ import numpy as np
 from shapely.geometry import MultiPolygon
 from shapely.ops import transform, unary_union
 
+from pipeline import get_function_name, run_stages
+from prep2 import get_layer_stages
+from spatial import clean_coverage, exclude_small_shapes
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
@@ -24,6 +28,8 @@ DATA_RAW = os.path.join(BASE_PATH, 'raw', 'real_site_data')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 
+STAGE_WORKERS = CONFIG.getint('prep', 'stage_workers', fallback=1)
+
 
 def process_country_shape(country):
     """
@@ -43,7 +49,7 @@ def process_country_shape(country):
         return 'Completed national outline processing'
 
     if not os.path.exists(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
 
     shape_path = os.path.join(path, 'national_outline.shp')
 
@@ -52,8 +58,7 @@ def process_country_shape(country):
 
     single_country = countries[countries.GID_0 == iso3]
 
-    single_country['geometry'] = single_country.apply(
-        exclude_small_shapes, axis=1)
+    single_country['geometry'] = exclude_small_shapes(single_country)
 
     glob_info_path = os.path.join(BASE_PATH, 'global_information.csv')
     load_glob_info = pd.read_csv(glob_info_path, encoding = "ISO-8859-1")
@@ -91,7 +96,7 @@ def process_regions(country):
             continue
 
         if not os.path.exists(folder):
-            os.mkdir(folder)
+            os.makedirs(folder)
 
         filename = 'gadm36_{}.shp'.format(regional_level)
         path_regions = os.path.join(DATA_RAW, '..',  'gadm36_levels_shp', filename)
@@ -99,7 +104,7 @@ def process_regions(country):
 
         regions = regions[regions.GID_0 == iso3]
 
-        regions['geometry'] = regions.apply(exclude_small_shapes, axis=1)
+        regions['geometry'] = exclude_small_shapes(regions)
 
         try:
             regions.to_file(path_processed, driver='ESRI Shapefile')
@@ -112,57 +117,6 @@ def process_regions(country):
     return
 
 
-def exclude_small_shapes(x):
-    """
-    Remove small multipolygon shapes.
-
-    Parameters
-    ---------
-    x : polygon
-        Feature to simplify.
-
-    Returns
-    -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
-
-    """
-    # if its a single polygon, just return the polygon geometry
-    if x.geometry.geom_type == 'Polygon':
-        return x.geometry
-
-    # if its a multipolygon, we start trying to simplify
-    # and remove shapes if its too big.
-    elif x.geometry.geom_type == 'MultiPolygon':
-
-        area1 = 0.01
-        area2 = 50
-
-        # dont remove shapes if total area is already very small
-        if x.geometry.area < area1:
-            return x.geometry
-        # remove bigger shapes if country is really big
-
-        if x['GID_0'] in ['CHL','IDN']:
-            threshold = 0.01
-        elif x['GID_0'] in ['RUS','GRL','CAN','USA']:
-            threshold = 0.01
-
-        elif x.geometry.area > area2:
-            threshold = 0.1
-        else:
-            threshold = 0.001
-
-        # save remaining polygons as new multipolygon for
-        # the specific country
-        new_geom = []
-        for y in x.geometry:
-            if y.area > threshold:
-                new_geom.append(y)
-
-        return MultiPolygon(new_geom)
-
-
 def process_coverage_shapes(country):
     """
     Load in coverage maps, process and export for each country.
@@ -226,7 +180,7 @@ def process_coverage_shapes(country):
             coverage = coverage.to_crs({'init': 'epsg:3857'})
 
             print('Excluding small shapes')
-            coverage['geometry'] = coverage.apply(clean_coverage,axis=1)
+            coverage['geometry'] = clean_coverage(coverage)
 
             print('Removing empty and null geometries')
             coverage = coverage[~(coverage['geometry'].is_empty)]
@@ -250,43 +204,6 @@ def process_coverage_shapes(country):
     print('Processed coverage shapes')
 
 
-def clean_coverage(x):
-    """
-    Cleans the coverage polygons by remove small multipolygon shapes.
-
-    Parameters
-    ---------
-    x : polygon
-        Feature to simplify.
-
-    Returns
-    -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
-
-    """
-    # if its a single polygon, just return the polygon geometry
-    if x.geometry.geom_type == 'Polygon':
-        if x.geometry.area > 1e7:
-            return x.geometry
-
-    # if its a multipolygon, we start trying to simplify and
-    # remove shapes if its too big.
-    elif x.geometry.geom_type == 'MultiPolygon':
-
-        threshold = 1e7
-
-        # save remaining polygons as new multipolygon for
-        # the specific country
-        new_geom = []
-        for y in x.geometry:
-
-            if y.area > threshold:
-                new_geom.append(y)
-
-        return MultiPolygon(new_geom)
-
-
 def load_regions(path):
     """
     Load in regions.
@@ -434,6 +351,53 @@ def load_senegal(path, regions, folder):
     return
 
 
+def get_stages(country):
+    """
+    Declare the preprocessing stages for a country, with the files each
+    stage reads and writes and the country parameters each depends on,
+    for `pipeline.run_stages`.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all country specfic information.
+
+    Returns
+    -------
+    stages : list of dicts
+        All stages for the country.
+
+    """
+    iso3 = country['iso3']
+
+    folder = os.path.join(DATA_INTERMEDIATE, iso3)
+
+    #the boundaries and coverage are written by the prep2.py stages
+    layers = get_layer_stages(country)
+
+    stages = layers['national_outline'] + layers['regions'] + layers['coverage']
+
+    site_data = {
+        'KEN': (process_kenya, 'Operators_Mobile_Transmitters_Data.csv'),
+        'SEN': (process_senegal, 'Bilan_Couverture_Orange_Dec2017.csv'),
+    }
+
+    if iso3 in site_data:
+        function, filename = site_data[iso3]
+        stages.append({
+            'name': '{}: {}'.format(iso3, get_function_name(function)),
+            'function': function,
+            'args': (),
+            'params': {},
+            'inputs': [os.path.join(folder, 'regions', 'regions_2_{}.shp'.format(iso3)),
+                os.path.join(DATA_RAW, iso3, filename)],
+            'outputs': [os.path.join(folder, 'sites', 'sites.shp'),
+                os.path.join(folder, 'sites', 'sites.csv')],
+        })
+
+    return stages
+
+
 if __name__ == "__main__":
 
     countries = [
@@ -441,19 +405,8 @@ if __name__ == "__main__":
         {'iso3': 'SEN', 'iso2': 'SN', 'regional_level': 2},
     ]
 
-    for country in countries:
-
-        print('Processing country boundary')
-        process_country_shape(country)
-
-        print('Processing regions')
-        process_regions(country)
-
-        print('Processing coverage shapes')
-        process_coverage_shapes(country)
-
-        if country['iso3'] == 'KEN':
-            process_kenya()
+    #stages are skipped when their inputs and parameters are unchanged
+    stages = [stage for country in countries for stage in get_stages(country)]
 
-        if country['iso3'] == 'SEN':
-            process_senegal()
+    run_stages(stages, os.path.join(DATA_INTERMEDIATE, 'cache'),
+        STAGE_WORKERS)
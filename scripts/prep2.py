@@ -20,12 +20,18 @@ from shapely.ops import transform, unary_union, nearest_points
 import fiona
 from fiona.crs import from_epsg
 import rasterio
-from rasterio.mask import mask
 from rasterstats import zonal_stats
 import networkx as nx
 from rtree import index
 import numpy as np
-import random
+from concurrent.futures import ProcessPoolExecutor
+
+from backhaul import sample_backhaul_types
+from clip import clip_raster
+from spatial import (EQUAL_AREA_CRS, assign_agglomerations, clean_coverage,
+    count_points_by_region, exclude_small_shapes, minimum_spanning_edges,
+    overlay_areas)
+from pipeline import country_stage, get_function_name, run_stages
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
@@ -35,6 +41,10 @@ DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 
+WORKERS = CONFIG.getint('prep', 'workers', fallback=1)
+STAGE_WORKERS = CONFIG.getint('prep', 'stage_workers', fallback=1)
+SEED = CONFIG.getint('prep', 'seed', fallback=42)
+
 
 def process_country_shapes(country):
     """
@@ -57,7 +67,7 @@ def process_country_shapes(country):
 
     if not os.path.exists(path):
         print('Creating directory {}'.format(path))
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
     shape_path = os.path.join(path, 'national_outline.shp')
 
     print('Loading all country shapes')
@@ -68,12 +78,11 @@ def process_country_shapes(country):
     single_country = countries[countries.GID_0 == iso3]
 
     print('Excluding small shapes')
-    single_country['geometry'] = single_country.apply(
-        exclude_small_shapes, axis=1)
+    single_country['geometry'] = exclude_small_shapes(single_country)
 
     print('Adding ISO country code and other global information')
     glob_info_path = os.path.join(BASE_PATH, 'global_information.csv')
-    load_glob_info = pd.read_csv(glob_info_path, encoding = "ISO-8859-1")
+    load_glob_info = pd.read_csv(glob_info_path, encoding = "ISO-8859-1", keep_default_na=False)
     single_country = single_country.merge(
         load_glob_info,left_on='GID_0', right_on='ISO_3digit')
 
@@ -94,46 +103,60 @@ def process_regions(country):
         Three digit ISO country code.
 
     """
-    regions = []
-
-    iso3 = country['iso3']
     level = country['regional_level']
 
     for regional_level in range(1, level + 1):
+        process_regional_level(country, regional_level)
 
-        filename = 'regions_{}_{}.shp'.format(regional_level, iso3)
-        folder = os.path.join(DATA_INTERMEDIATE, iso3, 'regions')
-        path_processed = os.path.join(folder, filename)
+    print('Completed processing of regional shapes level {}'.format(level))
 
-        if os.path.exists(path_processed):
-            continue
+    return print('complete')
 
-        print('----')
-        print('Working on {} level {}'.format(iso3, regional_level))
 
-        if not os.path.exists(folder):
-            os.mkdir(folder)
+def process_regional_level(country, regional_level):
+    """
+    Process the subnational regions of a single level for the chosen
+    country.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all country specfic information.
+    regional_level : int
+        The level of the regions (e.g. 2 for GID_2).
 
-        filename = 'gadm36_{}.shp'.format(regional_level)
-        path_regions = os.path.join(DATA_RAW, 'gadm36_levels_shp', filename)
-        regions = gpd.read_file(path_regions)
+    """
+    iso3 = country['iso3']
 
-        print('Subsetting {} level {}'.format(iso3, regional_level))
-        regions = regions[regions.GID_0 == iso3]
+    filename = 'regions_{}_{}.shp'.format(regional_level, iso3)
+    folder = os.path.join(DATA_INTERMEDIATE, iso3, 'regions')
+    path_processed = os.path.join(folder, filename)
 
-        print('Excluding small shapes')
-        regions['geometry'] = regions.apply(exclude_small_shapes, axis=1)
+    if os.path.exists(path_processed):
+        return
 
-        try:
-            print('Writing global_regions.shp to file')
-            regions.to_file(path_processed, driver='ESRI Shapefile')
-        except:
-            print('Unable to write {}'.format(filename))
-            pass
+    print('----')
+    print('Working on {} level {}'.format(iso3, regional_level))
 
-    print('Completed processing of regional shapes level {}'.format(level))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
 
-    return print('complete')
+    filename = 'gadm36_{}.shp'.format(regional_level)
+    path_regions = os.path.join(DATA_RAW, 'gadm36_levels_shp', filename)
+    regions = gpd.read_file(path_regions)
+
+    print('Subsetting {} level {}'.format(iso3, regional_level))
+    regions = regions[regions.GID_0 == iso3]
+
+    print('Excluding small shapes')
+    regions['geometry'] = exclude_small_shapes(regions)
+
+    try:
+        print('Writing global_regions.shp to file')
+        regions.to_file(path_processed, driver='ESRI Shapefile')
+    except:
+        print('Unable to write {}'.format(filename))
+        pass
 
 
 def process_settlement_layer(country):
@@ -153,10 +176,6 @@ def process_settlement_layer(country):
     path_settlements = os.path.join(DATA_RAW,'settlement_layer',
         'ppp_2020_1km_Aggregated.tif')
 
-    settlements = rasterio.open(path_settlements, 'r+')
-    settlements.nodata = 255
-    settlements.crs = {"init": "epsg:4326"}
-
     iso3 = country['iso3']
     path_country = os.path.join(DATA_INTERMEDIATE, iso3,
         'national_outline.shp')
@@ -182,18 +201,8 @@ def process_settlement_layer(country):
 
     coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-    out_img, out_transform = mask(settlements, coords, crop=True)
-
-    out_meta = settlements.meta.copy()
-
-    out_meta.update({"driver": "GTiff",
-                    "height": out_img.shape[1],
-                    "width": out_img.shape[2],
-                    "transform": out_transform,
-                    "crs": 'epsg:4326'})
-
-    with rasterio.open(shape_path, "w", **out_meta) as dest:
-            dest.write(out_img)
+    with rasterio.open(path_settlements) as settlements:
+        clip_raster(settlements, coords, shape_path, nodata=255)
 
     return print('Completed processing of settlement layer')
 
@@ -228,10 +237,6 @@ def process_under_10_layers(country):
         if os.path.exists(path_out):
             continue
 
-        settlements = rasterio.open(path, 'r+')
-        settlements.nodata = 255
-        settlements.crs = {"init": "epsg:4326"}
-
         filename = 'national_outline.shp'
         path_country = os.path.join(DATA_INTERMEDIATE, iso3, filename)
 
@@ -249,20 +254,8 @@ def process_under_10_layers(country):
 
         coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-        #chop on coords
-        out_img, out_transform = mask(settlements, coords, crop=True)
-
-        # Copy the metadata
-        out_meta = settlements.meta.copy()
-
-        out_meta.update({"driver": "GTiff",
-                        "height": out_img.shape[1],
-                        "width": out_img.shape[2],
-                        "transform": out_transform,
-                        "crs": 'epsg:4326'})
-
-        with rasterio.open(path_out, "w", **out_meta) as dest:
-                dest.write(out_img)
+        with rasterio.open(path) as settlements:
+            clip_raster(settlements, coords, path_out, nodata=255)
 
     return print('Completed processing of settlement layer')
 
@@ -304,21 +297,8 @@ def process_night_lights(country):
 
     coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-    night_lights = rasterio.open(path_night_lights, "r+")
-    night_lights.nodata = 0
-
-    out_img, out_transform = mask(night_lights, coords, crop=True)
-
-    out_meta = night_lights.meta.copy()
-
-    out_meta.update({"driver": "GTiff",
-                    "height": out_img.shape[1],
-                    "width": out_img.shape[2],
-                    "transform": out_transform,
-                    "crs": 'epsg:4326'})
-
-    with rasterio.open(path_output, "w", **out_meta) as dest:
-            dest.write(out_img)
+    with rasterio.open(path_night_lights) as night_lights:
+        clip_raster(night_lights, coords, path_output, nodata=0)
 
     return print('Completed processing of night lights layer')
 
@@ -386,7 +366,7 @@ def process_coverage_shapes(country):
             coverage = coverage.to_crs({'init': 'epsg:3857'})
 
             print('Excluding small shapes')
-            coverage['geometry'] = coverage.apply(clean_coverage,axis=1)
+            coverage['geometry'] = clean_coverage(coverage)
 
             print('Removing empty and null geometries')
             coverage = coverage[~(coverage['geometry'].is_empty)]
@@ -415,6 +395,10 @@ def process_regional_coverage(country):
     This functions estimates the area covered by each cellular
     technology.
 
+    The coverage of all technologies is overlaid on the regions together,
+    with technologies processed in parallel when more than one worker is
+    set.
+
     Parameters
     ----------
     country : dict
@@ -436,13 +420,16 @@ def process_regional_coverage(country):
     path = os.path.join(folder, filename)
     regions = gpd.read_file(path)
 
+    #regions are projected once for all technologies
+    regions = regions[[gid_level, 'geometry']].to_crs(EQUAL_AREA_CRS)
+
     technologies = [
         'GSM',
         '3G',
         '4G'
     ]
 
-    output = {}
+    tasks = []
 
     for tech in technologies:
 
@@ -450,22 +437,27 @@ def process_regional_coverage(country):
         path =  os.path.join(folder, 'coverage_{}.shp'.format(tech))
 
         if os.path.exists(path):
+            tasks.append((tech, path, regions, gid_level))
 
-            coverage = gpd.read_file(path)
+    if WORKERS > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(WORKERS, len(tasks))) as executor:
+            return dict(executor.map(get_coverage_area, tasks))
 
-            segments = gpd.overlay(regions, coverage, how='intersection')
+    return dict(get_coverage_area(task) for task in tasks)
 
-            tech_coverage = {}
 
-            for idx, region in segments.iterrows():
+def get_coverage_area(task):
+    """
+    Find the area of each region covered by a single technology.
 
-                area_km2 = round(area_of_polygon(region['geometry']) / 1e6)
+    """
+    tech, path, regions, gid_level = task
 
-                tech_coverage[region[gid_level]] = area_km2
+    coverage = gpd.read_file(path)
 
-            output[tech] = tech_coverage
+    area_km2 = overlay_areas(regions, coverage, gid_level)
 
-    return output
+    return tech, {gid: round(area) for gid, area in area_km2.items()}
 
 
 def get_regional_data(country):
@@ -507,41 +499,29 @@ def get_regional_data(country):
     path = os.path.join(folder, filename)
 
     regions = gpd.read_file(path)
+    regions = regions[~regions[gid_level].isin(country['regions_to_skip'])]
 
-    results = []
-
-    for index, region in regions.iterrows():
-
-        if region[gid_level] in country['regions_to_skip']:
-            continue
-
-        with rasterio.open(path_night_lights) as src:
-
-            affine = src.transform
-            array = src.read(1)
-            array[array <= 0] = 0
+    path_under_10 = os.path.join(DATA_INTERMEDIATE, iso3, 'under_10')
+    paths_under_10 = glob.glob(path_under_10 + '/*.tif')
 
-            luminosity_summation = [d['sum'] for d in zonal_stats(
-                region['geometry'],
-                array,
-                stats=['sum'],
-                nodata=0,
-                affine=affine)][0]
+    #each raster is read once for all regions
+    zonal_sums = get_zonal_sums(
+        [path_night_lights, path_settlements] + paths_under_10,
+        list(regions['geometry'])
+    )
+    luminosity_sums = zonal_sums[0]
+    population_sums = zonal_sums[1]
+    under_10_sums = zonal_sums[2:]
 
-        with rasterio.open(path_settlements) as src:
+    results = []
 
-            affine = src.transform
-            array = src.read(1)
-            array[array <= 0] = 0
+    for idx, (index, region) in enumerate(regions.iterrows()):
 
-            population_summation = [d['sum'] for d in zonal_stats(
-                region['geometry'],
-                array,
-                stats=['sum'],
-                nodata=0,
-                affine=affine)][0]
+        luminosity_summation = luminosity_sums[idx]
+        population_summation = population_sums[idx]
 
-        pop_under_10_pop = find_pop_under_10(region, iso3)
+        pop_under_10_pop = sum(
+            sums[idx] for sums in under_10_sums if sums[idx] is not None)
 
         area_km2 = round(area_of_polygon(region['geometry']) / 1e6)
 
@@ -596,7 +576,7 @@ def get_regional_data(country):
     backhaul_lut = estimate_backhaul(iso3, country['region'], '2025')
 
     print('Working on estimating sites')
-    results = estimate_sites(results, iso3, backhaul_lut)
+    results = estimate_sites(results, iso3, backhaul_lut, SEED)
 
     results_df = pd.DataFrame(results)
 
@@ -607,49 +587,60 @@ def get_regional_data(country):
     return print('Completed night lights data querying')
 
 
-def find_pop_under_10(region, iso3):
+def get_zonal_sums(paths, geometries):
     """
-    Find the estimated population under 10 years old.
+    Sum the values of each raster within each geometry.
+
+    Each raster is read once and summed over all geometries together,
+    with rasters processed in parallel when more than one worker is set.
 
     Parameters
     ----------
-    region : pandas series
-        The region being modeled.
-    iso3 : string
-        ISO3 country code.
+    paths : list of strings
+        Paths to the rasters.
+    geometries : list of shapely geometries
+        The regions being summed over.
 
     Returns
     -------
-    population : int
-        Population sum under 10 years of age.
+    zonal_sums : list of lists
+        For each raster, the sum within each geometry (None if the
+        geometry contains no cells with values above zero).
 
     """
-    path = os.path.join(DATA_INTERMEDIATE, iso3, 'under_10')
-    all_paths = glob.glob(path + '/*.tif')
+    tasks = [(path, geometries) for path in paths]
 
-    population = []
+    if WORKERS > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(WORKERS, len(tasks))) as executor:
+            return list(executor.map(sum_raster_by_geometry, tasks))
 
-    for path in all_paths:
-        with rasterio.open(path) as src:
+    return [sum_raster_by_geometry(task) for task in tasks]
+
+
+def sum_raster_by_geometry(task):
+    """
+    Sum the values of a single raster within each geometry.
 
-            affine = src.transform
-            array = src.read(1)
-            array[array <= 0] = 0
+    Values of zero or below are treated as nodata.
 
-            population_summation = [d['sum'] for d in zonal_stats(
-                region['geometry'],
-                array,
-                stats=['sum'],
-                nodata=0,
-                affine=affine)][0]
+    """
+    path, geometries = task
+
+    with rasterio.open(path) as src:
 
-            if population_summation is not None:
-                population.append(population_summation)
+        affine = src.transform
+        array = src.read(1)
+        array[array <= 0] = 0
 
-    return sum(population)
+    return [d['sum'] for d in zonal_stats(
+        geometries,
+        array,
+        stats=['sum'],
+        nodata=0,
+        affine=affine)]
 
 
-def estimate_sites(data, iso3, backhaul_lut):
+def estimate_sites(data, iso3, backhaul_lut, seed=None):
     """
     Estimate the sites by region.
 
@@ -661,6 +652,8 @@ def estimate_sites(data, iso3, backhaul_lut):
         ISO3 country code.
     backhaul_lut : dict
         Lookup table of backhaul composition.
+    seed : int
+        Seed for drawing the backhaul type of each site.
 
     Returns
     -------
@@ -707,6 +700,7 @@ def estimate_sites(data, iso3, backhaul_lut):
     data = sorted(data, key=lambda k: k['population_km2'], reverse=True)
 
     covered_pop_so_far = 0
+    sites = []
 
     for region in data:
 
@@ -728,23 +722,7 @@ def estimate_sites(data, iso3, backhaul_lut):
                 sites_estimated_total = 0
                 sites_estimated_km2 = 0
 
-        backhaul_fiber = 0
-        backhaul_copper = 0
-        backhaul_wireless = 0
-        backhaul_satellite = 0
-
-        for i in range(1, int(round(sites_estimated_total)) + 1):
-
-            num = random.uniform(0, 1)
-
-            if num <= tower_backhaul_lut['fiber']:
-                backhaul_fiber += 1
-            elif tower_backhaul_lut['fiber'] < num <= tower_backhaul_lut['copper']:
-                backhaul_copper += 1
-            elif tower_backhaul_lut['copper'] < num <= tower_backhaul_lut['microwave']:
-                backhaul_wireless += 1
-            elif tower_backhaul_lut['microwave'] < num:
-                backhaul_satellite += 1
+        sites.append(int(round(sites_estimated_total)))
 
         output.append({
                 'GID_0': region['GID_0'],
@@ -763,10 +741,10 @@ def estimate_sites(data, iso3, backhaul_lut):
                 'total_estimated_sites_km2': sites_estimated_km2,
                 'sites_3G': sites_estimated_total * (region['coverage_3G_percent'] /100),
                 'sites_4G': sites_estimated_total * (region['coverage_4G_percent'] /100),
-                'backhaul_fiber': backhaul_fiber,
-                'backhaul_copper': backhaul_copper,
-                'backhaul_wireless': backhaul_wireless,
-                'backhaul_satellite': backhaul_satellite,
+                'backhaul_fiber': 0,
+                'backhaul_copper': 0,
+                'backhaul_wireless': 0,
+                'backhaul_satellite': 0,
             })
 
         if region['population'] == None:
@@ -774,6 +752,14 @@ def estimate_sites(data, iso3, backhaul_lut):
 
         covered_pop_so_far += region['population']
 
+    #the backhaul of all sites is drawn at once, for all regions
+    backhaul = sample_backhaul_types(sites, tower_backhaul_lut, seed)
+
+    for region, counts in zip(output, backhaul):
+        for tech, count in zip(['backhaul_fiber', 'backhaul_copper',
+            'backhaul_wireless', 'backhaul_satellite'], counts):
+            region[tech] = int(count)
+
     return output
 
 
@@ -921,94 +907,6 @@ def estimate_numers_of_sites(linear_regressor, x_value):
     return result
 
 
-def exclude_small_shapes(x):
-    """
-    Remove small multipolygon shapes.
-
-    Parameters
-    ---------
-    x : polygon
-        Feature to simplify.
-
-    Returns
-    -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
-
-    """
-    # if its a single polygon, just return the polygon geometry
-    if x.geometry.geom_type == 'Polygon':
-        return x.geometry
-
-    # if its a multipolygon, we start trying to simplify
-    # and remove shapes if its too big.
-    elif x.geometry.geom_type == 'MultiPolygon':
-
-        area1 = 0.01
-        area2 = 50
-
-        # dont remove shapes if total area is already very small
-        if x.geometry.area < area1:
-            return x.geometry
-        # remove bigger shapes if country is really big
-
-        if x['GID_0'] in ['CHL','IDN']:
-            threshold = 0.01
-        elif x['GID_0'] in ['RUS','GRL','CAN','USA']:
-            threshold = 0.01
-
-        elif x.geometry.area > area2:
-            threshold = 0.1
-        else:
-            threshold = 0.001
-
-        # save remaining polygons as new multipolygon for
-        # the specific country
-        new_geom = []
-        for y in x.geometry:
-            if y.area > threshold:
-                new_geom.append(y)
-
-        return MultiPolygon(new_geom)
-
-
-def clean_coverage(x):
-    """
-    Cleans the coverage polygons by remove small multipolygon shapes.
-
-    Parameters
-    ---------
-    x : polygon
-        Feature to simplify.
-
-    Returns
-    -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
-
-    """
-    # if its a single polygon, just return the polygon geometry
-    if x.geometry.geom_type == 'Polygon':
-        if x.geometry.area > 1e7:
-            return x.geometry
-
-    # if its a multipolygon, we start trying to simplify and
-    # remove shapes if its too big.
-    elif x.geometry.geom_type == 'MultiPolygon':
-
-        threshold = 1e7
-
-        # save remaining polygons as new multipolygon for
-        # the specific country
-        new_geom = []
-        for y in x.geometry:
-
-            if y.area > threshold:
-                new_geom.append(y)
-
-        return MultiPolygon(new_geom)
-
-
 def estimate_core_nodes(iso3, pop_density_km2, settlement_size):
     """
     This function identifies settlements which exceed a desired settlement
@@ -1137,37 +1035,24 @@ def generate_agglomeration_lut(country):
     regions = gpd.read_file(path, crs="epsg:4326")
 
     path_settlements = os.path.join(DATA_INTERMEDIATE, iso3, 'settlements.tif')
-    settlements = rasterio.open(path_settlements, 'r+')
-    settlements.nodata = 255
-    settlements.crs = {"init": "epsg:4326"}
 
     folder_tifs = os.path.join(DATA_INTERMEDIATE, iso3, 'agglomerations', 'tifs')
     if not os.path.exists(folder_tifs):
         os.makedirs(folder_tifs)
 
-    for idx, region in regions.iterrows():
-
-        bbox = region['geometry'].envelope
-        geo = gpd.GeoDataFrame()
-        geo = gpd.GeoDataFrame({'geometry': bbox}, index=[idx])
-        coords = [json.loads(geo.to_json())['features'][0]['geometry']]
-
-        #chop on coords
-        out_img, out_transform = mask(settlements, coords, crop=True)
+    #one handle on the settlement layer is used for all regions
+    with rasterio.open(path_settlements) as settlements:
 
-        # Copy the metadata
-        out_meta = settlements.meta.copy()
+        for idx, region in regions.iterrows():
 
-        out_meta.update({"driver": "GTiff",
-                        "height": out_img.shape[1],
-                        "width": out_img.shape[2],
-                        "transform": out_transform,
-                        "crs": 'epsg:4326'})
+            bbox = region['geometry'].envelope
+            geo = gpd.GeoDataFrame()
+            geo = gpd.GeoDataFrame({'geometry': bbox}, index=[idx])
+            coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-        path_output = os.path.join(folder_tifs, region[GID_level] + '.tif')
+            path_output = os.path.join(folder_tifs, region[GID_level] + '.tif')
 
-        with rasterio.open(path_output, "w", **out_meta) as dest:
-                dest.write(out_img)
+            clip_raster(settlements, coords, path_output, nodata=255)
 
     print('Completed settlement.tif regional segmentation')
 
@@ -1183,35 +1068,8 @@ def generate_agglomeration_lut(country):
     nodes = pd.concat([nodes, bool_list], axis=1)
     nodes = nodes[nodes[0] == True].drop(columns=0)
 
-    agglomerations = []
-
     print('Identifying agglomerations')
-    for idx1, region in regions.iterrows():
-        seen = set()
-        for idx2, node in nodes.iterrows():
-            if node['geometry'].intersects(region['geometry']):
-                agglomerations.append({
-                    'type': 'Feature',
-                    'geometry': mapping(node['geometry']),
-                    'properties': {
-                        'id': idx1,
-                        'GID_0': region['GID_0'],
-                        GID_level: region[GID_level],
-                        'population': node['sum'],
-                    }
-                })
-                seen.add(region[GID_level])
-        if len(seen) == 0:
-            agglomerations.append({
-                    'type': 'Feature',
-                    'geometry': mapping(region['geometry'].centroid),
-                    'properties': {
-                        'id': 'regional_node',
-                        'GID_0': region['GID_0'],
-                        GID_level: region[GID_level],
-                        'population': 1,
-                    }
-                })
+    agglomerations = assign_agglomerations(regions, nodes, GID_level)
 
     agglomerations = gpd.GeoDataFrame.from_features(
             [
@@ -1792,45 +1650,22 @@ def fit_edges(input_path, output_path):
     nodes = gpd.read_file(input_path, crs='epsg:4326')
     nodes = nodes.to_crs('epsg:3857')
 
-    all_possible_edges = []
-
-    for node1_id, node1 in nodes.iterrows():
-        for node2_id, node2 in nodes.iterrows():
-            if node1_id != node2_id:
-                geom1 = shape(node1['geometry'])
-                geom2 = shape(node2['geometry'])
-                line = LineString([geom1, geom2])
-                all_possible_edges.append({
-                    'type': 'Feature',
-                    'geometry': mapping(line),
-                    'properties':{
-                        'from': node1_id,
-                        'to':  node2_id,
-                        'length': line.length,
-                        'source': 'new',
-                    }
-                })
-    if len(all_possible_edges) == 0:
-        return
-
-    G = nx.Graph()
-
-    for node_id, node in enumerate(nodes):
-        G.add_node(node_id, object=node)
-
-    for edge in all_possible_edges:
-        G.add_edge(edge['properties']['from'], edge['properties']['to'],
-            object=edge, weight=edge['properties']['length'])
-
-    tree = nx.minimum_spanning_edges(G)
-
     edges = []
 
-    for branch in tree:
-        link = branch[2]['object']
-        if link['properties']['length'] > 0:
-            if 'geometry' in link:
-                edges.append(link)
+    #only the edges of the minimum spanning tree are built
+    for node1, node2 in minimum_spanning_edges(nodes.geometry.x.values,
+        nodes.geometry.y.values):
+        line = LineString([nodes.geometry.iloc[node1], nodes.geometry.iloc[node2]])
+        edges.append({
+            'type': 'Feature',
+            'geometry': mapping(line),
+            'properties':{
+                'from': nodes.index[node1],
+                'to':  nodes.index[node2],
+                'length': line.length,
+                'source': 'new',
+            }
+        })
 
     if len(edges) > 0:
         edges = gpd.GeoDataFrame.from_features(edges, crs='epsg:3857')
@@ -1928,104 +1763,48 @@ def generate_core_lut(country):
     core_edges = gpd.GeoDataFrame(
         {'geometry': core_edges['geometry'], 'source': core_edges['source']})
 
-    existing_edges = core_edges.loc[core_edges['source'] == 'existing']
-    existing_edges = gpd.clip(regions, existing_edges)
-    existing_edges = existing_edges.to_crs('epsg:3857')
-    existing_edges['length'] = existing_edges['geometry'].length
-
-    for idx, edge in existing_edges.iterrows():
-        output.append({
-            'GID_id': edge[regional_level],
-            'asset': 'core_edge',
-            'value': edge['length'],
-            'source': 'existing',
-        })
-
-    new_edges = core_edges.loc[core_edges['source'] == 'new']
-    new_edges = gpd.clip(regions, new_edges)
-    new_edges = new_edges.to_crs('epsg:3857')
-    new_edges['length'] = new_edges['geometry'].length
-
-    for idx, edge in new_edges.iterrows():
-        output.append({
-            'GID_id': edge[regional_level],
-            'asset': 'core_edge',
-            'value': edge['length'],
-            'source': 'new',
-        })
-
+    edges = [
+        ('core_edge', 'existing', core_edges.loc[core_edges['source'] == 'existing']),
+        ('core_edge', 'new', core_edges.loc[core_edges['source'] == 'new']),
+    ]
 
     path = os.path.join(DATA_INTERMEDIATE, iso3, 'network', 'regional_edges.shp')
     if os.path.exists(path):
         regional_edges = gpd.read_file(path, crs='epsg:4326')
+        #all regional edges are assumed to be new
+        edges.append(('regional_edge', 'new', regional_edges))
 
-        regional_edges = gpd.clip(regions, regional_edges)
-        regional_edges = regional_edges.to_crs('epsg:3857')
-        regional_edges['length'] = regional_edges['geometry'].length
+    for asset, source, asset_edges in edges:
 
-        for idx, edge in regional_edges.iterrows():
-            output.append({
-                'GID_id': edge[regional_level],
-                'asset': 'regional_edge',
-                'value': edge['length'],
-                'source': 'new', #all regional edges are assumed to be new
-            })
+        asset_edges = gpd.clip(regions, asset_edges)
+        asset_edges = asset_edges.to_crs('epsg:3857')
 
-    path = os.path.join(DATA_INTERMEDIATE, iso3, 'network', 'core_nodes.shp')
-    nodes = gpd.read_file(path, crs='epsg:4326')
+        output.append(pd.DataFrame({
+            'GID_id': asset_edges[regional_level].values,
+            'asset': asset,
+            'value': asset_edges['geometry'].length.values,
+            'source': source,
+        }))
 
-    existing_nodes = nodes.loc[nodes['source'] == 'existing']
-    f = lambda x:np.sum(existing_nodes.intersects(x))
-    regions['nodes'] = regions['geometry'].apply(f)
+    for asset, filename in [
+        ('core_node', 'core_nodes.shp'),
+        ('regional_node', 'regional_nodes.shp')]:
 
-    for idx, region in regions.iterrows():
-        output.append({
-            'GID_id': region[regional_level],
-            'asset': 'core_node',
-            'value': region['nodes'],
-            'source': 'existing',
-        })
-
-    new_nodes = nodes.loc[nodes['source'] == 'new']
-    f = lambda x:np.sum(new_nodes.intersects(x))
-    regions['nodes'] = regions['geometry'].apply(f)
-
-    for idx, region in regions.iterrows():
-        output.append({
-            'GID_id': region[regional_level],
-            'asset': 'core_node',
-            'value': region['nodes'],
-            'source': 'new',
-        })
-
-    path = os.path.join(DATA_INTERMEDIATE, iso3, 'network', 'regional_nodes.shp')
-    regional_nodes = gpd.read_file(path, crs='epsg:4326')
-
-    existing_nodes = regional_nodes.loc[regional_nodes['source'] == 'existing']
-    f = lambda x:np.sum(existing_nodes.intersects(x))
-    regions['regional_nodes'] = regions['geometry'].apply(f)
-
-    for idx, region in regions.iterrows():
-        output.append({
-            'GID_id': region[regional_level],
-            'asset': 'regional_node',
-            'value': region['regional_nodes'],
-            'source': 'existing',
-        })
+        path = os.path.join(DATA_INTERMEDIATE, iso3, 'network', filename)
+        nodes = gpd.read_file(path, crs='epsg:4326')
 
-    new_nodes = regional_nodes.loc[regional_nodes['source'] == 'new']
-    f = lambda x:np.sum(new_nodes.intersects(x))
-    regions['regional_nodes'] = regions['geometry'].apply(f)
+        counts = count_points_by_region(regions, nodes, 'source')
+        counts = counts.reindex(columns=['existing', 'new'], fill_value=0)
 
-    for idx, region in regions.iterrows():
-        output.append({
-            'GID_id': region[regional_level],
-            'asset': 'regional_node',
-            'value': region['regional_nodes'],
-            'source': 'new',
-        })
+        for source in ['existing', 'new']:
+            output.append(pd.DataFrame({
+                'GID_id': regions[regional_level].values,
+                'asset': asset,
+                'value': counts[source].values,
+                'source': source,
+            }))
 
-    output = pd.DataFrame(output)
+    output = pd.concat(output, ignore_index=True)
     output = output.drop_duplicates()
     output.to_csv(output_path, index=False)
 
@@ -2064,7 +1843,7 @@ def forecast_subscriptions(country):
     path = os.path.join(DATA_INTERMEDIATE, iso3, 'subscriptions')
 
     if not os.path.exists(path):
-        os.mkdir(path)
+        os.makedirs(path)
 
     forecast_df.to_csv(os.path.join(path, 'subs_forecast.csv'), index=False)
 
@@ -2198,13 +1977,13 @@ def forecast_smartphones(country):
     path = os.path.join(DATA_INTERMEDIATE, iso3, 'smartphones')
 
     if not os.path.exists(path):
-        os.mkdir(path)
+        os.makedirs(path)
 
     forecast_df.to_csv(os.path.join(path, 'smartphone_forecast.csv'), index=False)
 
     path = os.path.join(BASE_PATH, '..', 'vis', 'smartphones', 'data_inputs')
     if not os.path.exists(path):
-        os.mkdir(path)
+        os.makedirs(path, exist_ok=True)
     forecast_df.to_csv(os.path.join(path, '{}.csv'.format(iso3)), index=False)
 
     return print('Completed subscription forecast')
@@ -2313,6 +2092,180 @@ def forecast_smartphones_linear(data, country, start_point, end_point):
     return output
 
 
+def get_layer_stages(country):
+    """
+    Declare the stages writing the national outline, regions, coverage
+    and settlement layers of a country.
+
+    These layers are also read by prep1.py, pop.py and uba_prep.py, which
+    declare these stages for them, so each layer is written by a single
+    stage. Each level of regions has its own stage, as the scripts need
+    regions down to different levels.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all country specfic information.
+
+    Returns
+    -------
+    stages : dict
+        The stages of each layer ('national_outline', 'regions',
+        'coverage', 'settlements' and 'under_10'), as lists.
+
+    """
+    iso3 = country['iso3']
+    level = country['regional_level']
+
+    folder = os.path.join(DATA_INTERMEDIATE, iso3)
+    national_outline = os.path.join(folder, 'national_outline.shp')
+
+    technologies = ['GSM', '3G', '4G']
+    folder_coverage = os.path.join(DATA_RAW, 'mobile_coverage_explorer')
+    coverage_raw = [
+        path for tech in technologies for path in [
+            os.path.join(folder_coverage, 'Data_MCE', 'Inclusions_201812_{}.shp'.format(tech)),
+            os.path.join(folder_coverage, 'Data_MCE', 'MCE_201812_{}.shp'.format(tech)),
+            os.path.join(folder_coverage, 'Data_OCI', 'OCI_201812_{}.shp'.format(tech)),
+        ]
+    ]
+    coverage = [os.path.join(folder, 'coverage', 'coverage_{}.shp'.format(tech))
+        for tech in technologies]
+
+    under_10_raw = sorted(glob.glob(
+        os.path.join(DATA_RAW, 'settlement_layer', 'under_10') + '/*.tif'))
+    under_10 = [os.path.join(folder, 'under_10', os.path.basename(path))
+        for path in under_10_raw]
+
+    regions = [{
+        'name': '{}: {} {}'.format(iso3, get_function_name(process_regional_level),
+            regional_level),
+        'function': process_regional_level,
+        'args': (country, regional_level),
+        'params': {'iso3': iso3, 'regional_level': regional_level},
+        'inputs': [os.path.join(DATA_RAW, 'gadm36_levels_shp',
+            'gadm36_{}.shp'.format(regional_level))],
+        'outputs': [os.path.join(folder, 'regions', 'regions_{}_{}.shp'.format(
+            regional_level, iso3))],
+    } for regional_level in range(1, level + 1)]
+
+    return {
+        'national_outline': [country_stage(process_country_shapes, country,
+            [os.path.join(DATA_RAW, 'gadm36_levels_shp', 'gadm36_0.shp'),
+            os.path.join(BASE_PATH, 'global_information.csv')],
+            [national_outline])],
+        'regions': regions,
+        'coverage': [country_stage(process_coverage_shapes, country,
+            coverage_raw,
+            coverage, ['iso2'], optional=coverage)],
+        'settlements': [country_stage(process_settlement_layer, country,
+            [os.path.join(DATA_RAW, 'settlement_layer', 'ppp_2020_1km_Aggregated.tif'),
+            national_outline],
+            [os.path.join(folder, 'settlements.tif')])],
+        'under_10': [country_stage(process_under_10_layers, country,
+            under_10_raw + [national_outline],
+            under_10)],
+    }
+
+
+def get_stages(country):
+    """
+    Declare the preprocessing stages for a country, with the files each
+    stage reads and writes and the country parameters each depends on,
+    for `pipeline.run_stages`.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all country specfic information.
+
+    Returns
+    -------
+    stages : list of dicts
+        All stages for the country.
+
+    """
+    iso3 = country['iso3']
+    level = country['regional_level']
+
+    folder = os.path.join(DATA_INTERMEDIATE, iso3)
+    national_outline = os.path.join(folder, 'national_outline.shp')
+    regions = os.path.join(folder, 'regions', 'regions_{}_{}.shp'.format(level, iso3))
+    settlements = os.path.join(folder, 'settlements.tif')
+    night_lights = os.path.join(folder, 'night_lights.tif')
+    agglomerations = os.path.join(folder, 'agglomerations', 'agglomerations.shp')
+    core_edges_existing = os.path.join(folder, 'network_existing', 'core_edges_existing.shp')
+    core_nodes_existing = os.path.join(folder, 'network_existing', 'core_nodes_existing.shp')
+    core_nodes = os.path.join(folder, 'network', 'core_nodes.shp')
+    new_nodes = os.path.join(folder, 'network', 'new_nodes.shp')
+    core_edges = os.path.join(folder, 'network', 'core_edges.shp')
+    regional_nodes = os.path.join(folder, 'network', 'regional_nodes.shp')
+    regional_edges = os.path.join(folder, 'network', 'regional_edges.shp')
+
+    layers = get_layer_stages(country)
+
+    coverage = layers['coverage'][0]['outputs']
+    under_10 = layers['under_10'][0]['outputs']
+
+    regional_data = country_stage(get_regional_data, country,
+        [national_outline, regions, night_lights, settlements] + coverage +
+        under_10 + [os.path.join(folder, 'sites', 'sites.csv'),
+        os.path.join(DATA_RAW, 'wb_mobile_coverage', 'wb_population_coverage_2G.csv'),
+        os.path.join(DATA_RAW, 'real_site_data', 'tower_counts', 'tower_counts.csv'),
+        os.path.join(DATA_RAW, 'gsma', 'backhaul.csv')],
+        [os.path.join(folder, 'regional_data.csv')],
+        ['regional_level', 'regions_to_skip', 'region'])
+    #the backhaul of each site is drawn with the configured seed
+    regional_data['params']['seed'] = SEED
+
+    growth = [key for key in country if key.startswith('subs_growth_')]
+    sp_growth = [key for key in country if key.startswith('sp_growth_')]
+
+    return layers['national_outline'] + layers['regions'] + [
+        *layers['settlements'],
+        *layers['under_10'],
+        country_stage(process_night_lights, country,
+            [os.path.join(DATA_RAW, 'nightlights', '2013',
+                'F182013.v4c_web.stable_lights.avg_vis.tif'), national_outline],
+            [night_lights]),
+        *layers['coverage'],
+        regional_data,
+        country_stage(generate_agglomeration_lut, country,
+            [regions, settlements],
+            [agglomerations, os.path.join(folder, 'agglomerations', 'agglomerations.csv')],
+            ['regional_level', 'pop_density_km2', 'settlement_size']),
+        country_stage(process_existing_fiber, country,
+            [os.path.join(DATA_RAW, 'afterfiber', 'afterfiber.shp')],
+            [core_edges_existing], ['iso2'], optional=[core_edges_existing]),
+        country_stage(find_nodes_on_existing_infrastructure, country,
+            [core_edges_existing, agglomerations],
+            [core_nodes_existing], optional=[core_nodes_existing]),
+        country_stage(find_regional_nodes, country,
+            [agglomerations, core_nodes_existing],
+            [core_nodes, regional_nodes, new_nodes],
+            ['regional_level', 'regions_to_skip'], optional=[new_nodes]),
+        country_stage(prepare_edge_fitting, country,
+            [core_edges_existing, core_nodes_existing, core_nodes, new_nodes],
+            [core_edges]),
+        country_stage(fit_regional_edges, country,
+            [core_nodes, regional_nodes],
+            [regional_edges], ['regional_level']),
+        country_stage(generate_core_lut, country,
+            [regions, core_edges, regional_edges, core_nodes, regional_nodes],
+            [os.path.join(folder, 'core_lut.csv')], ['regional_level']),
+        country_stage(forecast_subscriptions, country,
+            [os.path.join(DATA_RAW, 'gsma', 'gsma_unique_subscribers.csv')],
+            [os.path.join(folder, 'subscriptions', 'subs_forecast.csv'),
+            os.path.join(BASE_PATH, '..', 'vis', 'subscriptions', 'data_inputs',
+                '{}.csv'.format(iso3))], growth),
+        country_stage(forecast_smartphones, country,
+            [os.path.join(DATA_RAW, 'wb_smartphone_survey', 'wb_smartphone_survey.csv')],
+            [os.path.join(folder, 'smartphones', 'smartphone_forecast.csv'),
+            os.path.join(BASE_PATH, '..', 'vis', 'smartphones', 'data_inputs',
+                '{}.csv'.format(iso3))], ['cluster'] + sp_growth),
+    ]
+
+
 if __name__ == '__main__':
 
     countries = [
@@ -2365,49 +2318,10 @@ if __name__ == '__main__':
         },
     ]
 
-    for country in countries:
-
-        print('Processing country boundary')
-        process_country_shapes(country)
-
-        print('Processing regions')
-        process_regions(country)
-
-        print('Processing settlement layer')
-        process_settlement_layer(country)
-
-        print('Processing night lights')
-        process_night_lights(country)
-
-        print('Processing coverage shapes')
-        process_coverage_shapes(country)
-
-        print('Getting regional data')
-        get_regional_data(country)
-
-        print('Generating agglomeration lookup table')
-        generate_agglomeration_lut(country)
-
-        print('Load existing fiber infrastructure')
-        process_existing_fiber(country)
-
-        print('Estimate existing nodes')
-        find_nodes_on_existing_infrastructure(country)
-
-        print('Find regional nodes')
-        find_regional_nodes(country)
-
-        print('Fit edges')
-        prepare_edge_fitting(country)
-
-        print('Fit regional edges')
-        fit_regional_edges(country)
-
-        print('Create core lookup table')
-        generate_core_lut(country)
-
-        print('Create subscription forcast')
-        forecast_subscriptions(country)
+    #stages are skipped when their inputs and parameters are unchanged, and
+    #countries, and the stages within each country which do not depend on
+    #each other, are processed in parallel
+    stages = [stage for country in countries for stage in get_stages(country)]
 
-        print('Forecasting smartphones')
-        forecast_smartphones(country)
+    run_stages(stages, os.path.join(DATA_INTERMEDIATE, 'cache'),
+        STAGE_WORKERS)
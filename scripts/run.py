@@ -9,17 +9,16 @@ Winter 2020
 import os
 import csv
 import configparser
+import numpy as np
 import pandas as pd
 import geopandas
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 from options import OPTIONS, COUNTRY_PARAMETERS
-from podis.demand import estimate_demand
-from podis.supply import estimate_supply
-from podis.assess import assess
-from write import (define_deciles, #write_mno_demand,
-    write_regional_results,
-    write_decile_results, write_national_results) #, write_inputs
+from podis.batch import run_batch
+from write import (define_deciles, CsvSink, ParquetSink, #write_mno_demand,
+    RESULT_STORE) #, write_inputs
 from user_costs import (process_costs, process_all_regional_data, processing_national_costs,
     processing_decile_costs, processing_total_costs)
 from percentages import process_percentages
@@ -33,6 +32,19 @@ DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 OUTPUT = os.path.join(BASE_PATH, '..', 'results', 'model_results')
 PARAMETERS_DIR = os.path.join(BASE_PATH, '..', 'results', 'model_parameters')
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
+RESULT_FORMAT = CONFIG.get('run', 'result_format', fallback='csv')
+
+BASE_YEAR = 2020
+END_YEAR = 2030
+TIMESTEP_INCREMENT = 1
+TIMESTEPS = [t for t in range(BASE_YEAR, END_YEAR + 1, TIMESTEP_INCREMENT)]
+
+#Inputs shared by all tasks, loaded once per worker process.
+WORKER_INPUTS = {}
+
+#Loaded country inputs, keyed on file path and scenario prefix.
+COUNTRY_INPUTS = {}
 
 
 def load_regions(iso3, path):
@@ -42,7 +54,7 @@ def load_regions(iso3, path):
     """
     regions = pd.read_csv(path)
 
-    regions['geotype'] = regions.apply(define_geotype, axis=1)
+    regions['geotype'] = define_geotypes(regions['population_km2'])
 
     if len(iso3) <= 3:
         regions['integration'] = 'baseline'
@@ -75,6 +87,38 @@ def define_geotype(x):
         return 'rural 5'
 
 
+def define_geotypes(population_km2):
+    """
+    Allocate geotypes given a series of population densities.
+
+    Vectorized equivalent of `define_geotype`.
+
+    """
+    population_km2 = np.asarray(population_km2)
+
+    return np.select(
+        [
+            population_km2 > 5000,
+            population_km2 > 1500,
+            population_km2 > 1000,
+            population_km2 > 500,
+            population_km2 > 100,
+            population_km2 > 50,
+            population_km2 > 10,
+        ],
+        [
+            'urban',
+            'suburban 1',
+            'suburban 2',
+            'rural 1',
+            'rural 2',
+            'rural 3',
+            'rural 4',
+        ],
+        'rural 5'
+    )
+
+
 def read_capacity_lookup(path):
     """
 
@@ -283,119 +327,279 @@ def allocate_deciles(data):
     return data
 
 
-if __name__ == '__main__':
+def init_worker():
+    """
+    Load the inputs shared by all (parameter row, country) tasks.
 
-    if not os.path.exists(OUTPUT):
-        os.makedirs(OUTPUT)
+    """
+    path = os.path.join(DATA_RAW, 'pysim5g', 'capacity_lut_by_frequency.csv')
+    WORKER_INPUTS['lookup'] = read_capacity_lookup(path)
 
-    BASE_YEAR = 2020
-    END_YEAR = 2030
-    TIMESTEP_INCREMENT = 1
-    TIMESTEPS = [t for t in range(BASE_YEAR, END_YEAR + 1, TIMESTEP_INCREMENT)]
 
-    path = os.path.join(DATA_INTERMEDIATE, 'uq_inputs.csv')
-    parameter_set = pd.read_csv(path)
+def load_cached(path, load, key=None):
+    """
+    Load a file once, reloading only if it has been modified since.
 
-    path = os.path.join(DATA_RAW, 'pysim5g', 'capacity_lut_by_frequency.csv')
-    lookup = read_capacity_lookup(path)
+    Parameters
+    ----------
+    path : string
+        Path to the input file.
+    load : function
+        Called with no arguments to load the file.
+    key : string
+        Distinguishes different loads of the same file (e.g. by scenario).
 
-    # countries, country_regional_levels = find_country_list(['Africa', 'South America'])
+    """
+    mtime = os.path.getmtime(path)
 
-    countries = [
-        {'iso3': 'CIV', 'iso2': 'CI', 'regional_level': 2, 'regional_nodes_level': 1},
-        {'iso3': 'KEN', 'iso2': 'KE', 'regional_level': 3, 'regional_nodes_level': 2},
-        {'iso3': 'MLI', 'iso2': 'ML', 'regional_level': 2, 'regional_nodes_level': 2},
-        {'iso3': 'SEN', 'iso2': 'SN', 'regional_level': 2, 'regional_nodes_level': 2},
-        {'iso3': 'TZA', 'iso2': 'TZ', 'regional_level': 2, 'regional_nodes_level': 1},
-        {'iso3': 'UGA', 'iso2': 'UG', 'regional_level': 2, 'regional_nodes_level': 2},
-        ]
+    if (path, key) in COUNTRY_INPUTS:
+        cached_mtime, value = COUNTRY_INPUTS[(path, key)]
+        if cached_mtime == mtime:
+            return value
+
+    value = load()
+    COUNTRY_INPUTS[(path, key)] = (mtime, value)
+
+    return value
+
+
+def load_country_inputs(country, scenario):
+    """
+    Load all inputs for a country, for the scenario being modeled.
+
+    Each input is only read and prepared the first time it is needed,
+    and forecasts are shared by all scenarios with the same prefix.
+
+    Parameters
+    ----------
+    country : dict
+        Country information.
+    scenario : string
+        The scenario being modeled (e.g. 'baseline_10_10_10').
+
+    Returns
+    -------
+    inputs : dict
+        Cluster, core lut, penetration lut, smartphone lut and regions.
 
-    all_results = []
+    """
+    iso3 = country['iso3']
+    prefix = scenario.split('_')[0]
+
+    path = os.path.join(DATA_RAW, 'clustering', 'data_clustering_results.csv')
+    cluster = load_cached(path, lambda: load_cluster(path, iso3), iso3)
+
+    path = os.path.join(DATA_INTERMEDIATE, iso3, 'core_lut.csv')
+    core_lut = load_cached(path, lambda: load_core_lut(path))
+
+    path = os.path.join(DATA_INTERMEDIATE, iso3, 'subscriptions', 'subs_forecast.csv')
+    penetration_lut = load_cached(path, lambda: load_penetration(scenario, path), prefix)
+
+    path = os.path.join(DATA_INTERMEDIATE, iso3, 'smartphones', 'smartphone_forecast.csv')
+    smartphone_lut = load_cached(path, lambda: load_smartphones(scenario, path), prefix)
+
+    path = os.path.join(DATA_INTERMEDIATE, iso3, 'regional_data.csv')
+    regions = load_cached(path, lambda: load_regions(iso3, path))
 
-    for idx, parameters in parameter_set.iterrows():
+    return {
+        'cluster': cluster,
+        'core_lut': core_lut,
+        'penetration_lut': penetration_lut,
+        'smartphone_lut': smartphone_lut,
+        'regions': regions,
+    }
 
-        # if idx == 1:
-        #     break
 
-        regional_annual_demand = []
-        regional_results = []
-        regional_cost_structure = []
+def run_country(task):
+    """
+    Run demand, supply and assessment for a batch of parameter rows and
+    one country, with `run_batch`.
 
-        for country in countries:#[:1]:
+    Parameters
+    ----------
+    task : tuple
+        The batch of parameter rows and the country.
 
-            iso3 = country['iso3']
+    Returns
+    -------
+    final_results : list of lists of dicts
+        Regional results with deciles allocated, for each parameter row
+        of the batch.
 
-            # print('Working on {}'.format(iso3))
+    """
+    rows, country = task
 
-            country_parameters = COUNTRY_PARAMETERS[iso3]
+    iso3 = country['iso3']
 
-            folder = os.path.join(DATA_RAW, 'clustering')
-            filename = 'data_clustering_results.csv'
-            country['cluster'] = load_cluster(os.path.join(folder, filename), iso3)
+    country_parameters = COUNTRY_PARAMETERS[iso3]
 
-            folder = os.path.join(DATA_INTERMEDIATE, iso3)
-            filename = 'core_lut.csv'
-            core_lut = load_core_lut(os.path.join(folder, filename))
+    penetration_luts = {}
+    smartphone_luts = {}
 
-            print('Working on {}, {}, {}, {}, in {}'.format(
-                parameters['decision_option'],
-                parameters['strategy'],
-                parameters['scenario'],
-                parameters['input_cost'],
-                iso3))
+    for scenario in rows['scenario'].unique():
+        inputs = load_country_inputs(country, scenario)
+        penetration_luts[scenario] = inputs['penetration_lut']
+        smartphone_luts[scenario] = inputs['smartphone_lut']
 
-            folder = os.path.join(DATA_INTERMEDIATE, iso3, 'subscriptions')
-            filename = 'subs_forecast.csv'
-            path = os.path.join(folder, filename)
-            penetration_lut = load_penetration(parameters['scenario'], path)
+    country['cluster'] = inputs['cluster']
 
-            folder = os.path.join(DATA_INTERMEDIATE, iso3, 'smartphones')
-            filename = 'smartphone_forecast.csv'
-            path = os.path.join(folder, filename)
-            smartphone_lut = load_smartphones(parameters['scenario'], path)
+    for idx, parameters in rows.iterrows():
+        print('Working on {}, {}, {}, {}, in {}'.format(
+            parameters['decision_option'],
+            parameters['strategy'],
+            parameters['scenario'],
+            parameters['input_cost'],
+            iso3))
 
-            filename = 'regional_data.csv'
-            path = os.path.join(DATA_INTERMEDIATE, iso3, filename)
-            data = load_regions(iso3, path)
+    data_assess = run_batch(
+        country,
+        inputs['regions'],
+        rows,
+        country_parameters,
+        TIMESTEPS,
+        penetration_luts,
+        smartphone_luts,
+        WORKER_INPUTS['lookup'],
+        inputs['core_lut']
+    )
 
-            data_initial = data.to_dict('records')
+    final_results = []
 
-            data_demand, annual_demand = estimate_demand(
-                data_initial,
-                parameters,
-                country_parameters,
-                TIMESTEPS,
-                penetration_lut,
-                smartphone_lut
-            )
+    for idx in rows.index:
+        data = data_assess.loc[data_assess['parameter_set'] == idx]
+        data = data.drop(columns='parameter_set')
+        final_results.append(allocate_deciles(data))
 
-            data_supply = estimate_supply(
-                country,
-                data_demand,
-                lookup,
-                parameters,
-                country_parameters,
-                core_lut
-            )
+    return final_results
 
-            data_assess = assess(
-                country,
-                data_supply,
-                parameters,
-                country_parameters,
-                TIMESTEPS
-            )
 
-            final_results = allocate_deciles(data_assess)
+def get_batches(parameter_set):
+    """
+    Split the parameter rows into batches of consecutive rows with the
+    same strategy, to be run together by `run_batch`.
 
-            regional_annual_demand = regional_annual_demand + annual_demand
-            regional_results = regional_results + final_results
+    Rows with the same strategy share demand, site and spectrum estimates
+    across scenarios' input cost variants, so each batch is one strategy
+    of the `uq.generate_uq` grid.
 
-            # filename = 'regional_annual_demand_{}.csv'.format(parameters['decision_option'])
-            # path = os.path.join(OUTPUT, filename)
-            # write_mno_demand(regional_annual_demand, OUTPUT, parameters['decision_option'], path)
+    """
+    strategy = parameter_set['strategy']
+    batch = (strategy != strategy.shift()).cumsum()
 
-            all_results = all_results + regional_results
+    return [rows for _, rows in parameter_set.groupby(batch, sort=False)]
+
+
+def run_sweep(parameter_set, countries, workers=1):
+    """
+    Run every (batch of parameter rows, country) task, optionally across
+    a process pool.
+
+    Results are yielded one parameter row at a time, in the order of
+    `parameter_set`, with countries in the order given. The output does
+    not depend on the number of workers. Only a few tasks per worker are
+    submitted ahead of the results being yielded, so finished results do
+    not pile up in memory behind a slow task.
+
+    Parameters
+    ----------
+    parameter_set : pandas DataFrame
+        One row of model parameters per iteration.
+    countries : list of dicts
+        Country information.
+    workers : int
+        Number of worker processes. With one worker, tasks run in-process.
+
+    Yields
+    ------
+    parameters : pandas Series
+        The parameter row.
+    regional_results : list of dicts
+        Regional results for all countries for this parameter row.
+
+    """
+    batches = get_batches(parameter_set)
+
+    tasks = (
+        (rows, country)
+        for rows in batches
+        for country in countries
+    )
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+            initializer=init_worker) as executor:
+            results = bounded_map(executor, run_country, tasks, 2 * workers)
+            yield from collect_rows(batches, countries, results)
+    else:
+        init_worker()
+        results = map(run_country, tasks)
+        yield from collect_rows(batches, countries, results)
+
+
+def bounded_map(executor, function, tasks, window):
+    """
+    Map a function over tasks across an executor, yielding results in
+    the order of the tasks.
+
+    Unlike `executor.map`, which submits every task at once, at most
+    `window` tasks are submitted and not yet yielded at any time.
+
+    """
+    pending = deque()
+
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, task))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def collect_rows(batches, countries, results):
+    """
+    Group ordered task results back into one list per parameter row.
+
+    """
+    for rows in batches:
+
+        country_results = [next(results) for country in countries]
+
+        for i, (idx, parameters) in enumerate(rows.iterrows()):
+
+            regional_results = []
+
+            for country_result in country_results:
+                regional_results.extend(country_result[i])
+
+            yield parameters, regional_results
+
+
+if __name__ == '__main__':
+
+    if not os.path.exists(OUTPUT):
+        os.makedirs(OUTPUT)
+
+    path = os.path.join(DATA_INTERMEDIATE, 'uq_inputs.csv')
+    parameter_set = pd.read_csv(path)
+
+    # countries, country_regional_levels = find_country_list(['Africa', 'South America'])
+
+    countries = [
+        {'iso3': 'CIV', 'iso2': 'CI', 'regional_level': 2, 'regional_nodes_level': 1},
+        {'iso3': 'KEN', 'iso2': 'KE', 'regional_level': 3, 'regional_nodes_level': 2},
+        {'iso3': 'MLI', 'iso2': 'ML', 'regional_level': 2, 'regional_nodes_level': 2},
+        {'iso3': 'SEN', 'iso2': 'SN', 'regional_level': 2, 'regional_nodes_level': 2},
+        {'iso3': 'TZA', 'iso2': 'TZ', 'regional_level': 2, 'regional_nodes_level': 1},
+        {'iso3': 'UGA', 'iso2': 'UG', 'regional_level': 2, 'regional_nodes_level': 2},
+        ]
+
+    if RESULT_FORMAT == 'csv':
+        sink = CsvSink(OUTPUT)
+    else:
+        sink = ParquetSink(os.path.join(OUTPUT, RESULT_STORE))
+
+    for parameters, regional_results in run_sweep(parameter_set, countries, WORKERS):
 
         handle = "{}_{}_{}".format(
             parameters['scenario'],
@@ -403,14 +607,9 @@ if __name__ == '__main__':
             parameters['iteration']
         )
 
-        path = os.path.join(OUTPUT, 'regional_results')
-        write_regional_results(regional_results, path, handle)
-
-        path = os.path.join(OUTPUT, 'decile_results')
-        write_decile_results(regional_results, path, handle)
+        sink.write(handle, regional_results)
 
-        path = os.path.join(OUTPUT, 'national_results')
-        write_national_results(regional_results, path, handle)
+    sink.close()
 
     process_costs()
     process_all_regional_data()
@@ -0,0 +1,333 @@
+"""
+Vector geometry processing shared by the preprocessing scripts.
+
+"""
+import warnings
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import MultiPolygon, mapping
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import Delaunay
+
+#Global equal-area crs (WGS 84 / NSIDC EASE-Grid 2.0 Global) for areas.
+EQUAL_AREA_CRS = 'epsg:6933'
+
+
+def assign_agglomerations(regions, nodes, GID_level):
+    """
+    Assign agglomeration nodes to the regions they intersect.
+
+    Nodes are matched to regions with a spatial join, rather than testing
+    every node against every region. Regions without any nodes are given
+    a single node at their centroid.
+
+    Parameters
+    ----------
+    regions : geopandas GeoDataFrame
+        All regions.
+    nodes : geopandas GeoDataFrame
+        Agglomeration nodes, with the population of each in `sum`.
+    GID_level : string
+        The regional id column (e.g. 'GID_2').
+
+    Returns
+    -------
+    agglomerations : list of dicts
+        Agglomeration features, ordered by region and then by node.
+
+    """
+    nodes = nodes[['geometry', 'sum']].copy()
+    nodes['node_position'] = np.arange(len(nodes))
+
+    candidates = regions[['geometry']].copy()
+    candidates['region_position'] = np.arange(len(regions))
+
+    joined = gpd.sjoin(nodes, candidates, how='inner')
+    joined = joined.sort_values(['region_position', 'node_position'])
+
+    regional_nodes = {
+        position: group for position, group in joined.groupby('region_position')
+    }
+
+    agglomerations = []
+
+    for position, (idx, region) in enumerate(regions.iterrows()):
+
+        if position in regional_nodes:
+            for geometry, population in zip(
+                regional_nodes[position]['geometry'],
+                regional_nodes[position]['sum']):
+                agglomerations.append({
+                    'type': 'Feature',
+                    'geometry': mapping(geometry),
+                    'properties': {
+                        'id': idx,
+                        'GID_0': region['GID_0'],
+                        GID_level: region[GID_level],
+                        'population': population,
+                    }
+                })
+        else:
+            agglomerations.append({
+                    'type': 'Feature',
+                    'geometry': mapping(region['geometry'].centroid),
+                    'properties': {
+                        'id': 'regional_node',
+                        'GID_0': region['GID_0'],
+                        GID_level: region[GID_level],
+                        'population': 1,
+                    }
+                })
+
+    return agglomerations
+
+
+def minimum_spanning_edges(x, y):
+    """
+    Find the edges of the Euclidean minimum spanning tree of a set of points.
+
+    Candidate edges are taken from the Delaunay triangulation, which
+    always contains the minimum spanning tree, so only O(n) candidate
+    edges are considered rather than all pairs of points. Points at the
+    same location are joined to the tree once, via the first of them.
+
+    Parameters
+    ----------
+    x : numpy array
+        Projected x coordinates of the points.
+    y : numpy array
+        Projected y coordinates of the points.
+
+    Returns
+    -------
+    edges : numpy array
+        Positions of the two points joined by each edge, with the later
+        point first, ordered by increasing edge length.
+
+    """
+    points = np.column_stack([x, y]).astype(float)
+
+    #drop points at the same location, keeping the first
+    unique_points = np.sort(np.unique(points, axis=0, return_index=True)[1])
+    points = points[unique_points]
+
+    if len(points) < 2:
+        return np.empty((0, 2), dtype=int)
+
+    if len(points) < 4:
+        candidates = np.array([
+            (i, j) for i in range(len(points)) for j in range(i + 1, len(points))
+        ])
+    elif np.linalg.matrix_rank(points - points[0]) < 2:
+        #collinear points are joined in order along the line
+        order = np.lexsort((points[:, 1], points[:, 0]))
+        candidates = np.column_stack([order[:-1], order[1:]])
+    else:
+        simplices = Delaunay(points).simplices
+        candidates = np.concatenate([
+            simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+        candidates = np.unique(np.sort(candidates, axis=1), axis=0)
+
+    lengths = np.hypot(*(points[candidates[:, 0]] - points[candidates[:, 1]]).T)
+
+    tree = minimum_spanning_tree(coo_matrix(
+        (lengths, (candidates[:, 0], candidates[:, 1])),
+        shape=(len(points), len(points))
+    )).tocoo()
+
+    order = np.argsort(tree.data, kind='stable')
+
+    edges = unique_points[np.column_stack([tree.row[order], tree.col[order]])]
+
+    return np.sort(edges, axis=1)[:, ::-1]
+
+
+def count_points_by_region(regions, points, column):
+    """
+    Count the points intersecting each region, for each value of a column.
+
+    Points are matched to regions with a single spatial join, rather than
+    testing every point against every region.
+
+    Parameters
+    ----------
+    regions : geopandas GeoDataFrame
+        All regions.
+    points : geopandas GeoDataFrame
+        Points to count (e.g. network nodes).
+    column : string
+        The point column to count by (e.g. 'source').
+
+    Returns
+    -------
+    counts : pandas DataFrame
+        One row per region, in the order of `regions`, and one column of
+        counts for each value of `column`. Regions without any points
+        have a count of zero.
+
+    """
+    candidates = regions[['geometry']].copy()
+    candidates['region_position'] = np.arange(len(regions))
+
+    joined = gpd.sjoin(points[['geometry', column]], candidates, how='inner')
+
+    counts = joined.groupby(['region_position', column]).size().unstack(
+        column, fill_value=0)
+
+    return counts.reindex(np.arange(len(regions)), fill_value=0)
+
+
+def overlay_areas(regions, shapes, GID_level, crs=EQUAL_AREA_CRS):
+    """
+    Find the area of each region covered by a set of shapes.
+
+    Both layers are projected once to an equal-area crs, so the areas of
+    all intersections are found together, rather than reprojecting each
+    intersection in turn.
+
+    Parameters
+    ----------
+    regions : geopandas GeoDataFrame
+        All regions.
+    shapes : geopandas GeoDataFrame
+        Shapes covering the regions (e.g. coverage polygons).
+    GID_level : string
+        The regional id column (e.g. 'GID_2').
+    crs : string
+        Equal-area crs the areas are measured in.
+
+    Returns
+    -------
+    area_km2 : pandas Series
+        Area covered in square kilometers, indexed by regional id, for
+        regions intersecting the shapes.
+
+    """
+    regions = regions[[GID_level, 'geometry']].to_crs(crs)
+    shapes = shapes[['geometry']].to_crs(crs)
+
+    segments = gpd.overlay(regions, shapes, how='intersection')
+
+    return (segments.geometry.area / 1e6).groupby(segments[GID_level]).sum()
+
+
+def exclude_small_shapes(shapes):
+    """
+    Remove small polygons from multipolygon boundaries.
+
+    Parts of each multipolygon no larger than a threshold area (in the
+    units of the layer's crs) are removed, with all parts of all shapes
+    measured together. Thresholds depend on the size of the shape, and
+    shapes which are already very small are kept as they are.
+
+    Parameters
+    ----------
+    shapes : geopandas GeoDataFrame
+        Boundaries (e.g. countries or regions), with the country code in
+        `GID_0`.
+
+    Returns
+    -------
+    geometry : geopandas GeoSeries
+        Geometries without tiny shapes, aligned with `shapes`.
+
+    """
+    area = get_area(shapes.geometry)
+
+    threshold = np.where(area > 50, 0.1, 0.001)
+    #remove bigger shapes if country is really big
+    threshold[shapes['GID_0'].isin(
+        ['CHL', 'IDN', 'RUS', 'GRL', 'CAN', 'USA']).values] = 0.01
+
+    #dont remove shapes if total area is already very small
+    multipolygons = (shapes.geom_type == 'MultiPolygon').values & (area >= 0.01)
+
+    polygons = shapes.geom_type.isin(['Polygon', 'MultiPolygon']).values
+    geometry = np.where(polygons, shapes.geometry.values, None)
+    geometry[multipolygons] = remove_small_parts(
+        shapes.geometry[multipolygons], threshold[multipolygons])
+
+    return gpd.GeoSeries(geometry, index=shapes.index, crs=shapes.crs)
+
+
+def clean_coverage(coverage, threshold=1e7):
+    """
+    Remove small polygons from coverage shapes.
+
+    Polygons, and parts of multipolygons, no larger than the threshold
+    area are removed, with all parts of all shapes measured together.
+    Removed polygons are set to None.
+
+    Parameters
+    ----------
+    coverage : geopandas GeoDataFrame
+        Coverage shapes, in a projected crs.
+    threshold : float
+        Smallest area kept, in the units of the crs (e.g. square meters).
+
+    Returns
+    -------
+    geometry : geopandas GeoSeries
+        Geometries without tiny shapes, aligned with `coverage`.
+
+    """
+    area = get_area(coverage.geometry)
+
+    polygons = (coverage.geom_type == 'Polygon').values & (area > threshold)
+    multipolygons = (coverage.geom_type == 'MultiPolygon').values
+
+    geometry = np.where(polygons, coverage.geometry.values, None)
+    geometry[multipolygons] = remove_small_parts(
+        coverage.geometry[multipolygons],
+        np.full(multipolygons.sum(), threshold))
+
+    return gpd.GeoSeries(geometry, index=coverage.index, crs=coverage.crs)
+
+
+def remove_small_parts(geometries, thresholds):
+    """
+    Remove the parts of each multipolygon no larger than its threshold.
+
+    Parameters
+    ----------
+    geometries : geopandas GeoSeries
+        Multipolygons.
+    thresholds : numpy array
+        Smallest area of the parts kept, for each multipolygon.
+
+    Returns
+    -------
+    geometry : numpy array
+        Multipolygons of the parts kept, which may be empty.
+
+    """
+    with warnings.catch_warnings():
+        #the default index of the parts differs between geopandas versions
+        warnings.simplefilter('ignore', FutureWarning)
+        parts = geometries.reset_index(drop=True).explode()
+
+    #the first index level of the parts is the position of their multipolygon
+    positions = parts.index.get_level_values(0).values
+
+    keep = get_area(parts) > np.asarray(thresholds)[positions]
+
+    kept = [[] for geometry in geometries]
+    for position, part in zip(positions[keep], parts.values[keep]):
+        kept[position].append(part)
+
+    geometry = np.empty(len(kept), dtype=object)
+    geometry[:] = [MultiPolygon(polygons) for polygons in kept]
+
+    return geometry
+
+
+def get_area(geometries):
+    """
+    Get the area of each geometry in the units of its crs, including
+    geographic crs.
+
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'Geometry is in a geographic CRS')
+        return geometries.area.values
@@ -8,9 +8,12 @@ July 2020
 """
 import os
 import configparser
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
+from write import RESULT_STORE, compact_results, get_result_files, read_result_file
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
@@ -18,82 +21,78 @@ BASE_PATH = CONFIG['file_locations']['base_path']
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 RESULTS = os.path.join(BASE_PATH, '..', 'results', 'model_results')
 OUTPUT = os.path.join(BASE_PATH, '..', 'results', 'user_costs')
+RESULT_FORMAT = CONFIG.get('run', 'result_format', fallback='csv')
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
 
+#Most rows of user cost estimates held in memory at once.
+CHUNK_SIZE = 1000000
 
-def process_costs():
-    """
-    Add any necessary variables and rename scenarios and strategies.
-
-    Parameters
-    ----------
-    data : pandas df
-        All model results.
-    capacity : int
-        The capacity we wish to process.
-
-    Returns
-    -------
-    data : pandas df
-        All processed model results.
-
-    """
-    data = []
 
-    path = os.path.join(RESULTS, 'regional_results')
+#Columns of the regional cost results read from the Parquet result store.
+COST_RESULT_COLUMNS = [
+    'scenario', 'strategy', 'confidence', 'input_cost',
+    'population', 'area_km2',
+    'private_cost_per_network_user', 'private_cost_per_smartphone_user',
+    'financial_cost_per_network_user', 'financial_cost_per_smartphone_user',
+    'government_cost_per_network_user',
+]
 
-    for filename in os.listdir(path):
+#Columns the mean per user costs are grouped by.
+COST_GROUPS = ['scenario', 'strategy', 'confidence', 'decile', 'input_cost']
 
-        # if not capacity in filename:
-        #     continue
+#Per user costs averaged within each group.
+COST_COLUMNS = [
+    'private_cost_per_user',
+    'government_cost_per_network_user',
+    'financial_cost_per_user',
+]
 
-        if not 'regional_mno_cost_' in filename:
-            continue
 
-        filepath = os.path.join(path, filename)
-
-        sample = pd.read_csv(filepath)
+def process_costs(workers=WORKERS):
+    """
+    Find the mean per user costs of each density decile, for each
+    scenario, strategy, confidence and input cost.
 
-        # Add population density
-        sample['population_density_km2'] = sample['population'] / sample['area_km2']
+    Regional cost results are read one file (parameter row) at a time,
+    from the Parquet result store (if `result_format` is parquet) or
+    otherwise from the .csv results, with files read across a process pool. Each file is reduced
+    to the sum and count of the per user costs in each group as it is
+    read. These partial aggregates are combined into means at the end,
+    so only the aggregates of each file are held in memory, rather than
+    all regional results.
 
-        sample = sample.replace([np.inf, -np.inf], np.nan).dropna(subset=["private_cost_per_network_user"], how="all")
-        sample = sample.replace([np.inf, -np.inf], np.nan).dropna(subset=["private_cost_per_smartphone_user"], how="all")
-        sample = sample.replace([np.inf, -np.inf], np.nan).dropna(subset=["financial_cost_per_network_user"], how="all")
-        sample = sample.replace([np.inf, -np.inf], np.nan).dropna(subset=["financial_cost_per_smartphone_user"], how="all")
+    Parameters
+    ----------
+    workers : int
+        Number of files of regional cost results read at once.
 
-        sample['private_cost_per_user'] = round(sample['private_cost_per_network_user'])
-        sample['financial_cost_per_user'] = round(sample['financial_cost_per_network_user'])
+    """
+    store = os.path.join(RESULTS, RESULT_STORE)
 
-        bins = [-1, 20, 43, 69, 109, 171, 257, 367, 541, 1104, 111607] #-1,
-        labels = ['<20','20-43','43-69','69-109','109-171','171-257','257-367','367-541','541-1104','>1104']
+    if RESULT_FORMAT == 'parquet':
+        filepaths = get_result_files(store, 'regional_mno_cost_results')
 
-        sample['decile'] = pd.cut(
-            sample['population_density_km2'],
-            bins=bins,
-            labels=labels
-        )
+    else:
+        path = os.path.join(RESULTS, 'regional_results')
 
-        sample = sample.to_dict('records')
+        filepaths = [
+            os.path.join(path, filename) for filename in os.listdir(path)
+            if 'regional_mno_cost_' in filename
+        ]
 
-        data = data + sample
+    if workers > 1 and len(filepaths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            aggregates = list(executor.map(aggregate_cost_file,
+                filepaths, chunksize=16))
+    else:
+        aggregates = [aggregate_cost_file(filepath) for filepath in filepaths]
 
-    data = pd.DataFrame(data)
+    data = pd.concat(aggregates).groupby(level=COST_GROUPS, observed=True).sum()
 
-    #subset desired columns
-    data = data[[
-        'scenario', 'strategy', 'decile', 'confidence', 'input_cost',
-        'private_cost_per_user', 'financial_cost_per_user',
-        'government_cost_per_network_user'
-    ]]
+    #groups without any valid costs have a mean of nan, as with .mean()
+    data = data['sum'] / data['count']
 
-    data = data.groupby(['scenario', 'strategy', 'confidence', 'decile', 'input_cost'], as_index=False).agg(
-            private_cost_per_user_mean = ('private_cost_per_user','mean'),
-            government_cost_per_network_user_mean = ('government_cost_per_network_user','mean'),
-            financial_cost_per_user_mean = ('financial_cost_per_user','mean'),
-            # private_cost_per_user_median = ('private_cost_per_user','median'),
-            # government_cost_per_network_user = ('government_cost_per_network_user','median'),
-            # financial_cost_per_user = ('financial_cost_per_user','median'),
-        )
+    data = data[COST_COLUMNS].reset_index()
 
     data.columns = [
         'Scenario', 'Strategy', 'Confidence', 'Decile', 'Input Cost',
@@ -108,20 +107,95 @@ def process_costs():
     return
 
 
-def process_all_regional_data():
+def aggregate_cost_file(filepath):
+    """
+    Read a file of regional cost results (.parquet or .csv) and aggregate
+    the per user costs.
+
+    """
+    if filepath.endswith('.parquet'):
+        data = compact_results(
+            read_result_file(filepath, columns=COST_RESULT_COLUMNS))
+    else:
+        data = pd.read_csv(filepath)
+
+    data = add_cost_variables(data)
+
+    return aggregate_costs(data)
+
+
+def aggregate_costs(data):
     """
-    Add any necessary variables and rename scenarios
-    and strategies.
+    Sum and count the per user costs in each group.
 
     Parameters
     ----------
     data : pandas df
-        All model results.
+        Regional cost results, with the variables from `add_cost_variables`.
 
     Returns
     -------
-    data : pandas df
-        All processed model results.
+    aggregates : pandas df
+        The `sum` and `count` (of valid values) of each per user cost,
+        indexed by group. Aggregates of different files are combined by
+        summing over the groups.
+
+    """
+    data = data[COST_GROUPS + COST_COLUMNS].copy()
+
+    #group on decile labels, not categories, so groups are sorted by label
+    data['decile'] = data['decile'].astype(object)
+
+    grouped = data.groupby(COST_GROUPS, observed=True)
+
+    return pd.concat([grouped.sum(), grouped.count()], axis=1,
+        keys=['sum', 'count'])
+
+
+def add_cost_variables(data):
+    """
+    Add population density, rounded per user costs and density deciles,
+    dropping rows without valid per user costs.
+
+    """
+    # Add population density
+    data['population_density_km2'] = data['population'] / data['area_km2']
+
+    data = data.replace([np.inf, -np.inf], np.nan).dropna(subset=["private_cost_per_network_user"], how="all")
+    data = data.replace([np.inf, -np.inf], np.nan).dropna(subset=["private_cost_per_smartphone_user"], how="all")
+    data = data.replace([np.inf, -np.inf], np.nan).dropna(subset=["financial_cost_per_network_user"], how="all")
+    data = data.replace([np.inf, -np.inf], np.nan).dropna(subset=["financial_cost_per_smartphone_user"], how="all")
+
+    data['private_cost_per_user'] = round(data['private_cost_per_network_user'])
+    data['financial_cost_per_user'] = round(data['financial_cost_per_network_user'])
+
+    bins = [-1, 20, 43, 69, 109, 171, 257, 367, 541, 1104, 111607] #-1,
+    labels = ['<20','20-43','43-69','69-109','109-171','171-257','257-367','367-541','541-1104','>1104']
+
+    data['decile'] = pd.cut(
+        data['population_density_km2'],
+        bins=bins,
+        labels=labels
+    )
+
+    return data
+
+
+def process_all_regional_data(chunk_size=CHUNK_SIZE):
+    """
+    Estimate the user costs of every region, for every combination of
+    scenario, strategy, confidence and input cost.
+
+    Regions are cross joined with the parameter combinations, and the
+    mean per user costs of each decile joined on, so totals are found
+    as column arithmetic. Estimates are written in chunks of parameter
+    combinations, so only `chunk_size` rows are held in memory at once.
+
+    Parameters
+    ----------
+    chunk_size : int
+        Most rows of estimates held in memory at once (each chunk holds
+        all regions, for at least one parameter combination).
 
     """
     #Loading regional data by pop density geotype
@@ -143,88 +217,71 @@ def process_all_regional_data():
         data['population_km2'],
         bins=bins,
         labels=labels
-    )
+    ).astype(object)
 
     path = os.path.join(OUTPUT, 'decile_user_costs.csv')
     costs = pd.read_csv(path)
 
-    costs = costs.to_dict('records')
-
-    lookup = {}
-
-    scenarios = set()
-    strategies = set()
-    cis = set()
-    input_costs = set()
-
-    for item in costs:
-
-        scenario = item['Scenario']
-        strategy = item['Strategy'].replace(' ', '')
-        ci = item['Confidence']
-        decile = item['Decile']
-        input_cost = item['Input Cost']
-
-        handle = '{}_{}_{}_{}_{}'.format(scenario, strategy, ci, decile, input_cost)
-
-        lookup[handle] = {
-            'Private Cost Per User ($USD)': item['private_mean_cpu'],
-            'Government Cost Per User ($USD)': item['govt_mean_cpu'],
-        }
-
-        scenarios.add(scenario)
-        strategies.add(strategy)
-        cis.add(ci)
-        input_costs.add(input_cost)
-
-    output = []
-
-    data = data.to_dict('records')
-
-    for scenario in list(scenarios):
-        for strategy in list(strategies):
-            for ci in list(cis):
-                for input_cost in input_costs:
-                    for item in data:
-
-                        handle = '{}_{}_{}_{}_{}'.format(
-                            scenario,
-                            strategy,
-                            ci,
-                            item['decile'],
-                            input_cost
-                        )
-
-                        private_cost_per_user = lookup[handle]['Private Cost Per User ($USD)']
-                        govt_cost_per_user = lookup[handle]['Government Cost Per User ($USD)']
-
-                        output.append({
-                            'GID_id': item['GID_id'],
-                            'GID_level': item['GID_level'],
-                            'GID_0': item['GID_0'],
-                            'scenario': scenario,
-                            'strategy': strategy,
-                            'confidence': ci,
-                            'input_cost': input_cost,
-                            'population': item['population'],
-                            'population_km2': item['population_km2'],
-                            'area_km2': item['area_km2'],
-                            'decile': item['decile'],
-                            'private_cost_per_user': private_cost_per_user,
-                            'govt_cost_per_user': govt_cost_per_user,
-                            'financial_cost_per_user': private_cost_per_user + govt_cost_per_user,
-                            'total_private_cost': item['population'] * private_cost_per_user,
-                            'total_government_cost': item['population'] * govt_cost_per_user,
-                            'total_financial_cost': (item['population'] *
-                            (private_cost_per_user + govt_cost_per_user)),
-                        })
-
-    output = pd.DataFrame(output)
+    keys = ['scenario', 'strategy', 'confidence', 'decile', 'input_cost']
+
+    costs = pd.DataFrame({
+        'scenario': costs['Scenario'],
+        'strategy': costs['Strategy'].str.replace(' ', ''),
+        'confidence': costs['Confidence'],
+        'decile': costs['Decile'],
+        'input_cost': costs['Input Cost'],
+        'private_cost_per_user': costs['private_mean_cpu'],
+        'govt_cost_per_user': costs['govt_mean_cpu'],
+    })
+
+    #strategies matching once spaces are removed take the last costs
+    costs = costs.drop_duplicates(keys, keep='last')
+
+    #every combination of the parameters, not only those with costs
+    parameters = pd.MultiIndex.from_product([
+        costs['scenario'].unique(),
+        costs['strategy'].unique(),
+        costs['confidence'].unique(),
+        costs['input_cost'].unique(),
+    ], names=['scenario', 'strategy', 'confidence', 'input_cost']).to_frame(
+        index=False)
+
+    step = max(1, chunk_size // max(1, len(data)))
 
     path = os.path.join(OUTPUT, 'user_cost_estimates.csv')
-    output.to_csv(path, index=False)
 
-    return output
+    for start in range(0, max(1, len(parameters)), step):
+
+        output = pd.merge(parameters[start:start + step], data, how='cross')
+
+        output = pd.merge(output, costs, how='left', on=keys, indicator=True)
+
+        missing = output['_merge'] == 'left_only'
+        if missing.any():
+            raise KeyError("Combination %s not found in lookup table",
+                tuple(output.loc[missing, keys].iloc[0]))
+
+        output['financial_cost_per_user'] = (
+            output['private_cost_per_user'] + output['govt_cost_per_user'])
+        output['total_private_cost'] = (
+            output['population'] * output['private_cost_per_user'])
+        output['total_government_cost'] = (
+            output['population'] * output['govt_cost_per_user'])
+        output['total_financial_cost'] = (
+            output['population'] * output['financial_cost_per_user'])
+
+        output = output[[
+            'GID_id', 'GID_level', 'GID_0', 'scenario', 'strategy',
+            'confidence', 'input_cost', 'population', 'population_km2',
+            'area_km2', 'decile', 'private_cost_per_user', 'govt_cost_per_user',
+            'financial_cost_per_user', 'total_private_cost',
+            'total_government_cost', 'total_financial_cost',
+        ]]
+
+        output.to_csv(path, index=False, mode='w' if start == 0 else 'a',
+            header=start == 0)
+
+    return
 
 
 def processing_national_costs():
@@ -7,8 +7,112 @@ Written by Ed Oughton
 
 """
 import os
+import abc
+import glob
+import numpy as np
 import pandas as pd
 import datetime
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+#Folder (within the model results folder) holding the Parquet result store.
+RESULT_STORE = 'results_store'
+
+#Columns the result store is partitioned by.
+PARTITION_COLUMNS = ['scenario', 'strategy', 'input_cost']
+
+#Compact dtypes of model result columns. Identifiers repeated on every row
+#are categories. Counts and input percentages use 32 bits, as costs,
+#revenues and populations need 64 bits for the totals summed from them.
+RESULT_SCHEMA = {
+    'GID_0': 'category',
+    'GID_id': 'category',
+    'GID_level': 'category',
+    'geotype': 'category',
+    'integration': 'category',
+    'scenario': 'category',
+    'strategy': 'category',
+    'input_cost': 'category',
+    'decile': 'category',
+    'confidence': 'int32',
+    'penetration': 'float32',
+    'smartphone_penetration': 'float32',
+    'new_mno_sites': 'int32',
+    'backhaul_new': 'int32',
+    'backhaul_copper': 'int32',
+    'backhaul_satellite': 'int32',
+    'total_upgraded_sites': 'int32',
+    'total_new_sites': 'int32',
+    'total_phones': 'int32',
+    'total_smartphones': 'int32',
+}
+
+
+def compact_results(data):
+    """
+    Convert model results to the compact dtypes of `RESULT_SCHEMA`.
+
+    Numeric columns are only converted where every value is unchanged in
+    the compact dtype, so no precision is lost.
+
+    Parameters
+    ----------
+    data : pandas df
+        Model results (e.g. regional results).
+
+    Returns
+    -------
+    data : pandas df
+        The results, with compact dtypes.
+
+    """
+    dtypes = {}
+
+    for column, dtype in RESULT_SCHEMA.items():
+
+        if not column in data.columns:
+            continue
+
+        if dtype == 'category':
+            dtypes[column] = dtype
+            continue
+
+        values = data[column]
+
+        #only integers become int32, and only floats become float32
+        if values.dtype.kind != np.dtype(dtype).kind:
+            continue
+
+        if values.astype(dtype).astype(values.dtype).equals(values):
+            dtypes[column] = dtype
+
+    return data.astype(dtypes)
+
+
+def concat_results(frames):
+    """
+    Concatenate compact model results, keeping categorical columns as
+    categories of the values of all frames.
+
+    """
+    frames = list(frames)
+
+    for column in frames[0].columns:
+
+        if not all(column in frame.columns and
+            isinstance(frame[column].dtype, pd.CategoricalDtype)
+            for frame in frames):
+            continue
+
+        categories = frames[0][column].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[column].cat.categories, sort=False)
+
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=True)
 
 
 def define_deciles(regions):
@@ -23,7 +127,7 @@ def define_deciles(regions):
         'scenario',
         'strategy',
         'confidence'
-    ], as_index=True).population_km2.apply( #cost_per_sp_user
+    ], as_index=True, observed=True, group_keys=False).population_km2.apply( #cost_per_sp_user
         pd.qcut, q=11, precision=0,
         labels=[100,90,80,70,60,50,40,30,20,10,0],
         duplicates='drop') #   [0,10,20,30,40,50,60,70,80,90,100]
@@ -54,11 +158,38 @@ def write_regional_results(regional_results, folder, metric):
     """
     Write all results.
 
+    """
+    regional_mno_results, regional_mno_cost_results = get_regional_results(
+        regional_results)
+
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+
+    path = os.path.join(folder,'regional_mno_results_{}.csv'.format(metric))
+    regional_mno_results.to_csv(path, index=False)
+
+    path = os.path.join(folder,'regional_mno_cost_results_{}.csv'.format(metric))
+    regional_mno_cost_results.to_csv(path, index=False)
+
+
+def get_regional_results(regional_results):
+    """
+    Get the regional results and regional cost results.
+
+    """
+    results = get_results(regional_results, [
+        'regional_mno_results', 'regional_mno_cost_results'])
+
+    return results['regional_mno_results'], results['regional_mno_cost_results']
+
+
+def get_regional_mno_results(regions, deciles):
+    """
+    Get the regional results, from the regions allocated to deciles.
+
     """
     print('Writing regional results')
-    regional_mno_results = pd.DataFrame(regional_results)
-    regional_mno_results = define_deciles(regional_mno_results)
-    regional_mno_results = regional_mno_results[[
+    regional_mno_results = deciles[[
         'GID_0', 'GID_id', 'scenario', 'strategy', 'decile',
         'confidence', 'input_cost', 'population', 'area_km2',
         'phones_on_network', 'smartphones_on_network',
@@ -75,12 +206,6 @@ def write_regional_results(regional_results, folder, metric):
         regional_mno_results['total_mno_cost'] /
         regional_mno_results['smartphones_on_network'])
 
-    if not os.path.exists(folder):
-        os.mkdir(folder)
-
-    path = os.path.join(folder,'regional_mno_results_{}.csv'.format(metric))
-    regional_mno_results.to_csv(path, index=False)
-
 
     # print('Writing regional results')
     # regional_market_results = pd.DataFrame(regional_results)
@@ -103,11 +228,16 @@ def write_regional_results(regional_results, folder, metric):
     # path = os.path.join(folder,'regional_market_results_{}.csv'.format(metric))
     # regional_market_results.to_csv(path, index=False)
 
+    return regional_mno_results
+
+
+def get_regional_mno_cost_results(regions, deciles):
+    """
+    Get the regional cost results, from the regions allocated to deciles.
 
+    """
     print('Writing regional cost results')
-    regional_mno_cost_results = pd.DataFrame(regional_results)
-    regional_mno_cost_results = define_deciles(regional_mno_cost_results)
-    regional_mno_cost_results = regional_mno_cost_results[[
+    regional_mno_cost_results = deciles[[
         'GID_0', 'GID_id', 'scenario', 'strategy',
         'decile', 'confidence', 'input_cost', 'population', 'area_km2', 'geotype',
         'phones_on_network', 'smartphones_on_network', 'total_mno_revenue',
@@ -152,19 +282,44 @@ def write_regional_results(regional_results, folder, metric):
     #     regional_mno_cost_results['government_cost'] /
     #     regional_mno_cost_results['private_cost'] * 100)
 
-    path = os.path.join(folder,'regional_mno_cost_results_{}.csv'.format(metric))
-    regional_mno_cost_results.to_csv(path, index=False)
+    return regional_mno_cost_results
 
 
 def write_decile_results(regional_results, folder, metric):
     """
     Write decile results.
 
+    """
+    decile_results, decile_cost_results = get_decile_results(regional_results)
+
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+
+    path = os.path.join(folder,'decile_mno_results_{}.csv'.format(metric))
+    decile_results.to_csv(path, index=False)
+
+    path = os.path.join(folder,'decile_mno_cost_results_{}.csv'.format(metric))
+    decile_cost_results.to_csv(path, index=False)
+
+
+def get_decile_results(regional_results):
+    """
+    Get the decile results and decile cost results.
+
+    """
+    results = get_results(regional_results, [
+        'decile_mno_results', 'decile_mno_cost_results'])
+
+    return results['decile_mno_results'], results['decile_mno_cost_results']
+
+
+def get_decile_mno_results(regions, deciles):
+    """
+    Get the decile results, from the regions allocated to deciles.
+
     """
     print('Writing general decile results')
-    decile_results = pd.DataFrame(regional_results)
-    decile_results = define_deciles(decile_results)
-    decile_results = decile_results[[
+    decile_results = deciles[[
         'GID_0', 'scenario', 'strategy', 'decile', 'confidence', 'input_cost',
         'population', 'area_km2', 'phones_on_network',
         'smartphones_on_network', 'total_estimated_sites',
@@ -175,7 +330,8 @@ def write_decile_results(regional_results, folder, metric):
     ]]
     decile_results = decile_results.drop_duplicates()
     decile_results = decile_results.groupby([
-        'GID_0', 'scenario', 'strategy', 'confidence', 'decile'], as_index=True).sum()
+        'GID_0', 'scenario', 'strategy', 'confidence', 'decile'], as_index=True,
+        observed=True).sum(numeric_only=True)
     decile_results['population_km2'] = (
         decile_results['population'] / decile_results['area_km2'])
     decile_results['phone_density_on_network_km2'] = (
@@ -191,17 +347,16 @@ def write_decile_results(regional_results, folder, metric):
     decile_results['cost_per_smartphone_user'] = (
         decile_results['total_mno_cost'] / decile_results['smartphones_on_network'])
 
-    if not os.path.exists(folder):
-        os.mkdir(folder)
+    return decile_results
 
-    path = os.path.join(folder,'decile_mno_results_{}.csv'.format(metric))
-    decile_results.to_csv(path, index=False)
 
+def get_decile_mno_cost_results(regions, deciles):
+    """
+    Get the decile cost results, from the regions allocated to deciles.
 
+    """
     print('Writing cost decile results')
-    decile_cost_results = pd.DataFrame(regional_results)
-    decile_cost_results = define_deciles(decile_cost_results)
-    decile_cost_results = decile_cost_results[[
+    decile_cost_results = deciles[[
         'GID_0', 'scenario', 'strategy', 'decile', 'confidence', 'input_cost',
         'population', 'area_km2', 'phones_on_network', 'smartphones_on_network',
         'total_mno_revenue', 'ran_capex', 'ran_opex', 'backhaul_capex',
@@ -214,7 +369,8 @@ def write_decile_results(regional_results, folder, metric):
     ]]
     decile_cost_results = decile_cost_results.drop_duplicates()
     decile_cost_results = decile_cost_results.groupby([
-        'GID_0', 'scenario', 'strategy', 'confidence', 'decile'], as_index=True).sum()
+        'GID_0', 'scenario', 'strategy', 'confidence', 'decile'], as_index=True,
+        observed=True).sum(numeric_only=True)
     decile_cost_results['cost_per_network_user'] = (
         decile_cost_results['total_mno_cost'] / decile_cost_results['phones_on_network'])
     decile_cost_results['cost_per_smartphone_user'] = (
@@ -226,8 +382,7 @@ def write_decile_results(regional_results, folder, metric):
     decile_cost_results['financial_cost'] = (
         decile_cost_results['private_cost'] + decile_cost_results['government_cost'])
 
-    path = os.path.join(folder,'decile_mno_cost_results_{}.csv'.format(metric))
-    decile_cost_results.to_csv(path, index=False)
+    return decile_cost_results
 
     # print('Writing general decile results')
     # decile_results = pd.DataFrame(regional_results)
@@ -289,6 +444,28 @@ def write_national_results(regional_results, folder, metric):
     """
     Write national results.
 
+    """
+    national_cost_results = get_national_results(regional_results)
+
+    path = os.path.join(folder,'national_market_cost_results_{}.csv'.format(metric))
+    national_cost_results.to_csv(path, index=False)
+
+
+def get_national_results(regional_results):
+    """
+    Get the national market cost results.
+
+    """
+    results = get_results(regional_results, ['national_market_cost_results'])
+
+    return results['national_market_cost_results']
+
+
+def get_national_market_cost_results(regions, deciles):
+    """
+    Get the national market cost results, from the regions in their
+    original order.
+
     """
     # print('Writing national MNO results')
     # national_results = pd.DataFrame(regional_results)
@@ -383,8 +560,7 @@ def write_national_results(regional_results, folder, metric):
 
     #=cost / market share * 100
     print('Writing national market cost composition results')
-    national_cost_results = pd.DataFrame(regional_results)
-    national_cost_results = national_cost_results[[
+    national_cost_results = regions[[
         'GID_0', 'scenario', 'strategy', 'confidence', 'input_cost', 'population',
         'total_phones', 'total_smartphones',
         'total_market_revenue',
@@ -402,7 +578,8 @@ def write_national_results(regional_results, folder, metric):
     ]]
     national_cost_results = national_cost_results.drop_duplicates()
     national_cost_results = national_cost_results.groupby([
-        'GID_0', 'scenario', 'strategy', 'input_cost', 'confidence'], as_index=True).sum().reset_index()
+        'GID_0', 'scenario', 'strategy', 'input_cost', 'confidence'], as_index=True,
+        observed=True).sum().reset_index()
 
     national_cost_results['cost_per_network_user'] = (
         national_cost_results['total_market_cost'] / national_cost_results['total_phones'])
@@ -420,9 +597,267 @@ def write_national_results(regional_results, folder, metric):
         national_cost_results['government_cost'] /
         national_cost_results['private_cost'] * 100)
 
-    path = os.path.join(folder,'national_market_cost_results_{}.csv'.format(metric))
-    national_cost_results.to_csv(path, index=False)
+    return national_cost_results
+
+
+#All tables derived from the regional results, with the function deriving each.
+RESULT_TABLES = {
+    'regional_mno_results': get_regional_mno_results,
+    'regional_mno_cost_results': get_regional_mno_cost_results,
+    'decile_mno_results': get_decile_mno_results,
+    'decile_mno_cost_results': get_decile_mno_cost_results,
+    'national_market_cost_results': get_national_market_cost_results,
+}
+
+#Folder (within the model results folder) holding each table as .csv.
+CSV_FOLDERS = {
+    'regional_mno_results': 'regional_results',
+    'regional_mno_cost_results': 'regional_results',
+    'decile_mno_results': 'decile_results',
+    'decile_mno_cost_results': 'decile_results',
+    'national_market_cost_results': 'national_results',
+}
+
+
+def get_results(regional_results, tables=None):
+    """
+    Get the results tables for a single parameter row.
+
+    The regional results are converted to a DataFrame with compact dtypes,
+    and allocated to deciles, once for all tables. Only the requested tables are derived.
+
+    Parameters
+    ----------
+    regional_results : list of dicts
+        Regional results for a single parameter row.
+    tables : list of strings
+        Tables to derive, from `RESULT_TABLES` (all tables by default).
+
+    Returns
+    -------
+    results : dict
+        Each requested table as a pandas df, by table name.
+
+    """
+    regions = compact_results(pd.DataFrame(regional_results))
+    deciles = define_deciles(regions)
+
+    if tables is None:
+        tables = list(RESULT_TABLES)
+
+    return {table: RESULT_TABLES[table](regions, deciles) for table in tables}
+
+
+class ResultSink(abc.ABC):
+    """
+    Receives model results one chunk (parameter row) at a time.
+
+    Only the current chunk is held in memory by the driver, so peak
+    memory is bounded by a single chunk rather than the whole sweep.
+    Subclasses must implement `write`.
+
+    """
+    @abc.abstractmethod
+    def write(self, handle, regional_results):
+        """
+        Write the regional results for a single parameter row.
+
+        """
+
+    def close(self):
+        """
+        Finish writing any outstanding results.
+
+        """
+        pass
+
+
+class CsvSink(ResultSink):
+    """
+    Write each chunk straight to disk as regional, decile and
+    national results.
+
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, handle, regional_results):
+        results = get_results(regional_results)
+
+        for table, data in results.items():
+            folder = os.path.join(self.folder, CSV_FOLDERS[table])
+
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+            path = os.path.join(folder, '{}_{}.csv'.format(table, handle))
+            data.to_csv(path, index=False)
+
+
+class FrameSink(ResultSink):
+    """
+    Keep each chunk in memory as a DataFrame, to be combined once
+    all chunks have been written.
+
+    """
+    def __init__(self):
+        self.frames = []
+
+    def write(self, handle, regional_results):
+        frame = compact_results(pd.DataFrame(regional_results))
+        frame['handle'] = pd.Series(handle, index=frame.index, dtype='category')
+        self.frames.append(frame)
+
+    def to_frame(self):
+        """
+        Return all chunks as a single DataFrame.
+
+        """
+        if len(self.frames) == 0:
+            return pd.DataFrame()
+
+        return concat_results(self.frames)
+
+
+class ParquetSink(ResultSink):
+    """
+    Append each chunk to a Parquet result store, partitioned by
+    scenario, strategy and input cost.
+
+    Each table is stored under folder/<table>/scenario=.../strategy=.../
+    input_cost=.../, with one file per parameter row.
+
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, handle, regional_results):
+        if len(regional_results) == 0:
+            return
+
+        partition = {c: regional_results[0][c] for c in PARTITION_COLUMNS}
+
+        tables = get_results(regional_results)
+
+        #decile results are indexed by the grouping columns
+        for table in ['decile_mno_results', 'decile_mno_cost_results']:
+            tables[table] = tables[table].reset_index()
+
+        for table, data in tables.items():
+            write_partition(data, self.folder, table, partition, handle)
+
+
+def write_partition(data, folder, table, partition, handle):
+    """
+    Write a single file into a partition of the result store.
+
+    The partition columns are dropped from the file, as their values
+    are held in the folder names.
+
+    """
+    folder = os.path.join(folder, table, *[
+        '{}={}'.format(c, partition[c]) for c in PARTITION_COLUMNS])
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    data = data.drop(columns=PARTITION_COLUMNS, errors='ignore')
+
+    path = os.path.join(folder, 'part_{}.parquet'.format(handle))
+    data.to_parquet(path, index=False)
+
+
+def read_results(folder, table, columns=None, filters=None):
+    """
+    Read a table from the Parquet result store.
+
+    Parameters
+    ----------
+    folder : string
+        Path to the result store.
+    table : string
+        Table to read (e.g. 'national_market_cost_results').
+    columns : list
+        Only read these columns.
+    filters : list of tuples
+        Only read rows matching these predicates, in the form accepted
+        by pyarrow, e.g. [('confidence', '=', 50)]. Filters on partition
+        columns skip whole partitions.
+
+    Returns
+    -------
+    data : pandas df
+        The requested rows and columns.
+
+    """
+    partitioning = ds.partitioning(
+        pa.schema([(c, pa.string()) for c in PARTITION_COLUMNS]),
+        flavor='hive'
+    )
+
+    data = pq.read_table(
+        os.path.join(folder, table),
+        columns=columns,
+        filters=filters,
+        partitioning=partitioning,
+    ).to_pandas()
+
+    for column in PARTITION_COLUMNS:
+        if column in data.columns:
+            data[column] = data[column].astype(str)
+
+    return data
+
+
+
+def get_result_files(folder, table):
+    """
+    Get the paths of all files of a table in the Parquet result store,
+    one for each parameter row.
+
+    """
+    return sorted(glob.glob(os.path.join(
+        folder, table, *['{}=*'.format(c) for c in PARTITION_COLUMNS],
+        'part_*.parquet')))
+
+
+def read_result_file(path, columns=None):
+    """
+    Read a single file of the Parquet result store.
+
+    Parameters
+    ----------
+    path : string
+        Path to the file, from `get_result_files`.
+    columns : list
+        Only read these columns, which may include partition columns.
+
+    Returns
+    -------
+    data : pandas df
+        The requested columns, with the partition columns taken from
+        the folder names.
+
+    """
+    partition = dict(
+        part.split('=', 1) for part in os.path.dirname(path).split(os.sep)
+        if part.split('=', 1)[0] in PARTITION_COLUMNS
+    )
+
+    if columns is not None:
+        data = pd.read_parquet(path,
+            columns=[c for c in columns if not c in PARTITION_COLUMNS])
+    else:
+        data = pd.read_parquet(path)
+
+    for column in PARTITION_COLUMNS:
+        if columns is None or column in columns:
+            data[column] = partition[column]
+
+    if columns is not None:
+        data = data[columns]
 
+    return data
 
 # def write_inputs(folder, country, country_parameters, global_parameters,
 #     decision_option):
@@ -49,7 +49,8 @@ setup(
         'setuptools_scm'
     ],
     install_requires=[
-        'numpy>=1.16.4'
+        'numpy>=1.16.4',
+        'pandas'
     ],
     entry_points={
         'console_scripts': [
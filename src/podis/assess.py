@@ -6,6 +6,40 @@ Written by Ed Oughton.
 Winter 2020
 
 """
+import numpy as np
+import pandas as pd
+
+from podis.demand import get_geotype_classes, lookup_geotype_classes
+from podis.strategy import parse_strategy
+
+#(output metric, regional metric) pairs, scaled from one MNO to the market
+TOTAL_MARKET_METRICS = [
+    ('total_phones', 'phones_on_network'),
+    ('total_smartphones', 'smartphones_on_network'),
+    ('total_market_revenue', 'total_mno_revenue'),
+    ('total_upgraded_sites', 'upgraded_mno_sites'),
+    ('total_new_sites', 'new_mno_sites'),
+    ('total_ran_capex', 'ran_capex'),
+    ('total_ran_opex', 'ran_opex'),
+    ('total_backhaul_capex', 'backhaul_capex'),
+    ('total_backhaul_opex', 'backhaul_opex'),
+    ('total_civils_capex', 'civils_capex'),
+    ('total_core_capex', 'core_capex'),
+    ('total_core_opex', 'core_opex'),
+    ('total_network_cost', 'mno_network_cost'),
+    ('total_network_capex', 'mno_network_capex'),
+    ('total_network_opex', 'mno_network_opex'),
+    ('total_administration', 'administration'),
+    ('total_spectrum_cost', 'spectrum_cost'),
+    ('total_tax', 'tax'),
+    ('total_profit_margin', 'profit_margin'),
+    ('total_market_cost', 'total_mno_cost'),
+    ('total_available_cross_subsidy', 'available_cross_subsidy'),
+    ('total_deficit', 'deficit'),
+    ('total_used_cross_subsidy', 'used_cross_subsidy'),
+    ('total_required_state_subsidy', 'required_state_subsidy'),
+]
+
 
 def assess(country, regions, parameters, country_parameters, timesteps):
     """
@@ -30,7 +64,7 @@ def assess(country, regions, parameters, country_parameters, timesteps):
     """
     interim = []
 
-    strategy = parameters['strategy']
+    strategy = parse_strategy(parameters['strategy'])
     available_for_cross_subsidy = 0
 
     for region in regions:
@@ -40,7 +74,7 @@ def assess(country, regions, parameters, country_parameters, timesteps):
             parameters, timesteps)
 
         # npv spectrum cost
-        region['spectrum_cost'] = get_spectrum_costs(region, parameters['strategy'],
+        region['spectrum_cost'] = get_spectrum_costs(region, strategy,
             parameters, country_parameters)
 
         #tax on investment
@@ -86,6 +120,119 @@ def assess(country, regions, parameters, country_parameters, timesteps):
     return output
 
 
+def assess_frame(country, regions, parameters, country_parameters, timesteps,
+    spectrum_cost=None):
+    """
+    Columnar equivalent of `assess`.
+
+    Costs, excess revenue and deficits are computed as column operations.
+    The greedy cross-subsidy allocation over regions sorted by deficit is
+    a running subtraction of deficits from the capital available, which
+    is evaluated with `np.subtract.accumulate` in the same order (and so
+    with the same floating point results) as `estimate_subsidies`.
+
+    Parameters
+    ----------
+    country : dict
+        Country information.
+    regions : pandas DataFrame
+        Data for all regions (one row per region).
+    parameters : dict
+        All global model parameters.
+    country_parameters : dict
+        All country specific parameters.
+    timesteps : list
+        All years for the assessment period.
+    spectrum_cost : pandas Series
+        The spectrum cost of each region, by region index, if already
+        found (e.g. once for all parameter sets with the same generation
+        and spectrum cost option, by `batch.run_batch`).
+
+    Returns
+    -------
+    output : pandas DataFrame
+        All regions with the metrics `assess` adds, sorted by deficit.
+
+    """
+    regions = regions.copy()
+
+    strategy = parse_strategy(parameters['strategy'])
+    financials = country_parameters['financials']
+
+    network_cost = regions['mno_network_cost'].to_numpy()
+
+    # add administration cost
+    annual_cost = (network_cost *
+        (financials['administration_percentage_of_network_cost'] / 100))
+    administration = 0
+    for timestep in timesteps:
+        administration = administration + discount_admin_cost(
+            annual_cost, timestep - 2020, parameters)
+    regions['administration'] = administration
+
+    # npv spectrum cost
+    if spectrum_cost is None:
+        spectrum_cost = get_spectrum_cost_array(
+            regions['population'].to_numpy(), strategy, country_parameters)
+    regions['spectrum_cost'] = spectrum_cost
+
+    #tax on investment
+    tax_rate = financials['tax_{}'.format(strategy.tax)]
+    regions['tax'] = network_cost * (tax_rate / 100)
+
+    #profit margin value calculated on all costs + taxes
+    regions['profit_margin'] = (
+        regions['mno_network_cost'] +
+        regions['administration'] +
+        regions['spectrum_cost'] +
+        regions['tax']
+    ) * (financials['profit_margin'] / 100)
+
+    regions['total_mno_cost'] = (
+        regions['mno_network_cost'] +
+        regions['administration'] +
+        regions['spectrum_cost'] +
+        regions['tax'] +
+        regions['profit_margin']
+    )
+
+    total_mno_cost = regions['total_mno_cost'].to_numpy()
+    smartphones = regions['smartphones_on_network'].to_numpy()
+
+    #avoid zero division
+    valid = (total_mno_cost > 0) & (smartphones > 0)
+    regions['cost_per_sp_user'] = np.where(valid,
+        total_mno_cost / np.where(valid, smartphones, 1), 0)
+
+    difference = (regions['total_mno_revenue'] - regions['total_mno_cost']).to_numpy()
+    regions['available_cross_subsidy'] = np.where(difference > 0, difference, 0)
+    regions['deficit'] = np.where(difference > 0, 0, np.abs(difference))
+
+    #summed in region order, as in the dict path
+    available_for_cross_subsidy = np.cumsum(
+        np.concatenate([[0], regions['available_cross_subsidy'].to_numpy()]))[-1]
+
+    regions = regions.sort_values('deficit', kind='stable').reset_index(drop=True)
+
+    deficit = regions['deficit'].to_numpy()
+    has_deficit = deficit > 0
+
+    #capital still available when each region is reached
+    available = np.subtract.accumulate(np.concatenate([
+        [available_for_cross_subsidy], np.where(has_deficit, deficit, 0)]))[:-1]
+
+    regions['used_cross_subsidy'] = np.where(has_deficit,
+        np.where(available >= deficit, deficit, np.where(available > 0, available, 0)),
+        0)
+
+    required_state_subsidy = (regions['total_mno_cost'] -
+        (regions['total_mno_revenue'] + regions['used_cross_subsidy'])).to_numpy()
+    regions['required_state_subsidy'] = np.where(
+        required_state_subsidy > 0, required_state_subsidy, 0)
+
+    return calculate_total_market_costs_frame(regions, parameters, country_parameters)
+
+
 def get_administration_cost(region, country_parameters, parameters, timesteps):
     """
     There is an annual administration cost to deploying and operating all assets.
@@ -145,10 +292,10 @@ def get_spectrum_costs(region, strategy, parameters, country_parameters):
     """
     population = int(round(region['population']))
     frequencies = country_parameters['frequencies']
-    generation = strategy.split('_')[0]
-    frequencies = frequencies[generation]
+    strategy = parse_strategy(strategy)
+    frequencies = frequencies[strategy.generation]
 
-    spectrum_cost = strategy.split('_')[5]
+    spectrum_cost = strategy.spectrum
 
     coverage_spectrum_cost = 'spectrum_coverage_baseline_usd_mhz_pop'
     capacity_spectrum_cost = 'spectrum_capacity_baseline_usd_mhz_pop'
@@ -190,13 +337,52 @@ def get_spectrum_costs(region, strategy, parameters, country_parameters):
     return sum(all_costs)
 
 
+def get_spectrum_cost_array(population, strategy, country_parameters):
+    """
+    Calculate spectrum costs for an array of regional populations.
+
+    """
+    population = np.round(population)
+    frequencies = country_parameters['frequencies']
+    strategy = parse_strategy(strategy)
+    frequencies = frequencies[strategy.generation]
+
+    spectrum_cost = strategy.spectrum
+
+    coverage_cost_usd_mhz_pop = country_parameters['financials'][
+        'spectrum_coverage_baseline_usd_mhz_pop']
+    capacity_cost_usd_mhz_pop = country_parameters['financials'][
+        'spectrum_capacity_baseline_usd_mhz_pop']
+
+    if spectrum_cost in ('low', 'high'):
+        factor = country_parameters['financials']['spectrum_cost_{}'.format(spectrum_cost)] / 100
+        coverage_cost_usd_mhz_pop = coverage_cost_usd_mhz_pop * factor
+        capacity_cost_usd_mhz_pop = capacity_cost_usd_mhz_pop * factor
+
+    all_costs = 0
+
+    for frequency in frequencies:
+
+        channel_number = int(frequency['bandwidth'].split('x')[0])
+        channel_bandwidth = int(frequency['bandwidth'].split('x')[1])
+        bandwidth_total = channel_number * channel_bandwidth
+
+        if frequency['frequency'] < 1000:
+            cost_usd_mhz_pop = coverage_cost_usd_mhz_pop
+        else:
+            cost_usd_mhz_pop = capacity_cost_usd_mhz_pop
+
+        all_costs = all_costs + cost_usd_mhz_pop * bandwidth_total * population
+
+    return all_costs
+
+
 def calculate_tax(region, strategy, country_parameters):
     """
     Calculate tax.
 
     """
-    tax_rate = strategy.split('_')[6]
-    tax_rate = 'tax_{}'.format(tax_rate)
+    tax_rate = 'tax_{}'.format(parse_strategy(strategy).tax)
 
     tax_rate = country_parameters['financials'][tax_rate]
 
@@ -319,36 +505,41 @@ def calculate_total_market_costs(regions, parameters, country_parameters):
 
         ms = 100 / networks
 
-        region['total_phones'] = calc(region, 'phones_on_network', ms)
-        region['total_smartphones'] = calc(region, 'smartphones_on_network', ms)
-        region['total_market_revenue'] = calc(region, 'total_mno_revenue', ms)
-        region['total_upgraded_sites'] = calc(region, 'upgraded_mno_sites', ms)
-        region['total_new_sites'] = calc(region, 'new_mno_sites', ms)
-        region['total_ran_capex'] = calc(region, 'ran_capex', ms)
-        region['total_ran_opex'] = calc(region, 'ran_opex', ms)
-        region['total_backhaul_capex'] = calc(region, 'backhaul_capex', ms)
-        region['total_backhaul_opex'] = calc(region, 'backhaul_opex', ms)
-        region['total_civils_capex'] = calc(region, 'civils_capex', ms)
-        region['total_core_capex'] = calc(region, 'core_capex', ms)
-        region['total_core_opex'] = calc(region, 'core_opex', ms)
-        region['total_network_cost'] = calc(region, 'mno_network_cost', ms)
-        region['total_network_capex'] = calc(region, 'mno_network_capex', ms)
-        region['total_network_opex'] = calc(region, 'mno_network_opex', ms)
-        region['total_administration'] = calc(region, 'administration', ms)
-        region['total_spectrum_cost'] = calc(region, 'spectrum_cost', ms)
-        region['total_tax'] = calc(region, 'tax', ms)
-        region['total_profit_margin'] = calc(region, 'profit_margin', ms)
-        region['total_market_cost'] = calc(region, 'total_mno_cost', ms)
-        region['total_available_cross_subsidy'] = calc(region, 'available_cross_subsidy', ms)
-        region['total_deficit'] = calc(region, 'deficit', ms)
-        region['total_used_cross_subsidy'] = calc(region, 'used_cross_subsidy', ms)
-        region['total_required_state_subsidy'] = calc(region, 'required_state_subsidy', ms)
+        for total_metric, metric in TOTAL_MARKET_METRICS:
+            region[total_metric] = calc(region, metric, ms)
 
         output.append(region)
 
     return output
 
 
+def calculate_total_market_costs_frame(regions, parameters, country_parameters):
+    """
+    Columnar equivalent of `calculate_total_market_costs`.
+
+    """
+    networks = lookup_geotype_classes(get_geotype_classes(regions),
+        lambda g: country_parameters['networks']['baseline' + '_' + g])
+
+    ms = 100 / networks
+
+    totals = {}
+
+    for total_metric, metric in TOTAL_MARKET_METRICS:
+        if metric in regions:
+            #metrics missing for a region are zero, as in `calc`
+            totals[total_metric] = np.round(
+                (regions[metric].fillna(0).to_numpy() / ms) * 100)
+        else:
+            totals[total_metric] = 0
+
+    #added together, rather than one column at a time
+    return pd.concat([
+        regions.drop(columns=[key for key in totals if key in regions]),
+        pd.DataFrame(totals, index=regions.index)
+    ], axis=1)
+
+
 def calc(region, metric, ms):
     """
     """
@@ -0,0 +1,182 @@
+"""
+Batch Module
+
+Run demand, supply and assessment for many parameter sets in one call.
+
+"""
+import pandas as pd
+
+from podis.demand import estimate_demand_frame, get_geotype_classes, get_arpu
+from podis.supply import estimate_sites_frame, label_supply_frame
+from podis.costs import find_network_cost_frame, find_node_lookups, NODE_COLUMNS
+from podis.assess import assess_frame, get_spectrum_cost_array
+from podis.strategy import parse_strategy
+
+#Region columns which do not depend on the parameters, added by
+#prepare_regions and used by each stage when present.
+REGION_COLUMNS = ['geotype_class', 'arpu'] + NODE_COLUMNS
+
+
+def prepare_regions(regions, country_parameters, core_lut):
+    """
+    Prepare regions to be run for many parameter sets.
+
+    Regions without an area are removed, and the region columns which do
+    not depend on the parameters (`REGION_COLUMNS`: the settlement type,
+    ARPU tier and core and regional node lookups) are added once.
+
+    Parameters
+    ----------
+    regions : pandas DataFrame
+        Data for all regions (one row per region), as from `load_regions`.
+    country_parameters : dict
+        All country specific parameters.
+    core_lut : dict
+        Contains the number of existing and required, core and regional assets.
+
+    Returns
+    -------
+    regions : pandas DataFrame
+        Data for all regions with an area, with the `REGION_COLUMNS`.
+
+    """
+    regions = regions.loc[regions['area_km2'] > 0].reset_index(drop=True)
+
+    regions['geotype_class'] = get_geotype_classes(regions)
+    regions['arpu'] = get_arpu(regions, country_parameters)
+
+    nodes = find_node_lookups(regions, core_lut)
+    for column in NODE_COLUMNS:
+        regions[column] = nodes[column]
+
+    return regions
+
+
+def run_batch(country, regions, parameter_table, country_parameters,
+    timesteps, penetration_luts, smartphone_luts, capacity_lut, core_lut):
+    """
+    Run demand, supply and assessment for every row of a parameter table.
+
+    Work which does not depend on the parameters is carried out once for
+    all rows, by `prepare_regions`. Work which only depends on some of the
+    parameters is carried out once for each distinct combination of them,
+    and shared by all rows using it (e.g. all input cost variants in the
+    `uq.generate_uq` grid):
+
+        - demand depends on the scenario, the network strategy, the
+          discount rate and the busy hour traffic.
+        - site and backhaul upgrades depend on the demand, the generation
+          and backhaul of the strategy and the confidence interval.
+        - spectrum costs depend on the generation and the spectrum cost
+          option of the strategy.
+
+    Network costs and the assessment are found for each row, as column
+    operations over all regions.
+
+    Parameters
+    ----------
+    country : dict
+        Country information.
+    regions : pandas DataFrame
+        Data for all regions (one row per region), as from `load_regions`.
+    parameter_table : pandas DataFrame
+        One row of model parameters per parameter set.
+    country_parameters : dict
+        All country specific parameters.
+    timesteps : list
+        All years for the assessment period.
+    penetration_luts : dict
+        Annual cell phone penetration values, for each scenario.
+    smartphone_luts : dict
+        Annual smartphone penetration values, for each scenario.
+    capacity_lut : dict
+        A dictionary containing the lookup capacities.
+    core_lut : dict
+        Contains the number of existing and required, core and regional assets.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        Regional results for all parameter sets, stacked in the order of
+        `parameter_table`. The `parameter_set` column holds the index of
+        the parameter row.
+
+    """
+    regions = prepare_regions(regions, country_parameters, core_lut)
+
+    demand = {}
+    sites = {}
+    spectrum = {}
+    results = []
+
+    for idx, parameters in parameter_table.iterrows():
+
+        parameters = parameters.to_dict()
+        strategy = parse_strategy(parameters['strategy'])
+
+        demand_key = (
+            str(parameters['scenario']),
+            strategy.networks,
+            parameters['discount_rate'],
+            parameters['traffic_in_the_busy_hour_perc'],
+        )
+
+        if demand_key not in demand:
+            demand[demand_key], annual_demand = estimate_demand_frame(
+                regions,
+                parameters,
+                country_parameters,
+                timesteps,
+                penetration_luts[str(parameters['scenario'])],
+                smartphone_luts[str(parameters['scenario'])]
+            )
+
+        sites_key = demand_key + (
+            strategy.generation,
+            strategy.backhaul,
+            parameters['confidence'],
+            parameters.get('tdd_dl_to_ul'),
+        )
+
+        if sites_key not in sites:
+            sites[sites_key] = estimate_sites_frame(
+                demand[demand_key],
+                capacity_lut,
+                parameters,
+                country_parameters
+            )
+
+        data_supply = find_network_cost_frame(
+            sites[sites_key],
+            parameters,
+            country_parameters,
+            core_lut
+        )
+
+        data_supply = label_supply_frame(data_supply, parameters)
+
+        spectrum_key = (strategy.generation, strategy.spectrum)
+
+        if spectrum_key not in spectrum:
+            spectrum[spectrum_key] = pd.Series(get_spectrum_cost_array(
+                data_supply['population'].to_numpy(),
+                strategy,
+                country_parameters
+            ), index=data_supply.index)
+
+        data_assess = assess_frame(
+            country,
+            data_supply,
+            parameters,
+            country_parameters,
+            timesteps,
+            spectrum_cost=spectrum[spectrum_key]
+        )
+
+        data_assess = data_assess.drop(columns=REGION_COLUMNS)
+
+        data_assess.insert(0, 'parameter_set', idx)
+
+        results.append(data_assess)
+
+    return pd.concat(results, ignore_index=True)
@@ -11,8 +11,46 @@ import math
 from itertools import tee
 import collections, functools, operator
 
+import numpy as np
+import pandas as pd
+
+from podis.demand import get_geotype_classes, lookup_geotype_classes
+from podis.strategy import parse_strategy
+
+#Cost categories found by calc_costs, in the order they are summed.
+COST_CATEGORIES = [
+    'ran_capex', 'ran_opex', 'backhaul_capex', 'backhaul_opex',
+    'civils_capex', 'core_capex', 'core_opex',
+]
+
+#Cost category of each asset.
+ASSET_CATEGORIES = {
+    'equipment_capex': 'ran_capex',
+    'site_rental_opex': 'ran_opex',
+    'operation_and_maintenance_opex': 'ran_opex',
+    'power_opex': 'ran_opex',
+    'backhaul_capex': 'backhaul_capex',
+    'backhaul_opex': 'backhaul_opex',
+    'site_build_capex': 'civils_capex',
+    'installation_capex': 'civils_capex',
+    'core_edge_capex': 'core_capex',
+    'core_node_capex': 'core_capex',
+    'regional_edge_capex': 'core_capex',
+    'regional_node_capex': 'core_capex',
+    'core_edge_opex': 'core_opex',
+    'core_node_opex': 'core_opex',
+    'regional_edge_opex': 'core_opex',
+    'regional_node_opex': 'core_opex',
+}
+
+#Region columns found by find_node_lookups.
+NODE_COLUMNS = [
+    'core_edge_new', 'core_node_new', 'regional_edge_new',
+    'regional_node_new', 'node_distance_m',
+]
+
 def find_network_cost(region, parameters,
-    country_parameters, core_lut):
+    country_parameters, core_lut, aggregate=True):
     """
     Calculates the annual total cost using capex and opex.
 
@@ -26,6 +64,14 @@ def find_network_cost(region, parameters,
         Contains all country parameters.
     backhaul_lut : dict
         Backhaul distance by region.
+    aggregate : bool
+        If True (default), each class of site (upgraded or greenfield, with
+        or without new backhaul) is costed once, and the per-site cost is
+        repeated for each site in that class and summed sequentially, site
+        by site, with a cumulative sum. Multiplying by the number of sites
+        would round differently from adding one site at a time, so summing
+        in the same order keeps the totals exactly equal to the per-site
+        results. If False, every site is costed individually.
 
     Returns
     -------
@@ -34,8 +80,379 @@ def find_network_cost(region, parameters,
         opex costs.
 
     """
-    strategy = parameters['strategy']
-    generation = strategy.split('_')[0]
+    if aggregate:
+        site_class_costs = aggregate_site_costs(region, parameters,
+            country_parameters, core_lut)
+        all_costs = sum_site_class_costs(site_class_costs)
+    else:
+        regional_asset_cost = per_site_costs(region, parameters,
+            country_parameters, core_lut)
+        counter = collections.Counter()
+        for d in regional_asset_cost:
+            counter.update(d)
+        all_costs = dict(counter)
+
+    capex = 0
+    opex = 0
+    network_cost = 0
+    for k, v in all_costs.items():
+
+        region[k] = v
+        network_cost += v
+
+        cost_type = k.rsplit('_')[-1]
+
+        if cost_type == 'capex':
+            capex += v
+        elif cost_type == 'opex':
+            opex += v
+        else:
+            print('Did not recognize cost type')
+
+    region['mno_network_cost'] = network_cost
+    region['mno_network_capex'] = capex
+    region['mno_network_opex'] = opex
+
+    return region
+
+
+def find_network_cost_frame(regions, parameters, country_parameters, core_lut):
+    """
+    Columnar equivalent of `find_network_cost`.
+
+    Each class of site is costed for all regions at once, and the
+    per-site costs are summed site by site, in the same order as
+    `sum_site_class_costs`, so the totals match `find_network_cost`
+    exactly.
+
+    Parameters
+    ----------
+    regions : pandas DataFrame
+        Data for all regions (one row per region), with site and backhaul
+        upgrades. The node columns of `find_node_lookups` are used when
+        present (e.g. found once for many parameter sets).
+    parameters : dict
+        Contains all parameters.
+    country_parameters : dict
+        All country specific parameters.
+    core_lut : dict
+        Contains the number of existing and required, core and regional assets.
+
+    Returns
+    -------
+    regions : pandas DataFrame
+        Data for all regions, with the costs `find_network_cost` adds.
+        Asset costs are missing (NaN) for regions with no sites to cost.
+
+    """
+    strategy = parse_strategy(parameters['strategy'])
+
+    upgraded_sites = regions['upgraded_mno_sites'].to_numpy(dtype=float)
+    new_sites = regions['new_mno_sites'].to_numpy(dtype=float)
+
+    network_cost = np.zeros(len(regions))
+    capex = np.zeros(len(regions))
+    opex = np.zeros(len(regions))
+
+    output = {}
+
+    if strategy.generation in ('3G', '4G'):
+
+        if set(NODE_COLUMNS) <= set(regions.columns):
+            nodes = regions[NODE_COLUMNS]
+        else:
+            nodes = find_node_lookups(regions, core_lut)
+
+        geotype = get_geotype_classes(regions).to_numpy()
+
+        networks = lookup_geotype_classes(geotype,
+            lambda g: country_parameters['networks']['baseline' + '_' + g])
+
+        site_classes = count_site_classes_array(upgraded_sites,
+            new_sites + upgraded_sites, regions['backhaul_new'].to_numpy())
+
+        totals = np.zeros((len(COST_CATEGORIES), len(regions)))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for upgraded, backhaul_quant, quantity in site_classes:
+
+                if not (quantity > 0).any():
+                    continue
+
+                costs = site_class_cost_array(regions, nodes, geotype,
+                    networks, strategy, upgraded, backhaul_quant, parameters,
+                    country_parameters)
+
+                #summed one site at a time, as np.cumsum in sum_site_class_costs
+                for site in range(int(quantity.max())):
+                    more = quantity > site
+                    totals = np.where(more, totals + costs, totals)
+
+        #regions with no sites are not costed, as in find_network_cost
+        costed = sum(quantity for _, _, quantity in site_classes) > 0
+
+        for key, total in zip(COST_CATEGORIES, totals):
+
+            output[key] = np.where(costed, total, np.nan)
+
+            network_cost = network_cost + np.where(costed, total, 0)
+
+            if key.rsplit('_')[-1] == 'capex':
+                capex = capex + np.where(costed, total, 0)
+            else:
+                opex = opex + np.where(costed, total, 0)
+
+    output['mno_network_cost'] = network_cost
+    output['mno_network_capex'] = capex
+    output['mno_network_opex'] = opex
+
+    #added together, rather than one column at a time
+    return pd.concat([
+        regions.drop(columns=[key for key in output if key in regions]),
+        pd.DataFrame(output, index=regions.index)
+    ], axis=1)
+
+
+def find_node_lookups(regions, core_lut):
+    """
+    Look up the new core and regional assets of each region, and the
+    average distance from a site to a core or regional node.
+
+    These only depend on the region, so can be found once for many
+    parameter sets.
+
+    Parameters
+    ----------
+    regions : pandas DataFrame
+        Data for all regions (one row per region).
+    core_lut : dict
+        Contains the number of existing and required, core and regional assets.
+
+    Returns
+    -------
+    nodes : pandas DataFrame
+        The `NODE_COLUMNS` of each region, with NaN for assets missing
+        from the lut.
+
+    """
+    gid_ids = regions['GID_id'].to_numpy()
+
+    def lookup(asset_type, age):
+        values = core_lut.get(asset_type, {})
+        return np.array([values.get('{}_{}'.format(gid_id, age), np.nan)
+            for gid_id in gid_ids], dtype=float)
+
+    nodes = 0
+    for asset_type in ['core_node', 'regional_node']:
+        for age in ['new', 'existing']:
+            nodes = nodes + lookup(asset_type, age)
+
+    area_km2 = regions['area_km2'].to_numpy(dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        node_density_km2 = nodes / area_km2
+        node_distance_m = np.where(node_density_km2 > 0,
+            (np.sqrt(1 / node_density_km2) / 2) * 1000,
+            np.round(np.sqrt(area_km2) * 1000))
+
+    return pd.DataFrame({
+        'core_edge_new': lookup('core_edge', 'new'),
+        'core_node_new': lookup('core_node', 'new'),
+        'regional_edge_new': lookup('regional_edge', 'new'),
+        'regional_node_new': lookup('regional_node', 'new'),
+        'node_distance_m': node_distance_m,
+    }, index=regions.index)
+
+
+def count_site_classes_array(upgraded_sites, all_sites, new_backhaul):
+    """
+    Vectorized equivalent of `count_site_classes`.
+
+    """
+    all_sites = np.trunc(all_sites)
+
+    upgraded = np.minimum(all_sites, np.maximum(0, np.floor(upgraded_sites)))
+    backhaul = np.minimum(all_sites, np.maximum(0, np.floor(new_backhaul)))
+
+    upgraded_with_backhaul = np.minimum(upgraded, backhaul)
+    greenfield_with_backhaul = np.maximum(0, backhaul - upgraded)
+
+    return [
+        (True, 1, upgraded_with_backhaul),
+        (True, 0, upgraded - upgraded_with_backhaul),
+        (False, 1, greenfield_with_backhaul),
+        (False, 0, all_sites - upgraded - greenfield_with_backhaul),
+    ]
+
+
+def site_class_cost_array(regions, nodes, geotype, networks, strategy,
+    upgraded, backhaul_quant, parameters, country_parameters):
+    """
+    Cost a single site of one class in every region.
+
+    Vectorized equivalent of the cost structures of `upgrade_to_3g`,
+    `upgrade_to_4g`, `greenfield_3g` and `greenfield_4g`, costed by
+    `calc_costs`.
+
+    Returns
+    -------
+    costs : numpy array
+        The cost of each of the `COST_CATEGORIES` (rows) for each region
+        (columns).
+
+    """
+    generation = strategy.generation
+    backhaul = strategy.backhaul
+    sharing = strategy.sharing
+    core = strategy.core
+
+    all_sites = (regions['upgraded_mno_sites'] +
+        regions['new_mno_sites']).to_numpy(dtype=float)
+    sites = all_sites / networks
+
+    core_edge_capex = np.where(np.isnan(nodes['core_edge_new'].to_numpy()), 0,
+        per_site_core_cost(np.trunc(nodes['core_edge_new'].to_numpy() *
+            parameters['core_edge_capex']), sites, False))
+
+    #greenfield_3g looks up core nodes with its arguments swapped, so finds none
+    if generation == '3G' and not upgraded:
+        core_node_capex = np.zeros(len(regions))
+    else:
+        core_node_capex = np.where(
+            np.isnan(nodes['core_node_new'].to_numpy()), 0,
+            per_site_core_cost(np.trunc(nodes['core_node_new'].to_numpy() *
+                parameters['core_node_{}_capex'.format(core)]), sites, False))
+
+    regional_edge_capex = np.where(
+        np.isnan(nodes['regional_edge_new'].to_numpy()), 0,
+        per_site_core_cost(np.trunc(nodes['regional_edge_new'].to_numpy() *
+            parameters['regional_edge_capex']), sites, True))
+
+    regional_node_capex = np.where(
+        np.isnan(nodes['regional_node_new'].to_numpy()), 0,
+        per_site_core_cost(np.trunc(nodes['regional_node_new'].to_numpy() *
+            parameters['regional_node_{}_capex'.format(core)]), sites, False))
+
+    if generation == '3G' and not upgraded:
+        opex_share = int(parameters['opex_percentage_of_capex']) / 100
+    else:
+        opex_share = parameters['opex_percentage_of_capex'] / 100
+
+    distance = nodes['node_distance_m'].to_numpy()
+
+    if backhaul == 'wireless':
+        backhaul_capex = np.select(
+            [distance < 15000, (15000 < distance) & (distance < 30000)],
+            [parameters['wireless_small_capex'], parameters['wireless_medium_capex']],
+            parameters['wireless_large_capex'] * (distance / 30000))
+    elif backhaul == 'fiber':
+        cost_per_meter = lookup_geotype_classes(geotype,
+            lambda g: parameters['fiber_{}_m_capex'.format(g)])
+        backhaul_capex = cost_per_meter * distance
+    else:
+        backhaul_capex = np.zeros(len(regions))
+
+    site_rental_opex = lookup_geotype_classes(geotype,
+        lambda g: parameters['site_rental_{}_opex'.format(g)])
+
+    ###provides a single year of costs for the first year of assessment
+    assets = [
+        ('equipment_capex', parameters['equipment_capex']),
+        ('installation_capex', parameters['installation_capex']),
+    ]
+    if not upgraded:
+        assets.append(('site_build_capex', parameters['site_build_capex']))
+    assets += [
+        ('site_rental_opex', site_rental_opex),
+        ('operation_and_maintenance_opex', parameters['operation_and_maintenance_opex']),
+        ('power_opex', parameters['power_opex']),
+        ('backhaul_capex', backhaul_capex),
+        ('backhaul_opex', 0),
+        ('core_edge_capex', core_edge_capex),
+        ('core_node_capex', core_node_capex),
+        ('regional_edge_capex', regional_edge_capex),
+        ('regional_node_capex', regional_node_capex),
+        ('core_edge_opex', core_edge_capex * opex_share),
+        ('core_node_opex', core_node_capex * opex_share),
+        ('regional_edge_opex', regional_edge_capex * opex_share),
+    ]
+    if upgraded or generation == '4G':
+        assets.append(('regional_node_opex', regional_node_capex * opex_share))
+
+    shared_assets = INFRA_SHARING_ASSETS[sharing]
+
+    #srn only shares assets outside urban and suburban areas
+    unshared = np.isin(geotype, ['urban', 'suburban'])
+
+    wacc = country_parameters['financials']['wacc']
+
+    costs = {key: 0 for key in COST_CATEGORIES}
+
+    for asset_name, cost in assets:
+
+        if asset_name in shared_assets:
+            if sharing == 'srn':
+                cost = np.where(unshared, cost, cost / networks)
+            else:
+                cost = cost / networks
+
+        if 'backhaul' in asset_name and backhaul_quant == 0:
+            continue
+
+        if 'regional_node' in asset_name and backhaul == 'wireless':
+            continue
+
+        if 'regional_edge' in asset_name and backhaul == 'wireless':
+            continue
+
+        type_of_cost = asset_name.rsplit('_')[-1]
+
+        if asset_name in [
+            'core_edge_capex', 'core_node_capex',
+            'regional_edge_capex', 'regional_node_capex',
+            'core_edge_opex', 'core_node_opex',
+            'regional_edge_opex', 'regional_node_opex',
+            ]:
+            cost = cost / all_sites
+
+        if type_of_cost == 'capex':
+            cost = cost * (1 + (wacc / 100))
+        else:
+            cost = discount_opex_array(cost, parameters, country_parameters)
+
+        category = ASSET_CATEGORIES[asset_name]
+        costs[category] = costs[category] + cost
+
+    return np.array([np.broadcast_to(costs[key], len(regions))
+        for key in COST_CATEGORIES], dtype=float)
+
+
+def per_site_core_cost(cost, sites, regional_edge):
+    """
+    Share the cost of new core or regional assets across sites, as in
+    `core_capex` and `regional_net_capex`.
+
+    """
+    if regional_edge:
+        #regional edges are scaled by the sites where there is one or fewer
+        return np.where(sites == 0, 0, np.where(sites <= 1, cost * sites,
+            cost / sites))
+
+    return np.where(sites == 0, 0, np.where(sites <= 1, cost, cost / sites))
+
+
+def per_site_costs(region, parameters, country_parameters, core_lut):
+    """
+    Cost every site in the region individually.
+
+    Returns
+    -------
+    regional_asset_cost : list of dicts
+        The cost by asset for each site.
+
+    """
+    strategy = parse_strategy(parameters['strategy'])
+    generation = strategy.generation
 
     new_sites = region['new_mno_sites']
     upgraded_sites = region['upgraded_mno_sites']
@@ -97,34 +514,121 @@ def find_network_cost(region, parameters,
 
             regional_asset_cost.append(cost_by_asset)
 
+    return regional_asset_cost
 
-    counter = collections.Counter()
-    for d in regional_asset_cost:
-        counter.update(d)
-    all_costs = dict(counter)
 
-    capex = 0
-    opex = 0
-    network_cost = 0
-    for k, v in all_costs.items():
+def aggregate_site_costs(region, parameters, country_parameters, core_lut):
+    """
+    Cost each class of site once.
 
-        region[k] = v
-        network_cost += v
+    All sites of a class share the same cost structure, so each class
+    only needs costing once, rather than once per site.
 
-        cost_type = k.rsplit('_')[-1]
+    Returns
+    -------
+    site_class_costs : list of tuples
+        The cost by asset for a single site of each class, and the
+        number of sites in that class.
 
-        if cost_type == 'capex':
-            capex += v
-        elif cost_type == 'opex':
-            opex += v
+    """
+    strategy = parse_strategy(parameters['strategy'])
+    generation = strategy.generation
+
+    if generation == '3G':
+        upgrade, greenfield = upgrade_to_3g, greenfield_3g
+    elif generation == '4G':
+        upgrade, greenfield = upgrade_to_4g, greenfield_4g
+    else:
+        return []
+
+    site_classes = count_site_classes(
+        region['upgraded_mno_sites'],
+        region['new_mno_sites'] + region['upgraded_mno_sites'],
+        region['backhaul_new']
+    )
+
+    site_class_costs = []
+
+    for upgraded, backhaul_quant, quantity in site_classes:
+
+        if quantity == 0:
+            continue
+
+        if upgraded:
+            cost_structure = upgrade(region, strategy,
+                parameters, core_lut, country_parameters)
         else:
-            print('Did not recognize cost type')
+            cost_structure = greenfield(region, strategy,
+                parameters, core_lut, country_parameters)
 
-    region['mno_network_cost'] = network_cost
-    region['mno_network_capex'] = capex
-    region['mno_network_opex'] = opex
+        total_cost, cost_by_asset = calc_costs(region, strategy, cost_structure,
+            backhaul_quant, parameters, country_parameters)
 
-    return region
+        site_class_costs.append((cost_by_asset, quantity))
+
+    return site_class_costs
+
+
+def sum_site_class_costs(site_class_costs):
+    """
+    Sum the cost of each asset over all sites.
+
+    The costs are added site by site in the same order as the per-site
+    loop (np.cumsum adds sequentially), so the totals match it exactly.
+
+    Parameters
+    ----------
+    site_class_costs : list of tuples
+        The cost by asset for a single site of each class, and the
+        number of sites in that class.
+
+    Returns
+    -------
+    all_costs : dict
+        Total cost by asset.
+
+    """
+    all_costs = {}
+
+    if len(site_class_costs) == 0:
+        return all_costs
+
+    quantities = [quantity for cost_by_asset, quantity in site_class_costs]
+
+    for key in site_class_costs[0][0].keys():
+        costs = [cost_by_asset[key] for cost_by_asset, quantity in site_class_costs]
+        all_costs[key] = float(np.cumsum(np.repeat(costs, quantities))[-1])
+
+    return all_costs
+
+
+def count_site_classes(upgraded_sites, all_sites, new_backhaul):
+    """
+    Count the sites in each class, in the order they are costed.
+
+    Sites are numbered 1..int(all_sites). Site i is an upgrade if
+    i <= upgraded_sites, and receives new backhaul if i <= new_backhaul.
+
+    Returns
+    -------
+    site_classes : list of tuples
+        (upgraded, backhaul_quantity, number_of_sites) for each class.
+
+    """
+    all_sites = int(all_sites)
+
+    upgraded = min(all_sites, max(0, math.floor(upgraded_sites)))
+    backhaul = min(all_sites, max(0, math.floor(new_backhaul)))
+
+    upgraded_with_backhaul = min(upgraded, backhaul)
+    greenfield_with_backhaul = max(0, backhaul - upgraded)
+
+    return [
+        (True, 1, upgraded_with_backhaul),
+        (True, 0, upgraded - upgraded_with_backhaul),
+        (False, 1, greenfield_with_backhaul),
+        (False, 0, all_sites - upgraded - greenfield_with_backhaul),
+    ]
 
 
 def backhaul_quantity(i, new_backhaul):
@@ -141,8 +645,9 @@ def upgrade_to_3g(region, strategy, parameters,
     network.
     '4G_epc_wireless_moran_baseline_baseline_baseline_baseline',
     """
-    backhaul = '{}_backhaul'.format(strategy.split('_')[2])
-    sharing = strategy.split('_')[3]
+    strategy = parse_strategy(strategy)
+    backhaul = '{}_backhaul'.format(strategy.backhaul)
+    sharing = strategy.sharing
     geotype = region['geotype'].split(' ')[0]
 
     net_handle = 'baseline' + '_' + geotype
@@ -198,8 +703,9 @@ def upgrade_to_4g(region, strategy, parameters,
     network.
 
     """
-    backhaul = '{}_backhaul'.format(strategy.split('_')[2])
-    sharing = strategy.split('_')[3]
+    strategy = parse_strategy(strategy)
+    backhaul = '{}_backhaul'.format(strategy.backhaul)
+    sharing = strategy.sharing
     geotype = region['geotype'].split(' ')[0]
 
     net_handle = 'baseline' + '_' + geotype
@@ -254,8 +760,9 @@ def greenfield_3g(region, strategy, parameters,
     Build a greenfield 3G asset.
 
     """
-    backhaul = '{}_backhaul'.format(strategy.split('_')[2])
-    sharing = strategy.split('_')[3]
+    strategy = parse_strategy(strategy)
+    backhaul = '{}_backhaul'.format(strategy.backhaul)
+    sharing = strategy.sharing
     geotype = region['geotype'].split(' ')[0]
 
     net_handle = 'baseline' + '_' + geotype
@@ -311,8 +818,9 @@ def greenfield_4g(region, strategy, parameters,
     Build a greenfield 4G asset.
 
     """
-    backhaul = '{}_backhaul'.format(strategy.split('_')[2])
-    sharing = strategy.split('_')[3]
+    strategy = parse_strategy(strategy)
+    backhaul = '{}_backhaul'.format(strategy.backhaul)
+    sharing = strategy.sharing
     geotype = region['geotype'].split(' ')[0]
 
     net_handle = 'baseline' + '_' + geotype
@@ -410,7 +918,7 @@ def regional_net_capex(region, asset_type, costs, core_lut, strategy, country_pa
     """
     Return regional asset costs for only the 'new' assets that have been planned.
     """
-    core = strategy.split('_')[1]
+    core = parse_strategy(strategy).core
     geotype = region['geotype'].split(' ')[0]
 
     networks = country_parameters['networks']['baseline' + '_' + geotype]
@@ -463,7 +971,7 @@ def core_capex(region, asset_type, parameters, core_lut, strategy, country_param
     Return core asset costs for only the 'new' assets that have been planned.
 
     """
-    core = strategy.split('_')[1]
+    core = parse_strategy(strategy).core
     geotype = region['geotype'].split(' ')[0]
     networks = country_parameters['networks']['baseline' + '_' + geotype]
 
@@ -530,7 +1038,7 @@ def calc_costs(region, strategy, cost_structure, backhaul_quantity,
     """
 
     """
-    backhaul = strategy.split('_')[2]
+    backhaul = parse_strategy(strategy).backhaul
 
     all_sites = region['upgraded_mno_sites'] + region['new_mno_sites']
 
@@ -657,6 +1165,28 @@ def discount_opex(opex, parameters, country_parameters):
     return discounted_cost
 
 
+def discount_opex_array(opex, parameters, country_parameters):
+    """
+    Vectorized equivalent of `discount_opex`.
+
+    """
+    return_period = parameters['return_period']
+    discount_rate = parameters['discount_rate'] / 100
+    wacc = country_parameters['financials']['wacc']
+
+    discounted_cost = 0
+
+    for i in range(0, return_period):
+        discounted_cost = discounted_cost + opex / (1 + discount_rate)**i
+
+    discounted_cost = np.round(discounted_cost)
+
+    #add wacc
+    discounted_cost = discounted_cost * (1 + (wacc/100))
+
+    return discounted_cost
+
+
 INFRA_SHARING_ASSETS = {
     'baseline': [],
     'psb': [
@@ -6,6 +6,11 @@ Written by Ed Oughton.
 Winter 2020
 
 """
+import numpy as np
+import pandas as pd
+
+from podis.strategy import parse_strategy, parse_scenario
+
 
 def estimate_demand(regions, parameters, country_parameters, timesteps,
     penetration_lut, smartphone_lut):
@@ -39,7 +44,7 @@ def estimate_demand(regions, parameters, country_parameters, timesteps,
     annual_output = []
 
     # generation_core_backhaul_sharing_networks_spectrum_tax
-    network_strategy = parameters['strategy'].split('_')[4]
+    network_strategy = parse_strategy(parameters['strategy']).networks
 
     for region in regions:
 
@@ -134,8 +139,8 @@ def estimate_demand(regions, parameters, country_parameters, timesteps,
             annual_output.append({
                 'GID_0': region['GID_0'],
                 'GID_id': region['GID_id'],
-                'scenario': parameters['scenario'],
-                'strategy': parameters['strategy'],
+                'scenario': str(parameters['scenario']),
+                'strategy': str(parameters['strategy']),
                 'input_cost': parameters['input_cost'],
                 'confidence': parameters['confidence'],
                 'year': timestep,
@@ -162,6 +167,188 @@ def estimate_demand(regions, parameters, country_parameters, timesteps,
     return output, annual_output
 
 
+def estimate_demand_frame(regions, parameters, country_parameters, timesteps,
+    penetration_lut, smartphone_lut):
+    """
+    Columnar equivalent of `estimate_demand`.
+
+    All demand metrics are computed for the whole (region x timestep)
+    matrix at once, rather than looping over regions and years.
+
+    Parameters
+    ----------
+    regions : pandas DataFrame
+        Data for all regions (one row per region), as from `load_regions`.
+        The region columns of `batch.prepare_regions` are used when present.
+    parameters : dict
+        All model parameters.
+    country_parameters : dict
+        All country specific parameters.
+    timesteps : list
+        All years for the assessment period.
+    penetration_lut : list of dicts
+        Contains annual cell phone penetration values.
+    smartphone_lut : list of dicts
+        Contains annual penetration values for smartphones.
+
+    Returns
+    -------
+    regions : pandas DataFrame
+        Data for all regions, with the same demand metrics `estimate_demand`
+        adds to each region dict (values for the final timestep).
+    annual_output : pandas DataFrame
+        One row per region and timestep, with the columns of the
+        `estimate_demand` annual output.
+
+    """
+    regions = regions.loc[regions['area_km2'] > 0].copy()
+
+    # generation_core_backhaul_sharing_networks_spectrum_tax
+    network_strategy = parse_strategy(parameters['strategy']).networks
+
+    geotype = get_geotype_classes(regions)
+
+    #smartphone lut only has urban-rural split, hence no suburban
+    geotype_sps = geotype.replace('suburban', 'urban')
+
+    networks = geotype.map({
+        g: country_parameters['networks'][network_strategy + '_' + g]
+        for g in geotype.unique()
+    }).to_numpy(dtype=float)
+
+    per_user_mbps = geotype.map({
+        g: get_per_user_capacity(g, parameters) for g in geotype.unique()
+    }).to_numpy(dtype=float)
+
+    arpu = get_arpu(regions, country_parameters)
+
+    years = np.asarray(timesteps)
+    penetration = np.array([penetration_lut[t] for t in timesteps], dtype=float)
+    sps_codes, sps_geotypes = pd.factorize(geotype_sps)
+    smartphone_penetration = np.array([
+        [smartphone_lut[g][t] for t in timesteps] for g in sps_geotypes
+    ], dtype=float).reshape(len(sps_geotypes), len(timesteps))[sps_codes]
+
+    population = regions['population'].to_numpy(dtype=float)
+    pop_under_10 = regions['pop_under_10_pop'].to_numpy(dtype=float)
+    area_km2 = regions['area_km2'].to_numpy(dtype=float)
+
+    arpu_discounted_monthly = discount_arpu(
+        arpu[:, None], (years - 2020)[None, :], parameters)
+
+    penetration = np.broadcast_to(penetration, arpu_discounted_monthly.shape)
+
+    population_with_phones = (
+        (population - pop_under_10)[:, None] * (penetration / 100))
+
+    phones_on_network = population_with_phones / networks[:, None]
+
+    population_with_smartphones = (
+        population_with_phones * (smartphone_penetration / 100))
+
+    smartphones_on_network = (
+        phones_on_network * (smartphone_penetration / 100))
+
+    demand_mbps_km2 = (
+        smartphones_on_network * per_user_mbps[:, None] / area_km2[:, None])
+
+    revenue = arpu_discounted_monthly * phones_on_network * 12
+
+    total_revenue = revenue.sum(axis=1)
+
+    regions['arpu_discounted_monthly'] = arpu_discounted_monthly[:, -1]
+    regions['penetration'] = penetration[:, -1]
+    regions['population_with_phones'] = population_with_phones[:, -1]
+    regions['phones_on_network'] = phones_on_network[:, -1]
+    regions['phone_density_on_network_km2'] = phones_on_network[:, -1] / area_km2
+    regions['smartphone_penetration'] = smartphone_penetration[:, -1]
+    regions['population_with_smartphones'] = population_with_smartphones[:, -1]
+    regions['smartphones_on_network'] = smartphones_on_network[:, -1]
+    regions['sp_density_on_network_km2'] = smartphones_on_network[:, -1] / area_km2
+    regions['demand_mbps_km2'] = demand_mbps_km2.max(axis=1)
+    regions['total_mno_revenue'] = np.round(total_revenue)
+    regions['revenue_km2'] = np.round(total_revenue / area_km2)
+
+    n_years = len(timesteps)
+
+    annual_output = pd.DataFrame({
+        'GID_0': np.repeat(regions['GID_0'].to_numpy(), n_years),
+        'GID_id': np.repeat(regions['GID_id'].to_numpy(), n_years),
+        'scenario': str(parameters['scenario']),
+        'strategy': str(parameters['strategy']),
+        'input_cost': parameters['input_cost'],
+        'confidence': parameters['confidence'],
+        'year': np.tile(years, len(regions)),
+        'population': np.repeat(population, n_years),
+        'area_km2': np.repeat(area_km2, n_years),
+        'population_km2': np.repeat(regions['population_km2'].to_numpy(), n_years),
+        'geotype': np.repeat(geotype.to_numpy(), n_years),
+        'arpu_discounted_monthly': arpu_discounted_monthly.ravel(),
+        'penetration': penetration.ravel(),
+        'population_with_phones': population_with_phones.ravel(),
+        'phones_on_network': phones_on_network.ravel(),
+        'smartphone_penetration': smartphone_penetration.ravel(),
+        'population_with_smartphones': population_with_smartphones.ravel(),
+        'smartphones_on_network': smartphones_on_network.ravel(),
+        'revenue': revenue.ravel(),
+    })
+
+    return regions, annual_output
+
+
+def get_geotype_classes(regions):
+    """
+    Get the settlement type of each region, without its density band
+    (e.g. 'rural' for 'rural 1').
+
+    Uses the `geotype_class` column when present (e.g. added once for
+    many parameter sets by `batch.prepare_regions`).
+
+    """
+    if 'geotype_class' in regions:
+        return regions['geotype_class']
+
+    return regions['geotype'].str.split(' ').str[0]
+
+
+def lookup_geotype_classes(geotype, lookup):
+    """
+    Look up a value for each region from its settlement type, calling
+    `lookup` once for each distinct settlement type.
+
+    """
+    classes, inverse = np.unique(np.asarray(geotype), return_inverse=True)
+
+    return np.array([lookup(g) for g in classes], dtype=float)[inverse]
+
+
+def get_arpu(regions, country_parameters):
+    """
+    Get the (undiscounted) ARPU of each region, from the luminosity tier
+    as in `estimate_arpu`.
+
+    Uses the `arpu` column when present (e.g. added once for many
+    parameter sets by `batch.prepare_regions`).
+
+    """
+    if 'arpu' in regions:
+        return regions['arpu'].to_numpy()
+
+    luminosity = regions['mean_luminosity_km2'].to_numpy()
+
+    return np.select(
+        [
+            luminosity > country_parameters['luminosity']['high'],
+            luminosity > country_parameters['luminosity']['medium'],
+        ],
+        [
+            country_parameters['arpu']['high'],
+            country_parameters['arpu']['medium'],
+        ],
+        country_parameters['arpu']['low']
+    )
+
+
 def get_per_user_capacity(geotype, parameters):
     """
     Function to return the target per user capacity by scenario,
@@ -184,7 +371,7 @@ def get_per_user_capacity(geotype, parameters):
     """
     if geotype.split(' ')[0] == 'urban':
 
-        per_month_gb = int(parameters['scenario'].split('_')[1])
+        per_month_gb = parse_scenario(parameters['scenario']).urban
         per_day_gb = per_month_gb / 30
         busy_hour_gb = per_day_gb * (parameters['traffic_in_the_busy_hour_perc'] / 100)
         per_user_mbps = busy_hour_gb * 1000 * 8 / 3600
@@ -192,7 +379,7 @@ def get_per_user_capacity(geotype, parameters):
 
     elif geotype.split(' ')[0] == 'suburban':
 
-        per_month_gb = int(parameters['scenario'].split('_')[2])
+        per_month_gb = parse_scenario(parameters['scenario']).suburban
         per_day_gb = per_month_gb / 30
         busy_hour_gb = per_day_gb * (parameters['traffic_in_the_busy_hour_perc'] / 100)
         per_user_mbps = busy_hour_gb * 1000 * 8 / 3600
@@ -200,7 +387,7 @@ def get_per_user_capacity(geotype, parameters):
 
     elif geotype.split(' ')[0] == 'rural':
 
-        per_month_gb = int(parameters['scenario'].split('_')[3])
+        per_month_gb = parse_scenario(parameters['scenario']).rural
         per_day_gb = per_month_gb / 30
         busy_hour_gb = per_day_gb * (parameters['traffic_in_the_busy_hour_perc'] / 100)
         per_user_mbps = busy_hour_gb * 1000 * 8 / 3600
@@ -0,0 +1,102 @@
+"""
+Parsed strategy and scenario options
+
+The strategy and scenario strings are parsed once, and the parsed
+options are cached, so equal strings share the same parsed object.
+
+"""
+import functools
+from collections import namedtuple
+
+#generation_core_backhaul_sharing_networks_spectrum_tax
+STRATEGY_FIELDS = [
+    'generation', 'core', 'backhaul', 'sharing',
+    'networks', 'spectrum', 'tax',
+]
+
+#adoption_urban_suburban_rural (monthly GB per user by geotype)
+SCENARIO_FIELDS = [
+    'adoption', 'urban', 'suburban', 'rural',
+]
+
+
+class Strategy(namedtuple('Strategy', STRATEGY_FIELDS + ['name'])):
+    """
+    Parsed strategy options, with the strategy string as `name`.
+
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+class Scenario(namedtuple('Scenario', SCENARIO_FIELDS + ['name'])):
+    """
+    Parsed scenario options, with the scenario string as `name`.
+
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+def parse_strategy(strategy):
+    """
+    Parse a strategy string, e.g. '4G_epc_wireless_baseline_baseline_baseline_baseline'.
+
+    Parameters
+    ----------
+    strategy : string or Strategy
+        The strategy being modeled. Parsed strategies are returned as is.
+
+    Returns
+    -------
+    strategy : Strategy
+        Parsed strategy options. Options missing from the string are None.
+
+    """
+    if isinstance(strategy, Strategy):
+        return strategy
+
+    return _parse_strategy(strategy)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_strategy(strategy):
+
+    options = strategy.split('_')[:len(STRATEGY_FIELDS)]
+    options += [None] * (len(STRATEGY_FIELDS) - len(options))
+
+    return Strategy(*options, name=strategy)
+
+
+def parse_scenario(scenario):
+    """
+    Parse a scenario string, e.g. 'baseline_10_10_10'.
+
+    Parameters
+    ----------
+    scenario : string or Scenario
+        The scenario being modeled. Parsed scenarios are returned as is.
+
+    Returns
+    -------
+    scenario : Scenario
+        Parsed scenario options, with the per user capacities as integers.
+
+    """
+    if isinstance(scenario, Scenario):
+        return scenario
+
+    return _parse_scenario(scenario)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_scenario(scenario):
+
+    options = scenario.split('_')
+
+    return Scenario(options[0], *[int(item) for item in options[1:4]],
+        name=scenario)
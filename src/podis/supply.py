@@ -7,10 +7,16 @@ Winter 2020
 
 """
 import math
+import functools
 from itertools import tee
 from operator import itemgetter
 
-from podis.costs import find_network_cost
+import numpy as np
+import pandas as pd
+
+from podis.costs import find_network_cost, find_network_cost_frame
+from podis.demand import get_geotype_classes
+from podis.strategy import parse_strategy
 
 
 def estimate_supply(country, regions, capacity_lut, parameters,
@@ -41,22 +47,32 @@ def estimate_supply(country, regions, capacity_lut, parameters,
     """
     output_regions = []
 
-    for region in regions:
+    strategy = parse_strategy(parameters['strategy'])
+
+    site_densities = find_site_densities(
+        [region['demand_mbps_km2'] for region in regions],
+        [region['geotype'] for region in regions],
+        parameters,
+        country_parameters,
+        capacity_lut,
+        parameters['confidence']
+    )
+
+    for region, site_density in zip(regions, site_densities):
 
-        region['mno_site_density'] = find_site_density(region,
-            parameters, country_parameters, capacity_lut, parameters['confidence'])
+        region['mno_site_density'] = float(site_density)
 
         total_sites_required = math.ceil(region['mno_site_density'] *
             region['area_km2'])
 
         region = estimate_site_upgrades(
             region,
-            parameters['strategy'],
+            strategy,
             total_sites_required,
             country_parameters
         )
 
-        region = estimate_backhaul_upgrades(region, parameters['strategy'], country_parameters)
+        region = estimate_backhaul_upgrades(region, strategy, country_parameters)
 
         region = find_network_cost(
             region,
@@ -65,8 +81,8 @@ def estimate_supply(country, regions, capacity_lut, parameters,
             core_lut,
         )
 
-        region['scenario'] = parameters['scenario']
-        region['strategy'] = parameters['strategy']
+        region['scenario'] = str(parameters['scenario'])
+        region['strategy'] = str(parameters['strategy'])
         region['confidence'] = parameters['confidence']
         region['input_cost'] = parameters['input_cost']
 
@@ -75,6 +91,148 @@ def estimate_supply(country, regions, capacity_lut, parameters,
     return output_regions
 
 
+def estimate_supply_frame(country, regions, capacity_lut, parameters,
+    country_parameters, core_lut):
+    """
+    Columnar equivalent of `estimate_supply`.
+
+    Sites are estimated with `estimate_sites_frame`, and costed with
+    `find_network_cost_frame`.
+
+    Parameters
+    ----------
+    country : dict
+        Country information.
+    regions : pandas DataFrame
+        Data for all regions (one row per region), with demand metrics.
+    capacity_lut : dict
+        A dictionary containing the lookup capacities.
+    parameters : dict
+        All global model parameters.
+    country_parameters : dict
+        All country specific parameters.
+    core_lut : dict
+        Contains the number of existing and required, core and regional assets.
+
+    Returns
+    -------
+    regions : pandas DataFrame
+        Data for all regions, with the metrics `estimate_supply` adds.
+        Asset costs are missing (NaN) for regions with no sites to cost.
+
+    """
+    regions = estimate_sites_frame(regions, capacity_lut, parameters,
+        country_parameters)
+
+    regions = find_network_cost_frame(regions, parameters,
+        country_parameters, core_lut)
+
+    return label_supply_frame(regions, parameters)
+
+
+def estimate_sites_frame(regions, capacity_lut, parameters, country_parameters):
+    """
+    Estimate the site densities, site upgrades and backhaul upgrades of
+    all regions, as column operations.
+
+    These depend on the demand, the generation and backhaul of the
+    strategy and the confidence interval, but not on the costs.
+
+    Parameters
+    ----------
+    regions : pandas DataFrame
+        Data for all regions (one row per region), with demand metrics.
+    capacity_lut : dict
+        A dictionary containing the lookup capacities.
+    parameters : dict
+        All global model parameters.
+    country_parameters : dict
+        All country specific parameters.
+
+    Returns
+    -------
+    regions : pandas DataFrame
+        Data for all regions, with site and backhaul upgrades.
+
+    """
+    regions = regions.copy()
+
+    strategy = parse_strategy(parameters['strategy'])
+    generation = strategy.generation
+    backhaul = strategy.backhaul
+
+    geotype = get_geotype_classes(regions)
+
+    regions['mno_site_density'] = find_site_densities(
+        regions['demand_mbps_km2'].to_numpy(),
+        geotype.to_numpy(),
+        parameters,
+        country_parameters,
+        capacity_lut,
+        parameters['confidence']
+    )
+
+    #get the number of networks in the area
+    networks = geotype.map({
+        g: country_parameters['networks']['baseline' + '_' + g]
+        for g in geotype.unique()
+    }).to_numpy(dtype=float)
+
+    total_sites_required = np.ceil(
+        regions['mno_site_density'].to_numpy() * regions['area_km2'].to_numpy())
+
+    #get the total number of existing sites that the network has (2G-4G)
+    existing_mno_sites = regions['total_estimated_sites'].to_numpy() / networks
+    regions['existing_mno_sites'] = existing_mno_sites
+
+    #get the number of existing 4G sites
+    existing_4G_sites = np.ceil(regions['sites_4G'].to_numpy() / networks)
+    upgrade_from_4G = (generation == '4G') & (existing_4G_sites > 0)
+
+    shortfall = total_sites_required > existing_mno_sites
+
+    regions['new_mno_sites'] = np.where(shortfall,
+        np.round(total_sites_required - existing_mno_sites), 0).astype(int)
+
+    regions['upgraded_mno_sites'] = np.where(shortfall,
+        np.where(existing_mno_sites > 0,
+            np.where(upgrade_from_4G,
+                existing_mno_sites - existing_4G_sites, existing_mno_sites),
+            0),
+        np.where(upgrade_from_4G,
+            np.maximum(total_sites_required - existing_4G_sites, 0),
+            total_sites_required))
+
+    all_mno_sites = (
+        regions['new_mno_sites'] + regions['upgraded_mno_sites']).to_numpy()
+
+    if backhaul in ('fiber', 'wireless'):
+
+        existing_backhaul = regions['backhaul_fiber'].to_numpy()
+        if backhaul == 'wireless':
+            existing_backhaul = (regions['backhaul_wireless'].to_numpy() +
+                existing_backhaul)
+        existing_backhaul = existing_backhaul / networks
+
+        regions['backhaul_new'] = np.where(existing_backhaul < all_mno_sites,
+            np.ceil(all_mno_sites - existing_backhaul), 0).astype(int)
+
+    return regions
+
+
+def label_supply_frame(regions, parameters):
+    """
+    Label supply results with the parameters they were estimated for.
+
+    """
+    regions['scenario'] = str(parameters['scenario'])
+    regions['strategy'] = str(parameters['strategy'])
+    regions['confidence'] = parameters['confidence']
+    regions['input_cost'] = parameters['input_cost']
+
+    return regions
+
+
 def find_site_density(region, parameters, country_parameters,
     capacity_lut, ci):
     """
@@ -96,101 +254,206 @@ def find_site_density(region, parameters, country_parameters,
     site_density : float
         Estimated site density.
     """
-    demand = region['demand_mbps_km2']
-    geotype = region['geotype'].split(' ')[0]
-    ant_type = 'macro'
-    generation = parameters['strategy'].split('_')[0]
-    frequencies = country_parameters['frequencies']
-    frequencies = frequencies[generation]
-    ci = str(ci)
-    unique_densities = set()
+    site_densities = find_site_densities(
+        [region['demand_mbps_km2']],
+        [region['geotype']],
+        parameters,
+        country_parameters,
+        capacity_lut,
+        ci
+    )
 
-    capacity = 0
+    return float(site_densities[0])
 
-    for item in frequencies:
 
-        frequency = str(item['frequency'])
-        bandwidth = str(item['bandwidth'].split('x')[1])
+def find_site_densities(demand, geotypes, parameters, country_parameters,
+    capacity_lut, ci):
+    """
+    For a vector of regions, estimate the number of needed sites.
+
+    Parameters
+    ----------
+    demand : array_like
+        Demand (Mbps per km^2) for each region.
+    geotypes : array_like
+        Settlement type for each region (e.g. 'urban' or 'rural 1').
+    parameters : dict
+        All global model parameters.
+    country_parameters : dict
+        All country specific parameters.
+    capacity_lut : dict
+        A dictionary containing the lookup capacities.
+    ci : int
+        Confidence interval.
 
-        density_capacities = lookup_capacity(
+    Returns
+    -------
+    site_densities : numpy array
+        Estimated site density for each region.
+
+    """
+    demand = np.asarray(demand, dtype=float)
+    geotypes = np.asarray([geotype.split(' ')[0] for geotype in geotypes])
+
+    site_densities = np.empty(len(demand))
+
+    for geotype in np.unique(geotypes):
+
+        curve = get_capacity_curve(capacity_lut, geotype, parameters,
+            country_parameters, ci)
+
+        mask = geotypes == geotype
+        site_densities[mask] = lookup_site_density(demand[mask], curve)
+
+    return site_densities
+
+
+def get_capacity_curve(capacity_lut, geotype, parameters,
+    country_parameters, ci):
+    """
+    Return the compiled density-capacity curve for a geotype.
+
+    The curve depends only on the lut entries for the geotype, generation,
+    confidence interval and frequency set (plus the TDD downlink share for
+    TDD bands), so it is cached by `compile_capacity_curve` on those
+    values. No lut is held by the cache, and a lut changed in place
+    gives a new curve.
+
+    Parameters
+    ----------
+    capacity_lut : dict
+        A dictionary containing the lookup capacities.
+    geotype : string
+        The settlement type e.g. urban, suburban or rural.
+    parameters : dict
+        All global model parameters.
+    country_parameters : dict
+        All country specific parameters.
+    ci : int
+        Confidence interval.
+
+    Returns
+    -------
+    curve : tuple of numpy arrays
+        Sorted site densities and the corresponding capacities.
+
+    """
+    generation = parse_strategy(parameters['strategy']).generation
+    frequencies = country_parameters['frequencies'][generation]
+    ci = str(ci)
+
+    ant_type = 'macro'
+
+    if any(item['bandwidth'].split('x')[0] == '1' for item in frequencies):
+        tdd_dl_to_ul = parameters['tdd_dl_to_ul']
+    else:
+        tdd_dl_to_ul = None
+
+    bands = tuple(
+        (item['bandwidth'], tuple(lookup_capacity(
             capacity_lut,
             geotype,
             ant_type,
-            frequency,
+            str(item['frequency']),
             generation,
             ci
-        )
+        )))
+        for item in frequencies
+    )
 
-        for item in density_capacities:
-            site_density, capacity = item
-            unique_densities.add(site_density)
+    return compile_capacity_curve(bands, tdd_dl_to_ul)
 
-    density_lut = []
 
-    for density in list(unique_densities):
+@functools.lru_cache(maxsize=128)
+def compile_capacity_curve(bands, tdd_dl_to_ul):
+    """
+    Combine the capacity of all frequencies at each site density.
 
-        capacity = 0
+    Capacities are summed across frequencies at each unique density,
+    then scaled by the channel bandwidth (for TDD, the downlink share).
 
-        for item in frequencies:
+    Parameters
+    ----------
+    bands : tuple
+        The bandwidth and the site density to capacity tuples from the
+        lut, for each frequency.
+    tdd_dl_to_ul : string
+        The TDD downlink to uplink ratio, or None without TDD bands.
 
-            frequency = str(item['frequency'])
-            channels, bandwidth = item['bandwidth'].split('x')
-            channels, bandwidth = float(channels), float(bandwidth)
+    Returns
+    -------
+    curve : tuple of numpy arrays
+        Sorted site densities and the corresponding capacities.
 
-            if channels == 1: #allocate downlink channel width when using TDD
-                downlink = float(parameters['tdd_dl_to_ul'].split(':')[0])
-                bandwidth = bandwidth * (downlink / 100)
+    """
+    all_densities = []
+    all_capacities = []
 
-            density_capacities = lookup_capacity(
-                capacity_lut,
-                geotype,
-                ant_type,
-                frequency,
-                generation,
-                ci
-            )
+    for item_bandwidth, density_capacities in bands:
 
-            for density_capacity in density_capacities:
+        channels, bandwidth = item_bandwidth.split('x')
+        channels, bandwidth = float(channels), float(bandwidth)
 
-                if density_capacity[0] == density:
-                    capacity += density_capacity[1]
+        if channels == 1: #allocate downlink channel width when using TDD
+            downlink = float(tdd_dl_to_ul.split(':')[0])
+            bandwidth = bandwidth * (downlink / 100)
 
-        density_lut.append((density, capacity))
+        for site_density, capacity in density_capacities:
+            all_densities.append(site_density)
+            all_capacities.append(capacity)
 
-    density_lut = sorted(density_lut, key=lambda tup: tup[0])
+    densities, inverse = np.unique(all_densities, return_inverse=True)
 
-    max_density, max_capacity = density_lut[-1]
-    min_density, min_capacity = density_lut[0]
+    capacities = np.zeros(len(densities))
+    np.add.at(capacities, inverse, all_capacities)
 
-    max_capacity = max_capacity * bandwidth
-    min_capacity = min_capacity * bandwidth
+    #capacities are scaled by the bandwidth of the last frequency
+    capacities = capacities * bandwidth
 
-    if demand > max_capacity:
+    return densities, capacities
 
-        return max_density
 
-    elif demand < min_capacity:
+def lookup_site_density(demand, curve):
+    """
+    Interpolate the site density needed to meet each demand value.
 
-        return min_density
+    Demand above the curve returns the maximum density, and demand
+    below it returns the minimum density. Capacity is expected to
+    increase with site density.
 
-    else:
+    Parameters
+    ----------
+    demand : numpy array
+        Demand (Mbps per km^2) for each region.
+    curve : tuple of numpy arrays
+        Sorted site densities and the corresponding capacities.
+
+    Returns
+    -------
+    site_densities : numpy array
+        Estimated site density for each demand value.
+
+    """
+    densities, capacities = curve
 
-        for a, b in pairwise(density_lut):
+    if len(densities) == 1:
+        return np.full(len(demand), densities[0])
 
-            lower_density, lower_capacity  = a
-            upper_density, upper_capacity  = b
+    upper = np.searchsorted(capacities, demand, side='right')
+    upper = np.clip(upper, 1, len(capacities) - 1)
+    lower = upper - 1
 
-            lower_capacity = lower_capacity * bandwidth
-            upper_capacity = upper_capacity * bandwidth
+    with np.errstate(divide='ignore', invalid='ignore'):
+        site_densities = interpolate(
+            capacities[lower], densities[lower],
+            capacities[upper], densities[upper],
+            demand
+        )
 
-            if lower_capacity <= demand < upper_capacity:
+    site_densities = np.where(demand >= capacities[-1], densities[-1], site_densities)
+    site_densities = np.where(demand < capacities[0], densities[0], site_densities)
 
-                site_density = interpolate(
-                    lower_capacity, lower_density,
-                    upper_capacity, upper_density,
-                    demand
-                )
-                return site_density
+    return site_densities
 
 
 def lookup_capacity(capacity_lut, env, ant_type, frequency,
@@ -259,7 +522,7 @@ def estimate_site_upgrades(region, strategy, total_sites_required,
     ----------
     region : dict
         Contains all regional data.
-    strategy : dict
+    strategy : string or Strategy
         Controls the strategy variants being tested in the model and is
         defined based on the type of technology generation, core and
         backhaul, and the level of sharing, subsidy, spectrum and tax.
@@ -272,7 +535,7 @@ def estimate_site_upgrades(region, strategy, total_sites_required,
     region : dict
         Contains all regional data.
     """
-    generation = strategy.split('_')[0]
+    generation = parse_strategy(strategy).generation
     geotype = region['geotype'].split(' ')[0]
 
     #get the number of networks in the area
@@ -319,7 +582,7 @@ def estimate_backhaul_upgrades(region, strategy, country_parameters):
     ----------
     region : dict
         Contains all regional data.
-    strategy : dict
+    strategy : string or Strategy
         The strategy string controls the strategy variants being tested in the
         model and is defined based on the type of technology generation, core
         and backhaul, and the level of sharing, subsidy, spectrum and tax.
@@ -330,7 +593,7 @@ def estimate_backhaul_upgrades(region, strategy, country_parameters):
     region : dict
         Contains all regional data.
     """
-    backhaul = strategy.split('_')[2]
+    backhaul = parse_strategy(strategy).backhaul
     geotype = region['geotype'].split(' ')[0]
     networks = country_parameters['networks']['baseline' + '_' + geotype]
     all_mno_sites = (region['new_mno_sites'] + region['upgraded_mno_sites']) # networks
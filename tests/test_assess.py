@@ -1,6 +1,8 @@
+import copy
 import pytest
+import pandas as pd
 from podis.assess import (get_spectrum_costs, calculate_tax,
-    calculate_profit, assess,
+    calculate_profit, assess, assess_frame,
     estimate_subsidies, allocate_available_excess,
     calculate_total_market_costs, calc)
 
@@ -210,6 +212,38 @@ def test_assess(setup_parameters,
     assert answer[1]['required_state_subsidy'] == 53924.0
 
 
+def test_assess_frame(setup_parameters,
+    setup_country_parameters, setup_timesteps):
+    """
+    Check the columnar engine matches the dict-based assess.
+    """
+    regions = []
+    for i, (revenue, cost) in enumerate([
+        (20000, 5000), (12000, 8000), (900000, 3000), (40000, 2500),
+        (7000, 7000), (150000, 1000), (9000, 500), (30000, 4000)]):
+        regions.append({
+            'GID_id': 'MWI.{}'.format(i),
+            'geotype': ['urban', 'suburban 1', 'rural 2'][i % 3],
+            'population': 1000.5 * (i + 1),
+            'population_km2': 500,
+            'total_mno_revenue': revenue,
+            'mno_network_cost': cost * 1.1,
+            'phones_on_network': 250 * i,
+            'smartphones_on_network': 125 * i,
+        })
+
+    expected = assess('MWI', copy.deepcopy(regions), setup_parameters,
+        setup_country_parameters, setup_timesteps)
+
+    answer = assess_frame('MWI', pd.DataFrame(regions), setup_parameters,
+        setup_country_parameters, setup_timesteps)
+
+    assert sum(item['used_cross_subsidy'] > 0 for item in expected) > 1
+    assert list(answer['GID_id']) == [item['GID_id'] for item in expected]
+    for key in expected[0].keys():
+        assert list(answer[key]) == [item[key] for item in expected], key
+
+
 def test_allocate_available_excess():
 
     region = {
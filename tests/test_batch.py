@@ -0,0 +1,87 @@
+import copy
+import pytest
+import pandas as pd
+from podis.demand import estimate_demand
+from podis.supply import estimate_supply
+from podis.assess import assess
+from podis.batch import run_batch
+
+
+def test_run_batch(
+    setup_region,
+    setup_lookup,
+    setup_parameters,
+    setup_country_parameters,
+    setup_core_lut,
+    setup_timesteps,
+    setup_penetration_lut
+    ):
+    """
+    Check the batch engine matches running each parameter set in turn.
+    """
+    regions = []
+    for i, (population, sites) in enumerate([
+        (10000, 100), (50000, 3), (2000, 0), (80000, 40), (100, 1)]):
+        region = dict(setup_region[0])
+        region['population'] = population
+        region['mean_luminosity_km2'] = [0.5, 2, 10][i % 3]
+        region['total_estimated_sites'] = sites
+        region['sites_4G'] = sites // 2
+        region['backhaul_fiber'] = sites // 4
+        region['backhaul_wireless'] = sites // 3
+        regions.append(region)
+    region = dict(setup_region[0])
+    region['area_km2'] = 0
+    regions.append(region)
+
+    smartphone_lut = {'urban': {2020: 50}}
+
+    parameter_table = []
+    for strategy in [
+        '4G_epc_wireless_baseline_baseline_baseline_baseline_baseline',
+        '4G_epc_fiber_baseline_baseline_high_low_baseline']:
+        for input_cost, factor in [('low', 0.6), ('baseline', 1), ('high', 1.4)]:
+            parameters = dict(setup_parameters)
+            parameters['strategy'] = strategy
+            parameters['input_cost'] = input_cost
+            parameters['equipment_capex'] = 40000 * factor
+            parameters['site_rental_urban_opex'] = 9600 * factor
+            parameter_table.append(parameters)
+
+    answer = run_batch(
+        'MWI',
+        pd.DataFrame(regions),
+        pd.DataFrame(parameter_table),
+        setup_country_parameters,
+        setup_timesteps,
+        {'S1_50_50_50': setup_penetration_lut},
+        {'S1_50_50_50': smartphone_lut},
+        setup_lookup,
+        setup_core_lut
+    )
+
+    assert len(answer) == len(parameter_table) * 5
+    assert list(answer['parameter_set'].unique()) == list(range(len(parameter_table)))
+
+    for idx, parameters in enumerate(parameter_table):
+
+        data_demand, annual_demand = estimate_demand(
+            copy.deepcopy(regions), parameters, setup_country_parameters,
+            setup_timesteps, setup_penetration_lut, smartphone_lut)
+
+        data_supply = estimate_supply('MWI', data_demand, setup_lookup,
+            parameters, setup_country_parameters, setup_core_lut)
+
+        expected = assess('MWI', data_supply, parameters,
+            setup_country_parameters, setup_timesteps)
+
+        rows = answer.loc[answer['parameter_set'] == idx].to_dict('records')
+
+        assert len(rows) == len(expected)
+
+        for row, region in zip(rows, expected):
+            for key, value in region.items():
+                if isinstance(value, str):
+                    assert row[key] == value
+                else:
+                    assert row[key] == pytest.approx(value), key
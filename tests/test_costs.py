@@ -1,11 +1,12 @@
 import pytest
 import math
+import pandas as pd
 from podis.costs import (upgrade_to_3g, upgrade_to_4g,
     greenfield_3g, greenfield_4g, backhaul_quantity,
     get_backhaul_capex, regional_net_capex,
     core_capex, discount_opex,
     calc_costs,
-    find_network_cost)
+    find_network_cost, find_network_cost_frame, count_site_classes)
 
 #test approach is to:
 #test each function which returns the cost structure
@@ -232,6 +233,102 @@ def test_find_network_cost_for_sharing_strategies(setup_region,
     assert answer['mno_network_cost'] == 147814.8666666667
 
 
+def test_find_network_cost_aggregate(setup_region,
+    setup_parameters, setup_country_parameters,
+    setup_core_lut):
+    """
+    Check the aggregated cost path matches costing each site individually.
+
+    """
+    setup_region[0]['sites_4G'] = 0
+    setup_region[0]['site_density'] = 0.5
+
+    for strategy in [
+        '3G_epc_wireless_baseline_baseline_baseline_baseline',
+        '4G_epc_wireless_moran_baseline_baseline_baseline',
+        '4G_epc_fiber_baseline_baseline_baseline_baseline',
+        ]:
+        for new, upgraded, backhaul_new in [
+            (0, 0, 0), (1, 0, 0), (7, 3.5, 5), (20, 12, 30), (4, 10, 2)
+            ]:
+
+            setup_parameters['strategy'] = strategy
+            setup_region[0]['new_mno_sites'] = new
+            setup_region[0]['upgraded_mno_sites'] = upgraded
+            setup_region[0]['backhaul_new'] = backhaul_new
+
+            per_site = find_network_cost(dict(setup_region[0]), setup_parameters,
+                setup_country_parameters, setup_core_lut, aggregate=False)
+            aggregated = find_network_cost(dict(setup_region[0]), setup_parameters,
+                setup_country_parameters, setup_core_lut)
+
+            for key in ['mno_network_cost', 'mno_network_capex',
+                'mno_network_opex', 'ran_capex', 'backhaul_capex', 'core_opex']:
+                assert aggregated.get(key) == per_site.get(key)
+
+
+def test_find_network_cost_frame(setup_region,
+    setup_parameters, setup_country_parameters,
+    setup_core_lut):
+    """
+    Check the columnar cost path matches costing each region in turn.
+
+    """
+    setup_region[0]['sites_4G'] = 0
+    setup_region[0]['site_density'] = 0.5
+
+    regions = []
+    for new, upgraded, backhaul_new in [
+        (0, 0, 0), (1, 0, 0), (7, 3.5, 5), (20, 12, 30), (4, 10, 2)
+        ]:
+        region = dict(setup_region[0])
+        region['new_mno_sites'] = new
+        region['upgraded_mno_sites'] = upgraded
+        region['backhaul_new'] = backhaul_new
+        regions.append(region)
+
+    for strategy in [
+        '3G_epc_wireless_baseline_baseline_baseline_baseline',
+        '4G_epc_wireless_moran_baseline_baseline_baseline',
+        '4G_epc_fiber_baseline_baseline_baseline_baseline',
+        ]:
+
+        setup_parameters['strategy'] = strategy
+
+        answer = find_network_cost_frame(pd.DataFrame(regions),
+            setup_parameters, setup_country_parameters, setup_core_lut)
+
+        for row, region in zip(answer.to_dict('records'), regions):
+
+            expected = find_network_cost(dict(region), setup_parameters,
+                setup_country_parameters, setup_core_lut)
+
+            for key in ['mno_network_cost', 'mno_network_capex',
+                'mno_network_opex', 'ran_capex', 'backhaul_capex', 'core_opex']:
+                if key in expected:
+                    assert row[key] == expected[key]
+                else:
+                    assert math.isnan(row[key])
+
+
+def test_count_site_classes():
+    """
+    Unit test.
+
+    """
+    assert count_site_classes(0, 0, 0) == [
+        (True, 1, 0), (True, 0, 0), (False, 1, 0), (False, 0, 0)]
+
+    assert count_site_classes(3, 10, 5) == [
+        (True, 1, 3), (True, 0, 0), (False, 1, 2), (False, 0, 5)]
+
+    assert count_site_classes(3.5, 10.5, 2) == [
+        (True, 1, 2), (True, 0, 1), (False, 1, 0), (False, 0, 7)]
+
+    assert count_site_classes(-2, 4, 10) == [
+        (True, 1, 0), (True, 0, 0), (False, 1, 4), (False, 0, 0)]
+
+
 def test_upgrade_to_3g(setup_region, setup_parameters, setup_core_lut,
     setup_country_parameters):
     """
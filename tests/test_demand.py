@@ -1,6 +1,7 @@
 import pytest
-from podis.demand import (estimate_demand, get_per_user_capacity,
-    estimate_arpu, discount_arpu)
+import pandas as pd
+from podis.demand import (estimate_demand, estimate_demand_frame,
+    get_per_user_capacity, estimate_arpu, discount_arpu)
 
 
 def test_estimate_demand(
@@ -177,6 +178,60 @@ def test_estimate_demand(
     assert answer[0]['population_with_phones'] == 0
 
 
+def test_estimate_demand_frame(
+    setup_region,
+    setup_parameters,
+    setup_country_parameters,
+    ):
+    """
+    Check the columnar engine matches the dict-based estimate_demand.
+    """
+    regions = []
+    for i, (geotype, luminosity) in enumerate([
+        ('urban', 10), ('suburban 1', 2), ('rural 3', 0.5), ('rural 5', 0)]):
+        region = dict(setup_region[0])
+        region['GID_id'] = 'MWI.{}'.format(i)
+        region['geotype'] = geotype
+        region['mean_luminosity_km2'] = luminosity
+        region['pop_under_10_pop'] = 1000 * i
+        regions.append(region)
+    region = dict(setup_region[0])
+    region['area_km2'] = 0
+    regions.append(region)
+
+    timesteps = list(range(2020, 2030 + 1))
+    penetration_lut = {t: 50 + i for i, t in enumerate(timesteps)}
+    smartphone_lut = {
+        'urban': {t: 40 + 2 * i for i, t in enumerate(timesteps)},
+        'rural': {t: 20 + i for i, t in enumerate(timesteps)},
+    }
+
+    expected, expected_annual = estimate_demand(
+        [dict(r) for r in regions], setup_parameters, setup_country_parameters,
+        timesteps, penetration_lut, smartphone_lut)
+
+    answer, annual_answer = estimate_demand_frame(
+        pd.DataFrame(regions), setup_parameters, setup_country_parameters,
+        timesteps, penetration_lut, smartphone_lut)
+
+    assert len(answer) == len(expected) == 4
+    assert len(annual_answer) == len(expected_annual) == 4 * len(timesteps)
+
+    for row, region in zip(answer.to_dict('records'), expected):
+        for key, value in region.items():
+            if isinstance(value, str):
+                assert row[key] == value
+            else:
+                assert row[key] == pytest.approx(value)
+
+    for row, item in zip(annual_answer.to_dict('records'), expected_annual):
+        for key, value in item.items():
+            if isinstance(value, str):
+                assert row[key] == value
+            else:
+                assert row[key] == pytest.approx(value)
+
+
 def test_get_per_user_capacity(setup_parameters):
     """
     Unit test.
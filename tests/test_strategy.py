@@ -0,0 +1,45 @@
+from podis.strategy import (Strategy, Scenario, parse_strategy,
+    parse_scenario)
+from podis.assess import calculate_tax, get_spectrum_costs
+
+
+def test_parse_strategy():
+
+    strategy = parse_strategy('4G_epc_wireless_srn_srn_low_high')
+
+    assert strategy == Strategy('4G', 'epc', 'wireless', 'srn', 'srn',
+        'low', 'high', '4G_epc_wireless_srn_srn_low_high')
+    assert str(strategy) == '4G_epc_wireless_srn_srn_low_high'
+
+    #parsed strategies are interned and passed through
+    assert parse_strategy('4G_epc_wireless_srn_srn_low_high') is strategy
+    assert parse_strategy(strategy) is strategy
+
+    #options missing from the string are None
+    assert parse_strategy('3G_epc_fiber_baseline_baseline_baseline').tax is None
+
+
+def test_parse_scenario():
+
+    scenario = parse_scenario('baseline_10_20_30')
+
+    assert scenario == Scenario('baseline', 10, 20, 30, 'baseline_10_20_30')
+    assert '{}'.format(scenario) == 'baseline_10_20_30'
+    assert parse_scenario('baseline_10_20_30') is scenario
+    assert parse_scenario(scenario) is scenario
+
+
+def test_parsed_strategy_accepted(setup_region, setup_parameters,
+    setup_country_parameters):
+
+    setup_region[0]['mno_network_cost'] = 1e6
+
+    for strategy in [
+        '4G_epc_microwave_baseline_baseline_low_high',
+        parse_strategy('4G_epc_microwave_baseline_baseline_low_high')]:
+
+        assert calculate_tax(setup_region[0], strategy,
+            setup_country_parameters) == 1e6 * (40/100)
+
+        assert get_spectrum_costs(setup_region[0], strategy, setup_parameters,
+            setup_country_parameters) == 400000 * (50 / 100)
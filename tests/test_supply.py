@@ -1,7 +1,8 @@
 import pytest
 from podis.demand import estimate_demand
 from podis.supply import (estimate_supply, find_site_density,
-    estimate_site_upgrades, estimate_backhaul_upgrades)
+    find_site_densities, get_capacity_curve, estimate_site_upgrades,
+    estimate_backhaul_upgrades)
 
 
 def test_find_site_density(
@@ -60,6 +61,47 @@ def test_find_site_density(
     assert answer == 0.02
 
 
+def test_find_site_densities(
+    setup_parameters,
+    setup_country_parameters,
+    setup_lookup,
+    setup_ci
+    ):
+
+    densities, capacities = get_capacity_curve(setup_lookup, 'urban',
+        setup_parameters, setup_country_parameters, setup_ci)
+
+    assert list(densities) == [0.01, 0.02, 0.05, 0.15, 2]
+    assert list(capacities) == [60, 120, 250, 550, 11000]
+
+    #the curve is compiled once and reused
+    assert get_capacity_curve(setup_lookup, 'urban', setup_parameters,
+        setup_country_parameters, setup_ci)[0] is densities
+
+    #a lut changed in place gives a new curve
+    lookup = dict(setup_lookup)
+    get_capacity_curve(lookup, 'urban', setup_parameters,
+        setup_country_parameters, setup_ci)
+    lookup[('urban', 'macro', '800', '4G', '50')] = [(0.01, 2), (2, 200)]
+
+    densities, capacities = get_capacity_curve(lookup, 'urban',
+        setup_parameters, setup_country_parameters, setup_ci)
+
+    assert list(densities) == [0.01, 0.02, 0.05, 0.15, 2]
+    assert list(capacities) == [70, 100, 200, 400, 12000]
+
+    answer = find_site_densities(
+        [100000, 0.005, 250, 120, 11000, 185],
+        ['urban', 'urban', 'urban', 'urban 1', 'urban', 'urban'],
+        setup_parameters,
+        setup_country_parameters,
+        setup_lookup,
+        setup_ci
+    )
+
+    assert list(answer) == [2, 0.01, 0.05, 0.02, 2, pytest.approx(0.035)]
+
+
 def test_estimate_site_upgrades(
     setup_region,
     setup_country_parameters,
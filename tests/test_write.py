@@ -0,0 +1,71 @@
+import os
+import sys
+import pytest
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from write import (compact_results, define_deciles,
+    get_decile_mno_results, get_decile_mno_cost_results)
+
+#columns summed by the decile writers
+DECILE_COLUMNS = [
+    'population', 'area_km2', 'phones_on_network',
+    'smartphones_on_network', 'total_estimated_sites',
+    'existing_mno_sites', 'upgraded_mno_sites', 'new_mno_sites',
+    'total_mno_revenue', 'ran_capex', 'ran_opex', 'backhaul_capex',
+    'backhaul_opex', 'civils_capex', 'core_capex', 'core_opex',
+    'administration', 'spectrum_cost', 'tax', 'profit_margin',
+    'mno_network_capex', 'mno_network_opex', 'mno_network_cost',
+    'total_mno_cost', 'available_cross_subsidy', 'deficit',
+    'used_cross_subsidy', 'required_state_subsidy',
+]
+
+
+@pytest.fixture(scope='function')
+def setup_regional_results():
+    regional_results = []
+
+    for strategy in ['3G_epc_wireless', '4G_epc_fiber']:
+        for i in range(3):
+            region = {
+                'GID_0': 'MWI',
+                'GID_id': 'MWI.1.{}_1'.format(i),
+                'scenario': 'baseline_10_10_10',
+                'strategy': strategy,
+                'confidence': 50,
+                'input_cost': 'baseline',
+                'population_km2': [10, 100, 1000][i],
+            }
+            for column in DECILE_COLUMNS:
+                region[column] = i + 1
+            regional_results.append(region)
+
+    return regional_results
+
+
+def test_decile_results_compact(setup_regional_results):
+    """
+    Check only observed combinations of the categorical columns are
+    written, once results have compact dtypes.
+
+    """
+    regions = compact_results(pd.DataFrame(setup_regional_results))
+    deciles = define_deciles(regions)
+
+    assert isinstance(deciles['decile'].dtype, pd.CategoricalDtype)
+
+    expected = len(deciles[['strategy', 'decile']].drop_duplicates())
+
+    decile_results = get_decile_mno_results(regions, deciles)
+
+    assert len(decile_results) == expected
+    assert decile_results['population'].sum() == 12
+    assert not decile_results['population_km2'].isna().any()
+    assert not decile_results['cost_per_network_user'].isna().any()
+
+    decile_cost_results = get_decile_mno_cost_results(regions, deciles)
+
+    assert len(decile_cost_results) == expected
+    assert not decile_cost_results['cost_per_network_user'].isna().any()
+    assert not decile_cost_results['financial_cost'].isna().any()